@@ -43,19 +43,35 @@ reads_spectrum_image = True
 writes = False
 
 import io
-
-from collections import defaultdict
+import os
+import mmap
+import re
+import hashlib
+import shutil
+import tempfile
+import threading
+import weakref
+
+from collections import defaultdict, deque
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed, wait, FIRST_COMPLETED)
+from multiprocessing import shared_memory
 import xml.etree.ElementTree as ET
 import codecs
 from ast import literal_eval
 from datetime import datetime, timedelta
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import dask
 import dask.array as da
 import dask.delayed as dd
+from dask.utils import parse_bytes, format_bytes
 from struct import unpack as strct_unp
 from zlib import decompress as unzip_block
 import logging
 
+from . import unbcf_numpy
+
 _logger = logging.getLogger(__name__)
 
 warn_once = True
@@ -67,13 +83,238 @@ try:
 except ImportError:  # pragma: no cover
     fast_unbcf = False
     _logger.info("""unbcf_fast library is not present...
-Falling back to slow python only backend.""")
+Falling back to slower python/numpy backend.""")
+
+try:
+    import psutil
+except ImportError:  # pragma: no cover
+    psutil = None
 
 
 class Container(object):
     pass
 
 
+def default_cache_dir():
+    """return the directory for persistent indexes of bcf/sfs files.
+
+    It can be overridden with HUSSARIX_CACHE_DIR environment variable,
+    else the user cache directory of the platform is used."""
+    if 'HUSSARIX_CACHE_DIR' in os.environ:
+        return os.environ['HUSSARIX_CACHE_DIR']
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'hussarix')
+
+
+def container_key(sfs):
+    """return the key identifying the sfs container: the hash of its
+    size, modification time, sfs header and file tree."""
+    stat = os.stat(sfs.filename)
+    tree_start = sfs.chunksize * sfs.tree_address + 0x138
+    header_hash = hashlib.sha1(sfs._view[:0x118 + sfs.chunksize])
+    header_hash.update(sfs._view[tree_start:
+                                 tree_start + 0x200 * sfs.n_tree_items])
+    return hashlib.sha1('{0}:{1}:{2}'.format(
+        stat.st_size, stat.st_mtime_ns,
+        header_hash.hexdigest()).encode('ascii')).hexdigest()
+
+
+class SFSIndexCache(object):
+    """Persistent store of the indexes (numpy arrays) of one sfs container.
+
+    Indexes are kept in single small .npz file per container in the
+    cache directory. The file is keyed by the size, the modification
+    time and the hash of sfs header and file tree of the container,
+    thus changed or replaced container never gets a stale index,
+    while the copy of unchanged container reuses it.
+
+    Arguments:
+    sfs -- SFS_reader instance
+    directory -- the cache directory (default: default_cache_dir())
+
+    Methods:
+    load, store
+    """
+
+    def __init__(self, sfs, directory=None):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), 'sfs_index')
+        self.directory = directory
+        self.filename = os.path.join(directory, container_key(sfs) + '.npz')
+        self._arrays = None
+        # hypermaps of several indexes can be decoded in threads:
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _array_name(path, kind, field):
+        return '{0}.{1}.{2}'.format(path.replace('/', '__'), kind, field)
+
+    def _read(self):
+        if self._arrays is None:
+            self._arrays = {}
+            try:
+                with np.load(self.filename) as npz:
+                    self._arrays = dict(npz.items())
+            except (OSError, ValueError):
+                pass  # no index, or it is unreadable -- start new
+        return self._arrays
+
+    def load(self, path, kind, fields):
+        """return list of arrays of the given fields of index kind
+        of internal file, or None if such index is not cached."""
+        with self._lock:
+            arrays = self._read()
+        names = [self._array_name(path, kind, f) for f in fields]
+        if all(n in arrays for n in names):
+            return [arrays[n] for n in names]
+        return None
+
+    def store(self, path, kind, **fields):
+        """add index arrays (given as keyword arguments) of internal file
+        to the cache. Failure to write the cache is not fatal."""
+        with self._lock:
+            arrays = self._read()
+            for field, array in fields.items():
+                arrays[self._array_name(path, kind, field)] = array
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                fd, tmp_name = tempfile.mkstemp(suffix='.npz',
+                                                dir=self.directory)
+                with os.fdopen(fd, 'wb') as fn:
+                    np.savez(fn, **arrays)
+                os.replace(tmp_name, self.filename)
+            except OSError as error:
+                _logger.info('sfs index cache could not be written: %s',
+                             error)
+
+
+class HypermapCache(object):
+    """Persistent store of decoded hypermaps.
+
+    Every decoded hypermap is kept as .npy file in the cache directory,
+    keyed by the identity of the container (see container_key) and
+    by the decoding parameters, and is returned as read only
+    numpy.memmap when requested again, so only the touched part of
+    the array is paged in from disk. When the total size of the cache
+    exceeds the limit, the least recently used hypermaps are removed.
+
+    Arguments:
+    directory -- the cache directory (default: 'hypermaps' directory
+        in default_cache_dir())
+    size_limit -- the size of cache in bytes (int) or as string,
+        e.g. '20GB' (default '4GB')
+
+    Methods:
+    filename, load, store, evict, clear
+    """
+
+    def __init__(self, directory=None, size_limit='4GB'):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), 'hypermaps')
+        if isinstance(size_limit, str):
+            size_limit = parse_bytes(size_limit)
+        self.directory = directory
+        self.size_limit = size_limit
+
+    def filename(self, sfs, index=0, downsample=1, cutoff_chan=None,
+                 chan_low=0, energy_bin=1, region=None):
+        """return the path of cached hypermap of the container decoded
+        with given parameters."""
+        if region is not None:
+            region = tuple(int(i) for i in region)
+        if cutoff_chan is not None:
+            cutoff_chan = int(cutoff_chan)
+        params = '{0}:{1}:{2}:{3}:{4}:{5}'.format(index, downsample,
+                                                  cutoff_chan, int(chan_low),
+                                                  energy_bin, region)
+        key = hashlib.sha1(params.encode('ascii')).hexdigest()[:16]
+        return os.path.join(self.directory,
+                            '{0}-{1}.npy'.format(container_key(sfs), key))
+
+    def load(self, filename):
+        """return the cached hypermap as read only numpy.memmap, or None
+        if it is not cached."""
+        try:
+            hypermap = np.load(filename, mmap_mode='r')
+            # modification time is the time of last use:
+            os.utime(filename)
+        except (OSError, ValueError):
+            return None
+        return hypermap
+
+    def store(self, filename, hypermap):
+        """write the hypermap into the cache and evict the least
+        recently used ones over the size limit. Hypermap larger than
+        the limit is not stored; failure to write the cache is not
+        fatal."""
+        if hypermap.nbytes > self.size_limit:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(suffix='.tmp',
+                                            dir=self.directory)
+            with os.fdopen(fd, 'wb') as fn:
+                np.save(fn, hypermap)
+            os.replace(tmp_name, filename)
+        except OSError as error:
+            _logger.info('hypermap cache could not be written: %s', error)
+            return
+        self.evict(keep=filename)
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith('.npy'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """remove least recently used hypermaps until the cache fits
+        into the size limit (hypermap given as keep is not removed)."""
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        for _, size, path in entries:
+            if total <= self.size_limit:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:  # still mapped on some platforms
+                continue
+            total -= size
+
+    def clear(self):
+        """remove all cached hypermaps"""
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
 class SFSTreeItem(object):
     """Class to manage one internal sfs file.
 
@@ -87,6 +328,10 @@ class SFSTreeItem(object):
     Methods:
     read_piece, setup_compression_metadata, get_iter_and_properties,
     get_as_BytesIO_string
+
+    The pointer table and compression header are read only on the
+    first access to the file (pointers, uncompressed_blk_size,
+    no_of_compr_blk properties).
     """
 
     def __init__(self, item_raw_string, parent):
@@ -100,8 +345,43 @@ class SFSTreeItem(object):
         self.some_time = self._filetime_to_unix(some_time)
         self.name = name.strip(b'\x00').decode('utf-8')
         self.size_in_chunks = self._calc_pointer_table_size()
-        if self.is_dir == 0:
+        self._pointers = None
+        self._compression_metadata = None
+
+    @property
+    def pointers(self):
+        """sfs pointer table (read on first access)"""
+        if self._pointers is None:
+            self._fill_pointer_table()
+        return self._pointers
+
+    @property
+    def run_starts(self):
+        """first chunk indexes of runs of adjacent chunks"""
+        if self._pointers is None:
             self._fill_pointer_table()
+        return self._run_starts
+
+    @property
+    def run_lengths(self):
+        """lengths (in chunks) of runs of adjacent chunks"""
+        if self._pointers is None:
+            self._fill_pointer_table()
+        return self._run_lengths
+
+    @property
+    def uncompressed_blk_size(self):
+        """uncompressed size of compression block (read on first access)"""
+        if self._compression_metadata is None:
+            self.setup_compression_metadata()
+        return self._compression_metadata[0]
+
+    @property
+    def no_of_compr_blk(self):
+        """number of compression blocks (read on first access)"""
+        if self._compression_metadata is None:
+            self.setup_compression_metadata()
+        return self._compression_metadata[1]
 
     def _calc_pointer_table_size(self):
         n_chunks = -(-self.size // self.sfs.usable_chunk)
@@ -128,25 +408,100 @@ class SFSTreeItem(object):
         # table size in number of chunks:
         n_of_chunks = -(-self.size_in_chunks //
                         (self.sfs.usable_chunk // 4))
-        with open(self.sfs.filename, 'rb') as fn:
-            if n_of_chunks > 1:
-                next_chunk = self._pointer_to_pointer_table
-                temp_string = io.BytesIO()
-                for dummy1 in range(n_of_chunks):
-                    fn.seek(self.sfs.chunksize * next_chunk + 0x118)
-                    next_chunk = strct_unp('<I', fn.read(4))[0]
-                    fn.seek(28, 1)
-                    temp_string.write(fn.read(self.sfs.usable_chunk))
-                temp_string.seek(0)
-                temp_table = temp_string.read()
-                temp_string.close()
-            else:
-                fn.seek(self.sfs.chunksize *
-                        self._pointer_to_pointer_table + 0x138)
-                temp_table = fn.read(self.sfs.usable_chunk)
-            self.pointers = np.fromstring(temp_table[:self.size_in_chunks * 4],
-                                          dtype='uint32').astype(np.int64) *\
-                self.sfs.chunksize + 0x138
+        view = self.sfs._view
+        if n_of_chunks > 1:
+            next_chunk = self._pointer_to_pointer_table
+            temp_table = []
+            for dummy1 in range(n_of_chunks):
+                chunk_addr = self.sfs.chunksize * next_chunk + 0x118
+                next_chunk = strct_unp('<I',
+                                       view[chunk_addr:chunk_addr + 4])[0]
+                temp_table.append(
+                    view[chunk_addr + 32:
+                         chunk_addr + 32 + self.sfs.usable_chunk])
+            temp_table = b''.join(temp_table)
+            table_offset = 0
+        else:
+            temp_table = view
+            table_offset = self.sfs.chunksize *\
+                self._pointer_to_pointer_table + 0x138
+        self._pointers = np.frombuffer(temp_table, dtype='<u4',
+                                       count=self.size_in_chunks,
+                                       offset=table_offset
+                                       ).astype(np.int64) *\
+            self.sfs.chunksize + 0x138
+        self._calc_chunk_runs()
+
+    def _calc_chunk_runs(self):
+        """find the runs of physically adjacent chunks in pointer table.
+
+        Chunks of file written in one pass mostly follow each other in
+        the sfs container, and such run of chunks (with chunk headers in
+        between) can be read at once instead of chunk by chunk.
+        Sets self.run_starts and self.run_lengths (in chunks).
+        """
+        breaks = np.nonzero(np.diff(self._pointers) !=
+                            self.sfs.chunksize)[0] + 1
+        self._run_starts = np.concatenate(([0], breaks)).astype(np.int64)
+        self._run_lengths = np.diff(np.concatenate((self._run_starts,
+                                                    [self.size_in_chunks])))
+        if self.size_in_chunks == 0:
+            self._run_starts = self._run_lengths = np.zeros(0, dtype=np.int64)
+
+    def get_fragmentation(self):
+        """return statistics of how fragmented the file is in the
+        sfs container.
+
+        Returns:
+        dictionary with number of sfs chunks (count of read calls if
+        read chunk by chunk), number of runs of adjacent chunks (count of
+        read calls if read coalesced), the longest run in chunks and
+        fragmentation ratio (0 -- one contiguous run, 1 -- no chunk is
+        adjacent to the previous one).
+        """
+        n_chunks = int(self.size_in_chunks)
+        n_runs = len(self.run_starts)
+        if n_chunks > 1:
+            ratio = (n_runs - 1) / (n_chunks - 1)
+        else:
+            ratio = 0.0
+        return {'chunks': n_chunks,
+                'runs': n_runs,
+                'longest_run': int(self.run_lengths.max()) if n_runs else 0,
+                'fragmentation': ratio}
+
+    def _gather_chunks(self, first, last):
+        """copy the usable part of sfs chunks [first, last) into
+        one contiguous uint8 array, coalescing the runs of
+        adjacent chunks into single strided copy per run.
+        """
+        view = self.sfs._view
+        chunksize = self.sfs.chunksize
+        usable = self.sfs.usable_chunk
+        pointers = self.pointers
+        run_starts, run_lengths = self.run_starts, self.run_lengths
+        out = np.empty((last - first, usable), dtype=np.uint8)
+        run_idx = np.searchsorted(run_starts, first, side='right') - 1
+        idx = first
+        while idx < last:
+            run_end = run_starts[run_idx] + run_lengths[run_idx]
+            n = min(run_end, last) - idx
+            pointer = pointers[idx]
+            span = n * chunksize - 32
+            if pointer + span <= len(view):
+                run = np.frombuffer(view, dtype=np.uint8, count=span,
+                                    offset=pointer)
+                out[idx - first:idx - first + n] = as_strided(
+                    run, shape=(n, usable), strides=(chunksize, 1))
+            else:  # last chunk of truncated container
+                for j in range(n):
+                    piece = view[pointer + j * chunksize:
+                                 pointer + j * chunksize + usable]
+                    out[idx - first + j, :len(piece)] = np.frombuffer(
+                        piece, dtype=np.uint8)
+            idx += n
+            run_idx += 1
+        return out.reshape(-1)
 
     def read_piece(self, offset, length):
         """ Read and returns raw byte string of the file without applying
@@ -157,9 +512,12 @@ class SFSTreeItem(object):
         length: length of the data counting from the offset
 
         Returns:
-        io.ByteIO object
+        memoryview of the memory mapped container if the piece resides
+        inside single sfs chunk (no copy is made), else memoryview
+        of the buffer assembled from the pieces of spanned chunks
+        (runs of adjacent chunks are copied at once).
         """
-        data = io.BytesIO()
+        view = self.sfs._view
         # first block index:
         fb_idx = offset // self.sfs.usable_chunk
         # first block offset:
@@ -168,45 +526,64 @@ class SFSTreeItem(object):
         lb_idx = (offset + length) // self.sfs.usable_chunk
         # last block cut off:
         lbco = (offset + length) % self.sfs.usable_chunk
-        with open(self.sfs.filename, 'rb') as fn:
-            if fb_idx != lb_idx:
-                fn.seek(self.pointers[fb_idx] + fbo)
-                data.write(fn.read(self.sfs.usable_chunk - fbo))
-                for i in self.pointers[fb_idx + 1:lb_idx]:
-                    fn.seek(i)
-                    data.write(fn.read(self.sfs.usable_chunk))
-                if lbco > 0:
-                    fn.seek(self.pointers[lb_idx])
-                    data.write(fn.read(lbco))
-            else:
-                fn.seek(self.pointers[fb_idx] + fbo)
-                data.write(fn.read(length))
-        data.seek(0)
-        return data.read()
-
-    def _iter_read_chunks(self, first=0):
+        if fb_idx == lb_idx or (lb_idx == fb_idx + 1 and lbco == 0):
+            start = self.pointers[fb_idx] + fbo
+            return view[start:start + length]
+        if lbco > 0:
+            lb_idx += 1
+        data = self._gather_chunks(fb_idx, lb_idx)
+        return memoryview(data[fbo:fbo + length])
+
+    def _iter_read_chunks(self, first=0, as_memoryview=False):
         """Generate and return iterator for reading and returning
         sfs internal file in chunks.
 
         By default it creates iterator for whole file, however
-        with kwargs 'first' and 'chunks' the range of chunks
-        for iterator can be set.
+        with kwarg 'first' the first chunk for iterator can be set.
 
         Keyword arguments:
         first -- the index of first chunk from which to read. (default 0)
-        chunks -- the number of chunks to read. (default False)
+        as_memoryview -- yield zero-copy memoryview slices of memory
+            mapped container instead of bytes. (default False)
         """
+        if as_memoryview:
+            container = self.sfs._view
+        else:
+            container = self.sfs._mmap
+        usable_chunk = self.sfs.usable_chunk
+        pointers = self.pointers
         last = self.size_in_chunks
-        with open(self.sfs.filename, 'rb') as fn:
-            for idx in range(first, last - 1):
-                fn.seek(self.pointers[idx])
-                yield fn.read(self.sfs.usable_chunk)
-            fn.seek(self.pointers[last - 1])
-            last_stuff = self.size % self.sfs.usable_chunk
-            if last_stuff != 0:
-                yield fn.read(last_stuff)
-            else:
-                yield fn.read(self.sfs.usable_chunk)
+        for idx in range(first, last - 1):
+            pointer = pointers[idx]
+            yield container[pointer:pointer + usable_chunk]
+        pointer = pointers[last - 1]
+        last_stuff = self.size % usable_chunk
+        if last_stuff != 0:
+            yield container[pointer:pointer + last_stuff]
+        else:
+            yield container[pointer:pointer + usable_chunk]
+
+    def _iter_read_larger_chunks(self, chunk_size=524288,
+                                 as_memoryview=False):
+        """Generate and return iterator for reading
+        the raw data in sensible sized chunks.
+        default chunk size = 524288 bytes (0.5MB)
+
+        The sfs chunks are read in runs of adjacent chunks, thus for
+        not fragmented file every returned chunk is a single copy.
+        """
+        chunks = -(-self.size // chunk_size)
+        last_chunk = self.size % chunk_size
+        offset = 0
+        for dummy1 in range(chunks - 1):
+            raw_string = self.read_piece(offset, chunk_size)
+            offset += chunk_size
+            yield raw_string if as_memoryview else raw_string.tobytes()
+        if last_chunk != 0:
+            raw_string = self.read_piece(offset, last_chunk)
+        else:
+            raw_string = self.read_piece(offset, chunk_size)
+        yield raw_string if as_memoryview else raw_string.tobytes()
 
     def setup_compression_metadata(self):
         """ parse and setup the number of compression chunks
@@ -217,55 +594,171 @@ class SFSTreeItem(object):
         self.uncompressed_blk_size, self.no_of_compr_blk
 
         """
-        with open(self.sfs.filename, 'rb') as fn:
-            fn.seek(self.pointers[0])
-            # AACS signature, uncompressed size, undef var, number of blocks
-            aacs, uc_size, _, n_of_blocks = strct_unp('<IIII', fn.read(16))
+        # AACS signature, uncompressed size, undef var, number of blocks
+        aacs, uc_size, _, n_of_blocks = strct_unp('<IIII',
+                                                  self.read_piece(0, 16))
         if aacs == 0x53434141:  # AACS as string
-            self.uncompressed_blk_size = uc_size
-            self.no_of_compr_blk = n_of_blocks
+            self._compression_metadata = (uc_size, n_of_blocks)
         else:
             raise ValueError("""The file is marked to be compressed,
 but compression signature is missing in the header. Aborting....""")
 
-    def _iter_read_compr_chunks(self):
-        """Generate and return reader and decompressor iterator
-        for compressed with zlib compression sfs internal file.
+    def _scan_compr_blocks(self):
+        """Walk through compression block headers and build the index
+        of compressed blocks.
 
-        Returns:
-        iterator of decompressed data chunks.
+        Sets up attributes:
+        self.compr_blk_offsets -- offsets of compressed data of blocks
+        self.compr_blk_sizes -- sizes of compressed data of blocks
+        self.compr_blk_uc_offsets -- offsets of the blocks in the
+            uncompressed file (with total uncompressed size appended)
         """
-
+        offsets = np.empty(self.no_of_compr_blk, dtype=np.int64)
+        sizes = np.empty(self.no_of_compr_blk, dtype=np.int64)
+        uc_offsets = np.zeros(self.no_of_compr_blk + 1, dtype=np.int64)
         offset = 0x80  # the 1st compression block header
-        for dummy1 in range(self.no_of_compr_blk):
-            cpr_size, dummy_size, dummy_unkn, dummy_size2 = strct_unp('<IIII',
-                                                                      self.read_piece(offset, 16))
+        for i in range(self.no_of_compr_blk):
+            cpr_size, uc_size, dummy_unkn, dummy_size2 = strct_unp(
+                '<IIII', self.read_piece(offset, 16))
             # dummy_unkn is probably some kind of checksum but
             # none of known (crc16, crc32, adler32) algorithm could match.
             # dummy_size2 == cpr_size + 0x10 which have no use...
-            # dummy_size, which is decompressed size, also have no use...
-            # as it is the same in file compression_header
             offset += 16
-            raw_string = self.read_piece(offset, cpr_size)
+            offsets[i] = offset
+            sizes[i] = cpr_size
+            uc_offsets[i + 1] = uc_offsets[i] + uc_size
             offset += cpr_size
-            yield unzip_block(raw_string)
+        self.compr_blk_offsets = offsets
+        self.compr_blk_sizes = sizes
+        self.compr_blk_uc_offsets = uc_offsets
+
+    def setup_compr_block_index(self):
+        """Setup the index of compressed blocks (compressed offset,
+        compressed size and uncompressed offset of every block).
+
+        The index is loaded from persistent index cache of sfs container,
+        if present, else it is built by walking all block headers and
+        stored to the cache for later openings of the container.
+
+        See also:
+        SFSIndexCache
+        """
+        if hasattr(self, 'compr_blk_offsets'):
+            return
+        cache = self.sfs.index_cache
+        if cache is not None:
+            index = cache.load(self.path, 'blocks',
+                               ('offsets', 'sizes', 'uc_offsets'))
+            if index is not None and len(index[0]) == self.no_of_compr_blk:
+                self.compr_blk_offsets, self.compr_blk_sizes, \
+                    self.compr_blk_uc_offsets = index
+                return
+        self._scan_compr_blocks()
+        if cache is not None:
+            cache.store(self.path, 'blocks',
+                        offsets=self.compr_blk_offsets,
+                        sizes=self.compr_blk_sizes,
+                        uc_offsets=self.compr_blk_uc_offsets)
+
+    def locate_uncompressed(self, offset):
+        """return index of compression block containing given offset
+        of uncompressed file and the offset inside that block."""
+        self.setup_compr_block_index()
+        block = offset // self.uncompressed_blk_size
+        # blocks normally are of equal size, else look up:
+        if not (self.compr_blk_uc_offsets[block] <= offset <
+                self.compr_blk_uc_offsets[block + 1]):
+            block = int(np.searchsorted(self.compr_blk_uc_offsets, offset,
+                                        side='right')) - 1
+        return block, offset - int(self.compr_blk_uc_offsets[block])
+
+    def _decompress_block(self, block):
+        """read and decompress the compression block with given index"""
+        return unzip_block(self.read_piece(int(self.compr_blk_offsets[block]),
+                                           int(self.compr_blk_sizes[block])))
 
-    def get_iter_and_properties(self):
+    def _iter_read_compr_chunks(self):
+        """Generate and return reader and decompressor iterator
+        for compressed with zlib compression sfs internal file.
+
+        Returns:
+        iterator of decompressed data chunks.
+        """
+        self.setup_compr_block_index()
+        for block in range(self.no_of_compr_blk):
+            yield self._decompress_block(block)
+
+    def _iter_read_compr_chunks_parallel(self, workers):
+        """Generate and return decompressor iterator for compressed
+        with zlib compression sfs internal file, where blocks are
+        decompressed in the pool of threads (zlib releases the GIL).
+
+        Compression blocks are looked up in the block table, and at most
+        2 * workers blocks are decompressed ahead of consumer, so memory
+        use is bounded. Blocks are returned in order.
+
+        Arguments:
+        workers -- number of decompressing threads
+
+        Returns:
+        iterator of decompressed data chunks.
+        """
+        self.setup_compr_block_index()
+        prefetch = 2 * workers
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                next_block = 0
+                while next_block < self.no_of_compr_blk or pending:
+                    while (len(pending) < prefetch and
+                           next_block < self.no_of_compr_blk):
+                        pending.append(executor.submit(self._decompress_block,
+                                                       next_block))
+                        next_block += 1
+                    yield pending.popleft().result()
+            finally:
+                # iterator abandoned before the end:
+                for future in pending:
+                    future.cancel()
+
+    def get_iter_and_properties(self, as_memoryview=False,
+                                larger_chunks=False):
         """Generate and return the iterator of data chunks and
         properties of such chunks such as size and count.
 
         Method detects if data is compressed and uses iterator with
         decompression involved, else uses simple iterator of chunks.
+        If sfs reader have decompression_workers set to more than 1,
+        compressed blocks are decompressed in parallel.
+
+        Keyword arguments:
+        as_memoryview -- if True, not compressed data chunks are
+            returned as memoryview (zero-copy slices of memory mapped
+            container for sfs chunks), else as bytes (the chunk
+            consumers like unbcf_fast expects bytes). (default False)
+        larger_chunks -- size in bytes of not compressed data chunks
+            to be returned instead of sfs chunks, every such chunk
+            is read with single copy per run of adjacent sfs chunks.
+            (default False)
 
         Returns:
             (iterator, chunk_size, number_of_chunks)
         """
         if self.sfs.compression == 'None':
-            return self._iter_read_chunks(), self.sfs.usable_chunk,\
-                self.size_in_chunks
+            if larger_chunks:
+                return self._iter_read_larger_chunks(
+                    chunk_size=larger_chunks,
+                    as_memoryview=as_memoryview),\
+                    larger_chunks, -(-self.size // larger_chunks)
+            return self._iter_read_chunks(as_memoryview=as_memoryview),\
+                self.sfs.usable_chunk, self.size_in_chunks
         elif self.sfs.compression == 'zlib':
-            return self._iter_read_compr_chunks(), self.uncompressed_blk_size,\
-                self.no_of_compr_blk
+            workers = self.sfs.decompression_workers
+            if workers is not None and workers > 1:
+                iterator = self._iter_read_compr_chunks_parallel(workers)
+            else:
+                iterator = self._iter_read_compr_chunks()
+            return iterator, self.uncompressed_blk_size, self.no_of_compr_blk
         else:
             raise RuntimeError('file', str(self.sfs.filename),
                                ' is compressed by not known and not',
@@ -277,6 +770,105 @@ but compression signature is missing in the header. Aborting....""")
         data.write(b''.join(self.get_iter_and_properties()[0]))
         return data
 
+    def open(self, buffering=io.DEFAULT_BUFFER_SIZE):
+        """Open the internal file for reading as seekable binary
+        file object (decompressed transparently if compressed).
+
+        Arguments:
+        buffering -- size of buffer, if 0 - raw unbuffered SFSFile
+            object is returned. (default io.DEFAULT_BUFFER_SIZE)
+
+        Returns:
+        io.BufferedReader (or SFSFile if buffering is 0)
+        """
+        raw = SFSFile(self)
+        if buffering == 0:
+            return raw
+        return io.BufferedReader(raw, buffer_size=buffering)
+
+
+class SFSFile(io.RawIOBase):
+    """Seekable read only raw file object of sfs internal file.
+
+    Not compressed file is read directly from memory mapped container
+    using pointer table; compressed file is read using compressed
+    block index by decompressing only the blocks covering
+    requested range (last decompressed block is kept for following
+    reads). Thus file can be streamed or partially read without
+    keeping whole (decompressed) file in memory.
+
+    Arguments:
+    item -- SFSTreeItem instance
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.name = item.path
+        self._pos = 0
+        self._compressed = item.sfs.compression != 'None'
+        if self._compressed:
+            item.setup_compr_block_index()
+            self._size = int(item.compr_blk_uc_offsets[-1])
+            self._block = None
+            self._block_data = None
+        else:
+            self._size = item.size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('invalid whence ({0})'.format(whence))
+        if pos < 0:
+            raise ValueError('negative seek position {0}'.format(pos))
+        self._pos = pos
+        return pos
+
+    def _get_block(self, block):
+        if block != self._block:
+            self._block_data = self.item._decompress_block(block)
+            self._block = block
+        return self._block_data
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._pos)
+        if length <= 0:
+            return 0
+        dest = memoryview(buffer).cast('B')
+        done = 0
+        if self._compressed:
+            while done < length:
+                block, offset = self.item.locate_uncompressed(
+                    self._pos + done)
+                data = self._get_block(block)
+                n = min(length - done, len(data) - offset)
+                dest[done:done + n] = data[offset:offset + n]
+                done += n
+        else:
+            view = self.item.sfs._view
+            usable = self.item.sfs.usable_chunk
+            while done < length:
+                chunk, offset = divmod(self._pos + done, usable)
+                pointer = self.item.pointers[chunk] + offset
+                n = min(length - done, usable - offset)
+                dest[done:done + n] = view[pointer:pointer + n]
+                done += n
+        self._pos += length
+        return length
+
 
 class SFS_reader(object):
     """Class to read sfs file.
@@ -291,32 +883,92 @@ class SFS_reader(object):
 
     Attributes:
     filename
+    decompression_workers -- number of threads used to decompress zlib
+        compressed internal files (None or 1 - serial decompression)
+    index_cache -- SFSIndexCache instance keeping persistent indexes
+        of the container, or None if index caching is disabled
 
     Methods:
     get_file
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, decompression_workers=None,
+                 index_cache=True):
         self.filename = filename
+        self.decompression_workers = decompression_workers
+        # the whole container is memory mapped once and all internal
+        # files are read as slices of that mapping:
+        self._open_mapping()
         # read the file header
-        with open(filename, 'rb') as fn:
-            a = fn.read(8)
-            if a != b'AAMVHFSS':
-                raise TypeError(
-                    "file '{0}' is not SFS container".format(filename))
-            fn.seek(0x124)  # this looks to be version, as float value is always
-            # nicely rounded and at older bcf versions (<1.9) it was 2.40,
-            # at new (v2) - 2.60
-            version, self.chunksize = strct_unp('<fI', fn.read(8))
-            self.sfs_version = '{0:4.2f}'.format(version)
-            self.usable_chunk = self.chunksize - 32
-            fn.seek(0x140)
-            # the sfs tree and number of the items / files + directories in it,
-            # and the number in chunks of whole sfs:
-            self.tree_address, self.n_tree_items, self.sfs_n_of_chunks =\
-                strct_unp('<III', fn.read(12))
+        view = self._view
+        if view[:8] != b'AAMVHFSS':
+            raise TypeError(
+                "file '{0}' is not SFS container".format(filename))
+        # this looks to be version, as float value is always
+        # nicely rounded and at older bcf versions (<1.9) it was 2.40,
+        # at new (v2) - 2.60
+        version, self.chunksize = strct_unp('<fI', view[0x124:0x12C])
+        self.sfs_version = '{0:4.2f}'.format(version)
+        self.usable_chunk = self.chunksize - 32
+        # the sfs tree and number of the items / files + directories in it,
+        # and the number in chunks of whole sfs:
+        self.tree_address, self.n_tree_items, self.sfs_n_of_chunks =\
+            strct_unp('<III', view[0x140:0x14C])
+        if index_cache:
+            self.index_cache = SFSIndexCache(self)
+        else:
+            self.index_cache = None
         self._setup_vfs()
 
+    def _open_mapping(self):
+        """memory map the sfs container (read only)"""
+        with open(self.filename, 'rb') as fn:
+            self._mmap = mmap.mmap(fn.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def close(self):
+        """release the memory mapping of the sfs container.
+
+        If memoryview slices handed out by internal files are still
+        alive, the mapping can't be closed: the reader is left open
+        and usable (close can be called again after the slices are
+        released), and the mapping with its file handle is released
+        with the last reference.
+
+        Returns:
+        True if the mapping was closed, else False
+        """
+        if self._mmap.closed:
+            return True
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # keep the reader consistent -- both view and mapping open:
+            self._view = memoryview(self._mmap)
+            _logger.warning('sfs container mapping of %s is still in use '
+                            'and was not closed, the file stays open until '
+                            'the last slice of it is released',
+                            self.filename)
+            return False
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # mmap can't be pickled, it is reopened after unpickling
+        state = self.__dict__.copy()
+        del state['_mmap'], state['_view']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_mapping()
+
     def _setup_vfs(self):
         """Setup the virtual file system tree represented as python dictionary
         with values populated with SFSTreeItem instances
@@ -324,20 +976,17 @@ class SFS_reader(object):
         See also:
         SFSTreeItem
         """
-        with open(self.filename, 'rb') as fn:
-            # file tree do not exceed one chunk in bcf:
-            fn.seek(self.chunksize * self.tree_address + 0x138)
-            raw_tree = fn.read(0x200 * self.n_tree_items)
-            temp_item_list = [SFSTreeItem(raw_tree[i * 0x200:(i + 1) * 0x200],
-                                          self) for i in range(self.n_tree_items)]
-            # temp list with parents of items
-            paths = [[h.parent] for h in temp_item_list]
-        # checking the compression header which can be different per file:
+        # file tree do not exceed one chunk in bcf:
+        tree_start = self.chunksize * self.tree_address + 0x138
+        raw_tree = self._view[tree_start:tree_start + 0x200 * self.n_tree_items]
+        temp_item_list = [SFSTreeItem(raw_tree[i * 0x200:(i + 1) * 0x200],
+                                      self) for i in range(self.n_tree_items)]
+        # temp list with parents of items
+        paths = [[h.parent] for h in temp_item_list]
+        # checking the compression (global to the container) from
+        # the first file; compression header and pointer table of every
+        # file are read lazily on the first access:
         self._check_the_compresion(temp_item_list)
-        if self.compression == 'zlib':
-            for c in temp_item_list:
-                if not c.is_dir:
-                    c.setup_compression_metadata()
         # convert the items to virtual file system tree
         dict_tree = self._flat_items_to_dict(paths, temp_item_list)
         # and finaly set the Virtual file system:
@@ -346,47 +995,63 @@ class SFS_reader(object):
     def _flat_items_to_dict(self, paths, temp_item_list):
         """place items from flat list into dictionary tree
         of virtual file system
+
+        Parent paths are resolved in single pass, reusing the already
+        resolved path of the parent directory.
         """
-        while not all(g[-1] == -1 for g in paths):
-            for f in range(len(paths)):
-                if paths[f][-1] != -1:
-                    paths[f].extend(paths[paths[f][-1]])
-        names = [j.name for j in temp_item_list]
-        names.append('root')  # temp root item in dictionary
-        for p in paths:
-            for r in range(len(p)):
-                p[r] = names[p[r]]
-        for p in paths:
-            p.reverse()
-        root = {}
+        resolved = {-1: []}  # item index -> list of names of parent dirs
         for i in range(len(temp_item_list)):
-            dir_pointer = root
-            for j in paths[i]:
-                if j in dir_pointer:
-                    dir_pointer = dir_pointer[j]
-                else:
-                    dir_pointer[j] = {}
-                    dir_pointer = dir_pointer[j]
-            if temp_item_list[i].is_dir:
-                dir_pointer[temp_item_list[i].name] = {}
+            # walk up until the already resolved parent:
+            chain = []
+            j = i
+            while j not in resolved:
+                chain.append(j)
+                j = paths[j][-1]
+            for k in reversed(chain):
+                parent = paths[k][-1]
+                resolved[k] = resolved[parent] + (
+                    [temp_item_list[parent].name] if parent != -1 else [])
+        root = {'root': {}}
+        for i, item in enumerate(temp_item_list):
+            item.path = '/'.join(resolved[i] + [item.name])
+            dir_pointer = root['root']
+            for j in resolved[i]:
+                dir_pointer = dir_pointer.setdefault(j, {})
+            if item.is_dir:
+                dir_pointer.setdefault(item.name, {})
             else:
-                dir_pointer[temp_item_list[i].name] = temp_item_list[i]
+                dir_pointer[item.name] = item
         # return dict tree:
         return root
 
     def _check_the_compresion(self, temp_item_list):
         """parse, check and setup the self.compression"""
-        with open(self.filename, 'rb') as fn:
-            # Find if there is compression:
-            for c in temp_item_list:
-                if not c.is_dir:
-                    fn.seek(c.pointers[0])
-                    if fn.read(4) == b'\x41\x41\x43\x53':  # string AACS
-                        self.compression = 'zlib'
-                    else:
-                        self.compression = 'None'
-                    # compression is global, can't be diferent per file in sfs
-                    break
+        # Find if there is compression:
+        for c in temp_item_list:
+            if not c.is_dir:
+                if c.read_piece(0, 4) == b'\x41\x41\x43\x53':  # string AACS
+                    self.compression = 'zlib'
+                else:
+                    self.compression = 'None'
+                # compression is global, can't be diferent per file in sfs
+                break
+
+    def open(self, path, buffering=io.DEFAULT_BUFFER_SIZE):
+        """Open the internal file for reading as seekable binary
+        file object.
+
+        Arguments:
+        path -- internal file path in sfs file tree.
+        buffering -- size of buffer, if 0 - raw unbuffered SFSFile
+            object is returned. (default io.DEFAULT_BUFFER_SIZE)
+
+        Returns:
+        io.BufferedReader (or SFSFile if buffering is 0)
+
+        See also:
+        SFSFile, get_file
+        """
+        return self.get_file(path).open(buffering=buffering)
 
     def get_file(self, path):
         """Return the SFSTreeItem (aka internal file) object from
@@ -415,11 +1080,55 @@ class SFS_reader(object):
             item = item[i]
         return item
 
+    def get_fragmentation_report(self):
+        """Return dictionary with fragmentation statistics of every
+        internal file, where keys are the internal paths.
+
+        See also:
+        SFSTreeItem.get_fragmentation
+        """
+        report = {}
+        dirs = [('', self.vfs)]
+        while dirs:
+            path, directory = dirs.pop()
+            for name, item in directory.items():
+                if isinstance(item, dict):
+                    dirs.append((path + name + '/', item))
+                else:
+                    report[path + name] = item.get_fragmentation()
+        return report
+
+
+# forms of literals, which are converted without literal_eval
+# (the result is the same as of literal_eval):
+_int_literal = re.compile(r'[-+]?(?:0|[1-9][0-9]*)\Z')
+_float_literal = re.compile(r'[-+]?(?:[0-9]+\.[0-9]*|\.[0-9]+|[0-9]+(?=[eE]))'
+                            r'(?:[eE][-+]?[0-9]+)?\Z')
+_int_tuple_literal = re.compile(r'[-+]?(?:0|[1-9][0-9]*)'
+                                r'(?:,[-+]?(?:0|[1-9][0-9]*))+\Z')
+_named_literals = {'True': True, 'False': False, 'None': None}
+_prefixed_string = re.compile(r'[bBrRuUfF]{1,2}[\'"]')
+
 
 def interpret(string):
     """interpret any string and return casted to appropriate
     dtype python object
     """
+    # dictionarize passes already interpreted values of children:
+    if not isinstance(string, str):
+        return string
+    # most of bruker values are plain numbers, lists of integers
+    # or words, which are converted directly:
+    if _int_literal.match(string):
+        return int(string)
+    if _float_literal.match(string):
+        return float(string)
+    if _int_tuple_literal.match(string):
+        return tuple(int(i) for i in string.split(','))
+    if string in _named_literals:
+        return _named_literals[string]
+    if string[:1].isalpha() and not _prefixed_string.match(string):
+        return string
     try:
         return literal_eval(string)
     except (ValueError, SyntaxError):
@@ -428,6 +1137,49 @@ def interpret(string):
         return string
 
 
+def _node_value(node, tag, default=None):
+    """return the value of child node with given tag, same as it would be
+    in dictionarize(node), or default if there is no such child"""
+    child = node.find(tag)
+    if child is None:
+        return default
+    return dictionarize(child)[tag]
+
+
+class _LazyMetadata(object):
+    """Descriptor of metadata dictionary, which is made from xml node
+    (kept in the attribute node_attr) with convert function only when
+    the metadata is accessed for the first time."""
+
+    def __init__(self, node_attr, convert=None):
+        self.node_attr = node_attr
+        self.convert = dictionarize if convert is None else convert
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = self.convert(getattr(obj, self.node_attr))
+        # instance attribute hides the descriptor from now on:
+        obj.__dict__[self.name] = value
+        return value
+
+
+def _detector_metadata(detector_header):
+    """dictionarize detector header with decoded detector layers"""
+    metadata = dictionarize(detector_header)
+    # decode silly hidden detector layer info:
+    det_l_str = metadata['DetLayers']
+    dec_det_l_str = codecs.decode(det_l_str.encode('ascii'), 'base64')
+    mini_xml = ET.fromstring(unzip_block(dec_det_l_str))
+    metadata['DetLayers'] = {}  # Overwrite with dict
+    for i in mini_xml:
+        metadata['DetLayers'][i.tag] = dict(i.attrib)
+    return metadata
+
+
 def dictionarize(t):
     d = {t.tag: {} if t.attrib else None}
     children = list(t)
@@ -454,6 +1206,12 @@ def dictionarize(t):
 
 class EDXSpectrum(object):
 
+    # metadata dictionaries are made on demand:
+    hardware_metadata = _LazyMetadata('_hardware_header')
+    detector_metadata = _LazyMetadata('_detector_header', _detector_metadata)
+    esma_metadata = _LazyMetadata('_esma_header')
+    spectrum_metadata = _LazyMetadata('_spectrum_header')
+
     def __init__(self, spectrum):
         """
         Wrap the objectified bruker EDS spectrum xml part
@@ -475,34 +1233,30 @@ class EDXSpectrum(object):
         spectrum_header = spectrum.find(
             "./ClassInstance[@Type='TRTSpectrumHeader']")
 
+        # the xml branches are dictionarized only if metadata
+        # is accessed, the used values are taken directly:
+        self._hardware_header = hardware_header
+        self._detector_header = detector_header
+        self._esma_header = esma_header
+        self._spectrum_header = spectrum_header
+
         # map stuff from harware xml branch:
-        self.hardware_metadata = dictionarize(hardware_header)
-        self.amplification = self.hardware_metadata['Amplification']  # USED
+        self.amplification = _node_value(hardware_header,
+                                         'Amplification')  # USED
 
         # map stuff from detector xml branch
-        self.detector_metadata = dictionarize(detector_header)
-        self.detector_type = self.detector_metadata['Type']  # USED
-
-        # decode silly hidden detector layer info:
-        det_l_str = self.detector_metadata['DetLayers']
-        dec_det_l_str = codecs.decode(det_l_str.encode('ascii'), 'base64')
-        mini_xml = ET.fromstring(unzip_block(dec_det_l_str))
-        self.detector_metadata['DetLayers'] = {}  # Overwrite with dict
-        for i in mini_xml.getchildren():
-            self.detector_metadata['DetLayers'][i.tag] = dict(i.attrib)
+        self.detector_type = _node_value(detector_header, 'Type')  # USED
 
         # map stuff from esma xml branch:
-        self.esma_metadata = dictionarize(esma_header)
         # USED:
-        self.hv = self.esma_metadata['PrimaryEnergy']
-        self.elevationAngle = self.esma_metadata['ElevationAngle']
+        self.hv = _node_value(esma_header, 'PrimaryEnergy')
+        self.elevationAngle = _node_value(esma_header, 'ElevationAngle')
         #self.azimutAngle = self.esma_metadata['AzimutAngle']
 
         # map stuff from spectra xml branch:
-        self.spectrum_metadata = dictionarize(spectrum_header)
-        self.calibAbs = self.spectrum_metadata['CalibAbs']
-        self.calibLin = self.spectrum_metadata['CalibLin']
-        self.chnlCnt = self.spectrum_metadata['ChannelCount']
+        self.calibAbs = _node_value(spectrum_header, 'CalibAbs')
+        self.calibLin = _node_value(spectrum_header, 'CalibLin')
+        self.chnlCnt = _node_value(spectrum_header, 'ChannelCount')
 
         # main data:
         self.data = np.fromstring(spectrum.find('./Channels').text,
@@ -522,12 +1276,176 @@ class EDXSpectrum(object):
         return int(round((en_temp - self.calibAbs) / self.calibLin))
 
 
+# characters of base64 encoding (other are skipped by decoder):
+_base64_chars = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                          '0123456789+/=')
+
+
+def _decode_image_plane(text, height, width, step=1):
+    """decode base64 encoded 16bit image plane into numpy array;
+    every step-th pixel is kept if step > 1 (thumbnail)"""
+    raw = codecs.decode(text.encode('ascii'), 'base64')
+    array = np.frombuffer(raw, dtype=np.uint16).reshape((height, width))
+    return array[::step, ::step].copy()
+
+
+class ImagePlane(object):
+    """Lazy image plane (single detector) of bruker xml image node.
+
+    The base64 encoded text is kept and decoded into numpy array on
+    first access of data attribute.
+    """
+
+    def __init__(self, text, height, width, description):
+        self.text = text
+        self.height = height
+        self.width = width
+        self.description = description
+        self._data = None
+
+    @property
+    def decoded(self):
+        return self._data is not None
+
+    @property
+    def is_empty(self):
+        """True if all pixels are zero (checked without decoding:
+        zero bytes are encoded into 'A' characters, any other base64
+        character is not zero; the text with characters skipped by
+        base64 decoder is decoded)"""
+        if self._data is not None:
+            return not self._data.any()
+        # base64 blocks are broken into lines:
+        text = ''.join(self.text.split())
+        if not text.strip('A='):
+            return True
+        if _base64_chars.issuperset(text):
+            return False
+        return not self.data.any()
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = _decode_image_plane(self.text, self.height,
+                                             self.width)
+        return self._data
+
+    def thumbnail_step(self, max_size):
+        """return the step of pixels for thumbnail with largest side
+        not bigger than max_size"""
+        return max(1, -(-max(self.height, self.width) // max_size))
+
+    def thumbnail(self, max_size=256):
+        """return decimated (every n-th pixel) plane with largest side
+        not bigger than max_size; decoded full plane is not kept"""
+        step = self.thumbnail_step(max_size)
+        if self._data is not None:
+            return self._data[::step, ::step].copy()
+        return _decode_image_plane(self.text, self.height, self.width, step)
+
+
+class HyperImage(object):
+    """SEM (or overview) imagery of bruker xml image node with lazily
+    decoded planes.
+
+    Attributes:
+    width, height -- size of image in pixels
+    plane_count -- number of planes in xml
+    planes -- list of ImagePlane
+    markers -- hyperspy markers dict added to metadata of items
+      (rectangle of mapping on overview image) or None
+
+    The images property returns (and keeps) the hyperspy dicts of not
+    empty planes, planes are decoded only then.
+    """
+
+    def __init__(self, header, width, height, planes, markers=None):
+        self.header = header
+        self.width = width
+        self.height = height
+        self.plane_count = len(planes)
+        self.planes = planes
+        self.markers = markers
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = self.get_images()
+        return self._images
+
+    def decode(self, workers=None, thumbnail_size=None):
+        """decode not empty planes, in parallel processes if workers > 1
+        (binascii holds the GIL, so threads would not help).
+
+        Returns:
+        list of (plane, array, step) tuples, where step is the decimation
+        of thumbnail (1 for full planes, which are kept in the planes)
+        """
+        planes = [p for p in self.planes if not p.is_empty]
+        steps = [1 if thumbnail_size is None else
+                 p.thumbnail_step(thumbnail_size) for p in planes]
+        pending = [i for i, p in enumerate(planes) if not p.decoded]
+        arrays = [p._data for p in planes]
+        if workers is not None and workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(
+                    _decode_image_plane,
+                    [planes[i].text for i in pending],
+                    [planes[i].height for i in pending],
+                    [planes[i].width for i in pending],
+                    [steps[i] for i in pending])
+                for i, array in zip(pending, results):
+                    arrays[i] = array
+        else:
+            for i in pending:
+                arrays[i] = _decode_image_plane(planes[i].text,
+                                                planes[i].height,
+                                                planes[i].width, steps[i])
+        decoded = []
+        for plane, array, step in zip(planes, arrays, steps):
+            if thumbnail_size is None:
+                plane._data = array
+            elif plane.decoded:
+                array = array[::step, ::step].copy()
+            decoded.append((plane, array, step))
+        return decoded
+
+    def get_images(self, workers=None, thumbnail_size=None):
+        """return list of hyperspy dicts of not empty planes.
+
+        Arguments:
+        workers -- number of processes decoding planes (default None --
+          sequential decoding).
+        thumbnail_size -- if set, planes are decimated to thumbnails with
+          largest side not bigger than that (axes are rescaled), full
+          planes are not kept (default None).
+        """
+        images = []
+        for plane, data, step in self.decode(workers=workers,
+                                             thumbnail_size=thumbnail_size):
+            item = self.header.gen_hspy_item_dict_basic()
+            item['data'] = data
+            item['axes'][0]['size'] = data.shape[0]
+            item['axes'][1]['size'] = data.shape[1]
+            if step > 1:
+                item['axes'][0]['scale'] *= step
+                item['axes'][1]['scale'] *= step
+            item['metadata']['General'] = {'title': plane.description}
+            item['metadata']['Signal'] = {'signal_type': plane.description,
+                                          'record_by': 'image'}
+            if self.markers is not None:
+                item['metadata']['Markers'] = {'overview': self.markers}
+            images.append(item)
+        return images
+
+
 class HyperHeader(object):
     """Wrap Bruker HyperMaping xml header into python object.
 
     Arguments:
     xml_str -- the uncompressed to be provided with extracted Header xml
-    from bcf.
+    from bcf (bytes or binary file object to stream it from).
 
     Methods:
     estimate_map_channels, estimate_map_depth
@@ -537,11 +1455,22 @@ class HyperHeader(object):
     and it's metadata per hypermap slice which can be selected using index.
     Bcf can record number of imagery from different
     imagining detectors (BSE, SEI, ARGUS, etc...): access to imagery
-    is throught image index.
+    is throught image index. Image planes (image and overview attributes,
+    see HyperImage) are decoded only when requested.
+
+    Metadata dictionaries (sem_metadata, stage_metadata, dsp_metadata
+    and the metadata of spectra) are made from xml on first access.
     """
 
+    sem_metadata = _LazyMetadata('_sem_node')
+    stage_metadata = _LazyMetadata('_stage_node')
+    dsp_metadata = _LazyMetadata('_dsp_node')
+
     def __init__(self, xml_str, indexes, instrument=None):
-        root = ET.fromstring(xml_str)
+        if hasattr(xml_str, 'read'):
+            root = ET.parse(xml_str).getroot()
+        else:
+            root = ET.fromstring(xml_str)
         root = root.find("./ClassInstance[@Type='TRTSpectrumDatabase']")
         try:
             self.name = str(root.attrib['Name'])
@@ -580,22 +1509,22 @@ class HyperHeader(object):
         """
 
         semData = root.find("./ClassInstance[@Type='TRTSEMData']")
-        self.sem_metadata = dictionarize(semData)
+        self._sem_node = semData
         # parse values for use in hspy metadata:
-        self.hv = self.sem_metadata.get('HV', 0.0)  # in kV
+        self.hv = _node_value(semData, 'HV', 0.0)  # in kV
         # image/hypermap resolution in um/pixel:
-        if 'DX' in self.sem_metadata:
+        if semData.find('DX') is not None:
             self.units = 'µm'
         else:
             self.units = 'pix'
-        self.x_res = self.sem_metadata.get('DX', 1.0)
-        self.y_res = self.sem_metadata.get('DY', 1.0)
+        self.x_res = _node_value(semData, 'DX', 1.0)
+        self.y_res = _node_value(semData, 'DY', 1.0)
         # stage position:
-        semStageData = root.find("./ClassInstance[@Type='TRTSEMStageData']")
-        self.stage_metadata = dictionarize(semStageData)
+        self._stage_node = root.find(
+            "./ClassInstance[@Type='TRTSEMStageData']")
         # DSP configuration (always present, part of Bruker system):
-        DSPConf = root.find("./ClassInstance[@Type='TRTDSPConfiguration']")
-        self.dsp_metadata = dictionarize(DSPConf)
+        self._dsp_node = root.find(
+            "./ClassInstance[@Type='TRTDSPConfiguration']")
 
     def _get_mode(self, instrument=None):
         # where is no way to determine what kind of instrument was used:
@@ -632,7 +1561,8 @@ class HyperHeader(object):
         return acq_inst
 
     def _parse_image(self, xml_node, overview=False):
-        """parse image from bruker xml image node."""
+        """parse image from bruker xml image node into HyperImage;
+        planes are not decoded here."""
         if overview:
             rect_node = xml_node.find("./ChildClassInstances"
                 "/ClassInstance["
@@ -649,29 +1579,17 @@ class HyperHeader(object):
                          'data': rect,
                          'marker_properties': {'color': 'yellow',
                                                'linewidth': 2}}
-        image = Container()
-        image.width = int(xml_node.find('./Width').text)  # in pixels
-        image.height = int(xml_node.find('./Height').text)  # in pixels
-        image.plane_count = int(xml_node.find('./PlaneCount').text)
-        image.images = []
-        for i in range(image.plane_count):
+        else:
+            over_dict = None
+        width = int(xml_node.find('./Width').text)  # in pixels
+        height = int(xml_node.find('./Height').text)  # in pixels
+        plane_count = int(xml_node.find('./PlaneCount').text)
+        planes = []
+        for i in range(plane_count):
             img = xml_node.find("./Plane" + str(i))
-            raw = codecs.decode((img.find('./Data').text).encode('ascii'),'base64')
-            array1 = np.fromstring(raw, dtype=np.uint16)
-            if any(array1):
-                item = self.gen_hspy_item_dict_basic()
-                data = array1.reshape((image.height, image.width))
-                detector_name = str(img.find('./Description').text)
-                item['data'] = data
-                item['axes'][0]['size'] = image.height
-                item['axes'][1]['size'] = image.width
-                item['metadata']['General'] = {'title': detector_name}
-                item['metadata']['Signal'] = {'signal_type': detector_name,
-                                              'record_by': 'image'}
-                if overview:
-                    item['metadata']['Markers'] = {'overview': over_dict}
-                image.images.append(item)
-        return image
+            planes.append(ImagePlane(img.find('./Data').text, height, width,
+                                     str(img.find('./Description').text)))
+        return HyperImage(self, width, height, planes, markers=over_dict)
 
     def _set_images(self, root):
         """Wrap objectified xml part with image to class attributes
@@ -738,7 +1656,8 @@ class HyperHeader(object):
         else:
             return self.spectra_data[index].energy_to_channel(self.hv)
 
-    def estimate_map_depth(self, index=0, downsample=1, for_numpy=False):
+    def estimate_map_depth(self, index=0, downsample=1, for_numpy=False,
+                           energy_bin=1):
         """estimate minimal dtype of array using cumulative spectra
         of the all pixels so that no data would be truncated.
 
@@ -752,6 +1671,8 @@ class HyperHeader(object):
         the dtype should be signed; if cython implementation will
         be used (default), then any returned dtypes can be safely
         unsigned. (default False)
+        energy_bin -- number of adjacent channels summed together
+            (default 1)
 
         Returns:
         numpy dtype large enought to use in final hypermap numpy array.
@@ -761,6 +1682,9 @@ class HyperHeader(object):
         safe side multiplying by 2.
         """
         sum_eds = self.spectra_data[index].data
+        if energy_bin > 1:
+            sum_eds = np.add.reduceat(sum_eds,
+                                      np.arange(0, len(sum_eds), energy_bin))
         # the most intensive peak is Bruker reference peak at 0kV:
         roof = np.max(sum_eds) // self.image.width // self.image.height * 2 *\
             downsample * downsample
@@ -844,10 +1768,16 @@ class BCF_reader(SFS_reader):
 
     Attributes:
     filename
+    hypermap_cache -- HypermapCache instance keeping decoded hypermaps
+        of persistent_parse_hypermap, or None if it is disabled
 
     Methods:
     print_the_metadata, persistent_parse_hypermap, parse_hypermap,
-    py_parse_hypermap
+    py_parse_hypermap, parallel_parse_hypermap, lazy_parse_hypermap,
+    parse_sparse_hypermap, parse_compact_hypermap, get_element_maps, get_hypermap_statistics,
+    get_spectrum_index, memmap_parse_hypermap, plan_hypermap, load_hypermap,
+    iter_hypermap_lines, parse_hypermaps, persistent_parse_hypermaps,
+    get_hypermap_pca
     (Inherited from SFS_reader: print_file_tree, get_file)
 
     The class instantiates HyperHeader class as self.header attribute
@@ -857,17 +1787,38 @@ class BCF_reader(SFS_reader):
     where index of the hypermap (default 0) is the key to the instance.
     """
 
-    def __init__(self, filename, instrument=None):
-        SFS_reader.__init__(self, filename)
-        header_file = self.get_file('EDSDatabase/HeaderData')
+    def __init__(self, filename, instrument=None, decompression_workers=None,
+                 index_cache=True, hypermap_cache=False):
+        SFS_reader.__init__(self, filename,
+                            decompression_workers=decompression_workers,
+                            index_cache=index_cache)
+        if hypermap_cache is True:
+            self.hypermap_cache = HypermapCache()
+        elif hypermap_cache:
+            self.hypermap_cache = hypermap_cache
+        else:
+            self.hypermap_cache = None
         self.available_indexes = []
         for i in self.vfs['EDSDatabase'].keys():
             if 'SpectrumData' in i:
                 self.available_indexes.append(int(i[-1]))
         self.def_index = min(self.available_indexes)
-        header_byte_str = header_file.get_as_BytesIO_string().getvalue()
-        self.header = HyperHeader(header_byte_str, self.available_indexes, instrument=instrument)
+        # xml header is streamed from the internal file:
+        with self.open('EDSDatabase/HeaderData') as header_file:
+            self.header = HyperHeader(header_file, self.available_indexes,
+                                      instrument=instrument)
         self.hypermap = {}
+        self.spectrum_index = {}
+        # temporary memmap files, which could not be deleted yet:
+        self._temporary_files = []
+
+    def close(self):
+        """release the memory mapping of the bcf and delete the
+        temporary memmap files left (see memmap_parse_hypermap)"""
+        closed = SFS_reader.close(self)
+        for filename in list(self._temporary_files):
+            _remove_temporary(filename, self._temporary_files)
+        return closed
     
     def check_index_valid(self, index):
         """check and return if index is valid""" 
@@ -878,41 +1829,127 @@ class BCF_reader(SFS_reader):
                 "Available maps are under indexes: {0}".format(str(self.available_indexes)))
         return index
     
+    def get_spectrum_index(self, index=None, build=True):
+        """Return the index of line and pixel record offsets of hypermap.
+
+        The index (unbcf_numpy.SpectrumIndex) is built with single
+        header-only pass over the hypermap data and is kept in
+        self.spectrum_index dictionary and in the persistent index cache
+        of the container (if enabled), next to the index of compressed
+        blocks.
+
+        Arguments:
+        index -- index of hypermap in bcf if v2 (default 0)
+        build -- if False, the index is not built, when it is not
+            available already, and None is returned (default True)
+        """
+        if index is None:
+            index = self.def_index
+        if index in self.spectrum_index:
+            return self.spectrum_index[index]
+        path = 'EDSDatabase/SpectrumData' + str(index)
+        arrays = None
+        if self.index_cache is not None:
+            arrays = self.index_cache.load(path, 'lines',
+                                           unbcf_numpy.SpectrumIndex.fields)
+        if arrays is None:
+            if not build:
+                return None
+            spectrum_file = self.get_file(path)
+            height = unbcf_numpy.map_dimensions(spectrum_file)[0]
+            sp_index = unbcf_numpy.SpectrumIndex.build(
+                unbcf_numpy.open_stream(spectrum_file), height)
+            if self.index_cache is not None:
+                self.index_cache.store(path, 'lines',
+                                       lines=sp_index.lines,
+                                       pixels=sp_index.pixels,
+                                       line_pixels=sp_index.line_pixels)
+        else:
+            sp_index = unbcf_numpy.SpectrumIndex(*arrays)
+        self.spectrum_index[index] = sp_index
+        return sp_index
+
     def persistent_parse_hypermap(self, index=None, downsample=None,
                                   cutoff_at_kV=None,
-                                  lazy=False):
+                                  lazy=False, region=None, workers=None,
+                                  energy_bin=1, low_cutoff_at_kV=None,
+                                  progress=None):
         """Parse and assign the hypermap to the HyperMap instance.
 
         Arguments:
         index -- index of hypermap in bcf if v2 (default 0)
         downsample -- downsampling factor of hypermap (default None)
         cutoff_at_kV -- low pass cutoff value at keV (default None)
+        region -- (y0, y1, x0, x1) rectangle of hypermap to be parsed
+            (default None)
+        workers -- number of processes to decode hypermap (default None)
+        energy_bin -- number of adjacent channels summed together
+            (default 1)
+        low_cutoff_at_kV -- high pass cutoff value at keV (default None)
+        progress -- unbcf_numpy.Progress instance (default None)
 
         Method does not return anything, it adds the HyperMap instance to
         self.hypermap dictionary.
 
+        If hypermap cache is enabled (see HypermapCache), the hypermap
+        decoded with the same parameters before is returned from the
+        cache as numpy.memmap (or dask array of it if lazy), and newly
+        decoded (not lazy) hypermap is stored in the cache.
+
         See also:
         HyperMap, parse_hypermap
         """
         if index is None:
             index = self.def_index
-        dwn = downsample
-        hypermap = self.parse_hypermap(index=index,
-                                       downsample=dwn,
-                                       cutoff_at_kV=cutoff_at_kV,
-                                       lazy=lazy)
+        dwn = 1 if downsample is None else downsample
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        params = dict(downsample=dwn, cutoff_chan=cutoff_chan,
+                      region=region, chan_low=chan_low,
+                      energy_bin=energy_bin)
+        hypermap = None
+        if self.hypermap_cache is not None:
+            cache_file = self.hypermap_cache.filename(self, index=index,
+                                                      **params)
+            hypermap = self.hypermap_cache.load(cache_file)
+            if hypermap is not None and lazy:
+                hypermap = da.from_array(hypermap, chunks=('auto', -1, -1))
+        if hypermap is None:
+            hypermap = self._parse_hypermap_channels(index, lazy=lazy,
+                                                     workers=workers,
+                                                     progress=progress,
+                                                     **params)
+            if self.hypermap_cache is not None and not lazy:
+                self.hypermap_cache.store(cache_file, hypermap)
         self.hypermap[index] = HyperMap(hypermap,
                                         self,
                                         index=index,
-                                        downsample=dwn)
+                                        downsample=dwn,
+                                        region=region,
+                                        energy_bin=energy_bin,
+                                        chan_low=chan_low)
+
+    def _energy_cutoffs(self, index, cutoff_at_kV, low_cutoff_at_kV):
+        """return (cutoff channel or None, low cutoff channel)"""
+        eds = self.header.get_spectra_metadata(index)
+        if type(cutoff_at_kV) in (int, float):
+            cutoff_chan = eds.energy_to_channel(cutoff_at_kV)
+        else:
+            cutoff_chan = None
+        if type(low_cutoff_at_kV) in (int, float):
+            chan_low = max(0, eds.energy_to_channel(low_cutoff_at_kV))
+        else:
+            chan_low = 0
+        return cutoff_chan, chan_low
 
     def parse_hypermap(self, index=None,
                        downsample=1, cutoff_at_kV=None,
-                       lazy=False):
+                       lazy=False, region=None, workers=None,
+                       energy_bin=1, low_cutoff_at_kV=None, progress=None):
         """Unpack the Delphi/Bruker binary spectral map and return
         numpy array in memory efficient way.
 
-        Pure python/numpy implementation -- slow, or
+        Pure python/numpy implementation (unbcf_numpy) -- slower, or
         cython/memoryview/numpy implimentation if compilied and present
         (fast) is used.
 
@@ -925,52 +1962,1017 @@ class BCF_reader(SFS_reader):
             memory requiriments. (default 1)
         cutoff_at_kV -- value in keV to truncate the array at. Helps reducing
           size of array. (default None)
-        lazy -- return dask.array (True) or numpy.array (False) (default False)
+        lazy -- return dask.array (True) chunked by the bands of lines
+            (see lazy_parse_hypermap) or numpy.array (False)
+            (default False)
+        region -- (y0, y1, x0, x1) rectangle of hypermap to be parsed;
+            only lines in range are decoded and pixels outside the x
+            range are skipped without unpacking. If the spectrum index
+            (see get_spectrum_index) is available, lines before the
+            region are not read at all. Region is always parsed with
+            python/numpy backend. (default None)
+        workers -- number of processes to decode the (not lazy) hypermap
+            with python/numpy backend, see parallel_parse_hypermap.
+            (default None -- decode in this process)
+        energy_bin -- number of adjacent channels summed together while
+            decoding, which reduces the size of array energy_bin times.
+            (default 1)
+        low_cutoff_at_kV -- value in keV, the channels below are dropped
+            (default None)
+        progress -- unbcf_numpy.Progress instance, which reports the
+            decoded lines, read bytes and ETA to its callback and can
+            cancel the decoding (raising unbcf_numpy.DecodingCancelled
+            with partially decoded array if requested). Not available
+            for lazy array, which is computed by dask (use dask
+            diagnostics). (default None)
+        Energy binning, low cutoff and progress are done with
+        python/numpy backend.
 
         Returns:
         numpy or dask array of bruker hypermap, with (y,x,E) shape.
         """
         if index is None:
             index = self.def_index
-        if type(cutoff_at_kV) in (int, float):
-            eds = self.header.get_spectra_metadata(index)
-            cutoff_chan = eds.energy_to_channel(cutoff_at_kV)
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        return self._parse_hypermap_channels(index, downsample=downsample,
+                                             cutoff_chan=cutoff_chan,
+                                             lazy=lazy, region=region,
+                                             workers=workers,
+                                             chan_low=chan_low,
+                                             energy_bin=energy_bin,
+                                             progress=progress)
+
+    def _parse_hypermap_channels(self, index, downsample=1, cutoff_chan=None,
+                                 lazy=False, region=None, workers=None,
+                                 chan_low=0, energy_bin=1, progress=None):
+        """parse_hypermap with energy range given in channels"""
+        if lazy and progress is not None:
+            raise ValueError('progress of lazy hypermap is reported '
+                             'by dask, when it is computed')
+        if not lazy and workers is not None and workers > 1:
+            return self.parallel_parse_hypermap(index=index,
+                                                downsample=downsample,
+                                                cutoff_chan=cutoff_chan,
+                                                region=region,
+                                                workers=workers,
+                                                chan_low=chan_low,
+                                                energy_bin=energy_bin,
+                                                progress=progress)
+
+        if lazy:
+            return self.lazy_parse_hypermap(index=index,
+                                            downsample=downsample,
+                                            cutoff_chan=cutoff_chan,
+                                            region=region,
+                                            chan_low=chan_low,
+                                            energy_bin=energy_bin)
+        kwargs = {}
+        if progress is not None:
+            kwargs['progress'] = progress
+        if region is not None or chan_low > 0 or energy_bin > 1 or\
+                progress is not None:
+            backend = unbcf_numpy
+            kwargs['region'] = region
+            kwargs['spectrum_index'] = self.get_spectrum_index(index,
+                                                               build=False)
+            kwargs['chan_low'] = chan_low
+            kwargs['energy_bin'] = energy_bin
+        elif fast_unbcf:
+            backend = unbcf_fast
         else:
-            cutoff_chan = None
+            backend = unbcf_numpy
+        fh = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        return backend.parse_to_numpy(fh,
+                                      downsample=downsample,
+                                      cutoff=cutoff_chan,
+                                      description=False,
+                                      index=index,
+                                      **kwargs)
+
+    def lazy_parse_hypermap(self, index=None, downsample=1, cutoff_chan=None,
+                            region=None, chunk_bytes=None, chan_low=0,
+                            energy_bin=1):
+        """Return the hypermap as dask array chunked by bands of lines.
+
+        Every chunk decodes only its own lines (with python/numpy
+        backend) starting at the offset from spectrum index (see
+        get_spectrum_index), so computing a slice or reduction of array
+        reads and decodes only the required part of hypermap, and chunks
+        can be computed in parallel. If the index is not cached, it is
+        not built when the array is created: the offset of every band is
+        found while computing, by walking the line headers of the
+        previous band (once for the graph). Tasks get only the filename
+        of the container, so the graph is cheap to pickle for process
+        or distributed schedulers.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        downsample -- downsampling factor (integer) (default 1)
+        cutoff_chan -- channel to truncate the array at (default None)
+        region -- (y0, y1, x0, x1) rectangle of hypermap (default None)
+        chunk_bytes -- approximate size of the chunk in bytes
+            (default None -- dask 'array.chunk-size' configuration)
+        chan_low -- channels below are dropped (default 0)
+        energy_bin -- number of adjacent channels summed together
+            (default 1)
 
-        if fast_unbcf:
-            fh = dd(self.get_file)('EDSDatabase/SpectrumData' + str(index))  # noqa
-            value = dd(unbcf_fast.parse_to_numpy)(fh,                        # noqa
+        Returns:
+        dask array of bruker hypermap, with (y,x,E) shape.
+        """
+        if index is None:
+            index = self.def_index
+        path = 'EDSDatabase/SpectrumData' + str(index)
+        decoder, dtype = unbcf_numpy.make_decoder(self.get_file(path),
                                                   downsample=downsample,
                                                   cutoff=cutoff_chan,
-                                                  description=False,
-                                                  index=index)
-            if lazy:
-                shape, dtype = unbcf_fast.parse_to_numpy(fh.compute(),
-                                                         downsample=downsample,
-                                                         cutoff=cutoff_chan,
-                                                         description=True,
-                                                         index=index)
-                res = da.from_delayed(value, shape=shape, dtype=dtype)
-            else:
-                res = value.compute()
-            return res
+                                                  index=index,
+                                                  region=region,
+                                                  chan_low=chan_low,
+                                                  energy_bin=energy_bin)
+        sp_index = self.get_spectrum_index(index, build=False)
+        if chunk_bytes is None:
+            chunk_bytes = parse_bytes(dask.config.get('array.chunk-size'))
+        line_bytes = decoder.shape[1] * decoder.shape[2] * dtype.itemsize
+        chunk_lines = max(1, chunk_bytes // line_bytes)
+        index_cache = self.index_cache is not None
+        chunks = []
+        line_offset = None
+        for band, out_first in decoder.split(-(-decoder.shape[0] //
+                                               chunk_lines)):
+            if sp_index is not None:
+                line_offset = unbcf_numpy.region_line_offset(
+                    sp_index, band.region[0])
+            value = dd(_decode_band)(self.filename, path, index_cache, band,
+                                     dtype, line_offset)
+            chunks.append(da.from_delayed(value, shape=band.shape,
+                                          dtype=dtype))
+            if sp_index is None:
+                line_offset = dd(_band_end_offset)(self.filename, path,
+                                                   index_cache, band,
+                                                   line_offset)
+        return da.concatenate(chunks, axis=0)
+
+    def iter_hypermap_lines(self, index=None, downsample=1,
+                            cutoff_at_kV=None, region=None, energy_bin=1,
+                            low_cutoff_at_kV=None, progress=None):
+        """Generate the lines of hypermap as they are decoded, without
+        building the whole array.
+
+        Lines are decoded (with python/numpy backend) by the same kernels
+        and into the same dtype as parse_hypermap; with downsampling
+        every yielded line is summed up from downsample lines.
+        The yielded array is the buffer which is overwritten by the next
+        line, thus it has to be copied if it is kept.
+
+        Peak memory is bounded by the decoded band of lines (int64
+        array of at most unbcf_numpy.BAND_ELEMENTS elements, i.e. 8 MiB,
+        or of single downsampled line if it is larger), the decoding
+        temporaries of at most unbcf_numpy.BAND_PIXELS pixels and
+        the line buffer, independently from the height of hypermap.
+
+        Arguments are same as for parse_hypermap.
+
+        Yields:
+        (line number of the output array, array of (width, E) shape)
+        """
+        if index is None:
+            index = self.def_index
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        decoder, dtype = unbcf_numpy.make_decoder(spectrum_file,
+                                                  downsample=downsample,
+                                                  cutoff=cutoff_chan,
+                                                  index=index, region=region,
+                                                  chan_low=chan_low,
+                                                  energy_bin=energy_bin)
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        return decoder.iter_lines(dtype=dtype,
+                                  **decoder.open_region(spectrum_file,
+                                                        line_offset,
+                                                        progress))
+
+    def parse_sparse_hypermap(self, index=None, downsample=1,
+                              cutoff_at_kV=None, region=None, energy_bin=1,
+                              low_cutoff_at_kV=None):
+        """Decode the hypermap into the sparse container.
+
+        The dense array is never built as a whole: every decoded band
+        of lines (with python/numpy backend) is converted to non-zero
+        channels and counts of its pixels.
+
+        Arguments are same as for parse_hypermap.
+
+        Returns:
+        unbcf_numpy.SparseHypermap instance
+        """
+        if index is None:
+            index = self.def_index
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        decoder = unbcf_numpy.make_decoder(spectrum_file,
+                                           downsample=downsample,
+                                           cutoff=cutoff_chan, index=index,
+                                           region=region, chan_low=chan_low,
+                                           energy_bin=energy_bin)[0]
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        return unbcf_numpy.SparseHypermap.from_bands(
+            decoder.shape,
+            decoder.iter_bands(**decoder.open_region(spectrum_file,
+                                                     line_offset)))
+
+    def parse_compact_hypermap(self, index=None, downsample=1,
+                               cutoff_at_kV=None, region=None, energy_bin=1,
+                               low_cutoff_at_kV=None, dtype=np.uint8):
+        """Decode the hypermap into the compact storage with exact counts.
+
+        Differently than parse_hypermap, the dtype is not estimated
+        from the sum spectrum: counts are stored in the smallest dtype
+        (starting from given dtype) which fits most of the elements,
+        and rare larger values are kept in the overflow table.
+
+        Arguments are same as for parse_hypermap, and:
+        dtype -- the smallest dtype to be tried (default numpy.uint8)
+
+        Returns:
+        unbcf_numpy.CompactHypermap instance
+        """
+        if index is None:
+            index = self.def_index
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        decoder = unbcf_numpy.make_decoder(spectrum_file,
+                                           downsample=downsample,
+                                           cutoff=cutoff_chan, index=index,
+                                           region=region, chan_low=chan_low,
+                                           energy_bin=energy_bin)[0]
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        return unbcf_numpy.CompactHypermap.from_bands(
+            decoder.shape,
+            decoder.iter_bands(**decoder.open_region(spectrum_file,
+                                                     line_offset)),
+            dtype=dtype)
+
+    def get_element_maps(self, index=None, windows=None, downsample=1,
+                         region=None, dtype=np.uint32):
+        """Return the maps of counts in the energy windows.
+
+        Counts are summed up into the windows of every pixel while
+        decoding the hypermap (with python/numpy backend) band by band,
+        the (y, x, E) cube is never built, thus memory use is
+        proportional to the map area.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        windows -- list of (low, high) energy windows in keV, or None
+            for the element regions (energy -/+ width/2) from
+            self.header.elements (default None)
+        downsample -- downsampling factor (integer) (default 1)
+        region -- (y0, y1, x0, x1) rectangle of hypermap (default None)
+        dtype -- dtype of the returned maps (default numpy.uint32)
+
+        Returns:
+        (labels, maps) -- list of window labels (element names for the
+        default windows) and numpy array of (n_windows, y, x) shape
+        """
+        if index is None:
+            index = self.def_index
+        eds = self.header.get_spectra_metadata(index)
+        if windows is None:
+            labels = sorted(self.header.elements)
+            windows = []
+            for name in labels:
+                element = self.header.elements[name]
+                windows.append((element['energy'] - element['width'] / 2,
+                                element['energy'] + element['width'] / 2))
         else:
-            value = dd(self.py_parse_hypermap)(index=index,
-                                               downsample=downsample,
-                                               cutoff_at_channel=cutoff_chan,
-                                               description=False)
-            if lazy:
-                shape, dtype = self.py_parse_hypermap(
-                    index=index, downsample=downsample,
-                    cutoff_at_channel=cutoff_chan, description=True)
-                res = da.from_delayed(value, shape=shape, dtype=dtype)
+            labels = ['{0:g}-{1:g} keV'.format(*w) for w in windows]
+        if len(windows) == 0:
+            raise ValueError('no energy windows given and no element '
+                             'regions are present in the header')
+        chan_windows = []
+        for low, high in windows:
+            first = max(0, eds.energy_to_channel(low))
+            chan_windows.append((first,
+                                 max(first, eds.energy_to_channel(high) + 1)))
+        path = 'EDSDatabase/SpectrumData' + str(index)
+        spectrum_file = self.get_file(path)
+        # channels above the highest window are not decoded at all:
+        decoder = unbcf_numpy.make_decoder(
+            spectrum_file, downsample=downsample,
+            cutoff=max(last for first, last in chan_windows),
+            index=index, region=region)[0]
+        maps = np.zeros((len(chan_windows),) + decoder.shape[:2], dtype=dtype)
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        decoder.window_maps_into(windows=chan_windows, out=maps,
+                                 **decoder.open_region(spectrum_file,
+                                                       line_offset))
+        return labels, maps
+
+    def get_hypermap_statistics(self, index=None, downsample=1, region=None,
+                                cutoff_at_kV=None, low_cutoff_at_kV=None):
+        """Compute quick-look statistics of the hypermap in single
+        streaming pass (with python/numpy backend), without keeping
+        the cube in memory.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        downsample -- downsampling factor (integer) (default 1)
+        region -- (y0, y1, x0, x1) rectangle of hypermap (default None)
+        cutoff_at_kV -- value in keV to truncate the spectra at (default
+            None -- all channels of the sum spectrum in the header)
+        low_cutoff_at_kV -- value in keV, the channels below are dropped
+            (default None)
+
+        Returns:
+        HyperMapStatistics instance
+        """
+        if index is None:
+            index = self.def_index
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        if cutoff_chan is None:
+            cutoff_chan = self.header.spectra_data[index].data.shape[0]
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        decoder = unbcf_numpy.make_decoder(spectrum_file,
+                                           downsample=downsample,
+                                           cutoff=cutoff_chan,
+                                           index=index, region=region,
+                                           chan_low=chan_low)[0]
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        stats = decoder.statistics(**decoder.open_region(spectrum_file,
+                                                         line_offset))
+        if decoder.region == (0, decoder.height, 0, decoder.width):
+            header_spectrum = self.header.spectra_data[index].data
+        else:
+            header_spectrum = None
+        return HyperMapStatistics(stats, self, index=index,
+                                  downsample=downsample, region=region,
+                                  chan_low=chan_low,
+                                  header_spectrum=header_spectrum)
+
+    def get_hypermap_pca(self, index=None, n_components=10, downsample=1,
+                         region=None, cutoff_at_kV=None, energy_bin=1,
+                         low_cutoff_at_kV=None, poisson=True, scores=True,
+                         progress=None):
+        """Principal component analysis of the hypermap streamed from
+        the bcf (with python/numpy backend), without decoding the cube
+        into memory.
+
+        The mean spectrum and the channel by channel covariance are
+        accumulated in the first pass over the bands of lines (see
+        unbcf_numpy.CovarianceAccumulator), the scores of pixels are
+        computed in the second pass. Memory use is of the order of
+        channels ** 2 + pixels * n_components, energy binning and
+        cutoffs reduce the channels.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        n_components -- number of components to keep (default 10)
+        downsample, region, cutoff_at_kV, energy_bin, low_cutoff_at_kV
+            -- same as for parse_hypermap
+        poisson -- scale the spectra for Poisson noise before the
+            analysis (default True)
+        scores -- compute the scores of pixels (second pass)
+            (default True)
+        progress -- unbcf_numpy.Progress instance, started for the
+            lines of both passes (default None)
+
+        Returns:
+        HyperMapPCA instance
+        """
+        if index is None:
+            index = self.def_index
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        decoder = unbcf_numpy.make_decoder(spectrum_file,
+                                           downsample=downsample,
+                                           cutoff=cutoff_chan,
+                                           index=index, region=region,
+                                           chan_low=chan_low,
+                                           energy_bin=energy_bin)[0]
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        if progress is not None:
+            # both passes are counted into single token:
+            n_passes = 2 if scores else 1
+            progress.start((decoder.region[1] - decoder.region[0]) * n_passes)
+        accumulator = unbcf_numpy.CovarianceAccumulator(decoder.shape[2],
+                                                        poisson=poisson)
+        try:
+            for out_first, band in decoder.iter_bands(
+                    **decoder.open_region(spectrum_file, line_offset,
+                                          progress)):
+                accumulator.add(band)
+            variance, components = accumulator.decompose(n_components)
+            pixel_scores = None
+            if scores:
+                pixel_scores = np.empty(decoder.shape[:2] + (len(variance),),
+                                        dtype=np.float64)
+                for out_first, band in decoder.iter_bands(
+                        **decoder.open_region(spectrum_file, line_offset,
+                                              progress)):
+                    pixel_scores[out_first:out_first + band.shape[0]] =\
+                        accumulator.transform(band, components)
+        finally:
+            if progress is not None:
+                progress.finish()
+        return HyperMapPCA(accumulator, variance, components, pixel_scores,
+                           self, index=index, downsample=downsample,
+                           region=region, energy_bin=energy_bin,
+                           chan_low=chan_low)
+
+    def parallel_parse_hypermap(self, index=None, downsample=1,
+                                cutoff_chan=None, region=None, workers=2,
+                                chan_low=0, energy_bin=1, progress=None):
+        """Decode the hypermap with the pool of processes.
+
+        The hypermap (or its region) is split into bands of lines, using
+        the spectrum index (see get_spectrum_index), which is built if
+        not available. Bands are aligned to the downsampling factor, so
+        every downsampled line is summed up by single process. Every
+        band is decoded by python/numpy backend in separate process
+        directly into the array in shared memory. With memory backed
+        files (/dev/shm) that array is returned without copy (if the
+        array does not fit into the free space of /dev/shm, the file is
+        created in the temporary directory instead), else (i.e. on
+        Windows) it is copied to the returned array at the end, which
+        takes twice the memory of the array at peak. The index of
+        compressed blocks is built once and passed to the processes.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        downsample -- downsampling factor (integer) (default 1)
+        cutoff_chan -- channel to truncate the array at (default None)
+        region -- (y0, y1, x0, x1) rectangle of hypermap (default None)
+        workers -- number of processes (default 2)
+        chan_low -- channels below are dropped (default 0)
+        energy_bin -- number of adjacent channels summed together
+            (default 1)
+        progress -- unbcf_numpy.Progress instance, updated after every
+            decoded band; bands not started yet are dropped if it is
+            cancelled (default None)
+
+        Returns:
+        numpy array of bruker hypermap, with (y,x,E) shape.
+        """
+        if index is None:
+            index = self.def_index
+        path = 'EDSDatabase/SpectrumData' + str(index)
+        decoder, dtype = unbcf_numpy.make_decoder(self.get_file(path),
+                                                  downsample=downsample,
+                                                  cutoff=cutoff_chan,
+                                                  index=index,
+                                                  region=region,
+                                                  chan_low=chan_low,
+                                                  energy_bin=energy_bin)
+        sp_index = self.get_spectrum_index(index)
+        block_index = _compr_block_index(self.get_file(path))
+        # more bands than workers balances the uneven bands:
+        bands = decoder.split(workers * 4)
+        shared = _SharedArray(decoder.shape, dtype)
+        if progress is not None:
+            progress.start(decoder.region[1] - decoder.region[0])
+        cancelled = None
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {}
+                for band, out_first in bands:
+                    y0, y1 = band.region[:2]
+                    line_offset = int(sp_index.lines[y0])
+                    futures[pool.submit(
+                        _decode_band_to_shared, self.filename, path,
+                        self.index_cache is not None, band, line_offset,
+                        shared.handle, out_first, block_index)] =\
+                        (y1 - y0, int(sp_index.lines[y1]) - line_offset)
+                for future in as_completed(futures):
+                    future.result()
+                    if progress is None:
+                        continue
+                    n_lines, n_bytes = futures[future]
+                    progress.bytes_read += n_bytes
+                    try:
+                        progress.update(n_lines)
+                    except unbcf_numpy.DecodingCancelled as error:
+                        cancelled = error
+                        # running bands are finished at pool exit:
+                        for pending in futures:
+                            pending.cancel()
+                        break
+            hypermap = shared.result()
+        finally:
+            shared.release()
+            if progress is not None:
+                progress.finish()
+        if cancelled is not None:
+            if progress.keep_partial:
+                cancelled.partial = hypermap
+            raise cancelled
+        return hypermap
+
+    def memmap_parse_hypermap(self, index=None, downsample=1,
+                              cutoff_chan=None, region=None, chan_low=0,
+                              energy_bin=1, filename=None, progress=None,
+                              directory=None):
+        """Decode the hypermap (with python/numpy backend) into the
+        memory mapped .npy file, so only the band of lines being
+        decoded has to fit into memory.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        downsample -- downsampling factor (integer) (default 1)
+        cutoff_chan -- channel to truncate the array at (default None)
+        region -- (y0, y1, x0, x1) rectangle of hypermap (default None)
+        chan_low -- channels below are dropped (default 0)
+        energy_bin -- number of adjacent channels summed together
+            (default 1)
+        filename -- path of .npy file to be written, which is owned
+            by the caller (default None -- new temporary file, owned by
+            the returned array: it is deleted when the array (and all
+            views of it) is released, or if that fails (Windows can't
+            delete mapped file), when the reader is closed; its path is
+            in filename attribute of returned array)
+        progress -- unbcf_numpy.Progress instance (default None)
+        directory -- directory of the temporary file (default None --
+            the system temporary directory)
+
+        Returns:
+        numpy.memmap of bruker hypermap, with (y,x,E) shape.
+        """
+        if index is None:
+            index = self.def_index
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        decoder, dtype = unbcf_numpy.make_decoder(spectrum_file,
+                                                  downsample=downsample,
+                                                  cutoff=cutoff_chan,
+                                                  index=index, region=region,
+                                                  chan_low=chan_low,
+                                                  energy_bin=energy_bin)
+        temporary = filename is None
+        if temporary:
+            handle, filename = tempfile.mkstemp(suffix='.npy', dir=directory)
+            os.close(handle)
+        try:
+            hypermap = np.lib.format.open_memmap(filename, mode='w+',
+                                                 dtype=dtype,
+                                                 shape=decoder.shape)
+        except BaseException:
+            if temporary:
+                os.remove(filename)
+            raise
+        if temporary:
+            weakref.finalize(hypermap, _remove_temporary, filename,
+                             self._temporary_files)
+        line_offset = unbcf_numpy.region_line_offset(
+            self.get_spectrum_index(index, build=False), decoder.region[0])
+        try:
+            decoder.decode_file(spectrum_file, hypermap,
+                                line_offset=line_offset, progress=progress)
+        finally:
+            hypermap.flush()
+        return hypermap
+
+    def plan_hypermap(self, index=None, memory_budget=None, downsample=1,
+                      cutoff_at_kV=None, region=None, energy_bin=1,
+                      low_cutoff_at_kV=None, workers=None,
+                      strategies=('trim', 'lazy', 'memmap', 'energy_bin',
+                                  'downsample'),
+                      max_energy_bin=4, max_downsample=8, memmap_dir=None):
+        """Choose how the hypermap should be loaded to fit in memory budget.
+
+        If the array with given parameters fits into the budget, it is
+        loaded as it is, else the strategies are tried in given order
+        (the cheapest first) until the plan fits:
+        'trim' -- drop the channels at both ends of energy axis, where
+            sum spectrum in the header is zero (lossless),
+        'lazy' -- return dask array chunked by the bands of lines, which
+            fit into the budget (lossless, but decoding is deferred),
+        'memmap' -- decode into .npy file in memmap_dir memory mapped
+            on disk (lossless, if disk has the space),
+        'energy_bin' -- sum 2, 3 ... up to max_energy_bin adjacent
+            channels (lossy),
+        'downsample' -- downsample the map with increasing factor, up
+            to max_downsample (lossy).
+        The lossless steps taken (trimming) are kept for the later
+        strategies.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        memory_budget -- bytes (int) or string as '2GB' (default None --
+            90% of available memory, which requires psutil)
+        downsample, cutoff_at_kV, region, energy_bin, low_cutoff_at_kV
+            -- starting parameters, same as for parse_hypermap
+        workers -- number of processes or threads which will decode
+            the hypermap at once (default None -- 1 for in memory and
+            memmap loading, number of dask threads for lazy loading)
+        strategies -- sequence of strategies which are allowed
+            (default all, in order above)
+        max_energy_bin -- the largest energy binning allowed (default 4)
+        max_downsample -- the largest downsampling allowed (default 8)
+        memmap_dir -- directory for memmap files (default None --
+            the system temporary directory)
+
+        Returns:
+        HyperMapPlan instance (which can be passed to load_hypermap)
+
+        Raises MemoryError if no plan fits into the budget.
+        """
+        if index is None:
+            index = self.def_index
+        if memory_budget is None:
+            if psutil is None:
+                raise ValueError('memory_budget has to be given, as psutil '
+                                 'is not available to query free memory')
+            memory_budget = int(psutil.virtual_memory().available * 0.9)
+        elif isinstance(memory_budget, str):
+            memory_budget = parse_bytes(memory_budget)
+        if memmap_dir is None:
+            memmap_dir = tempfile.gettempdir()
+        cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                     low_cutoff_at_kV)
+        spectrum_file = self.get_file('EDSDatabase/SpectrumData' + str(index))
+        parallel = workers is not None and workers > 1
+        steps = []
+        plan = dict(index=index, region=region, downsample=downsample,
+                    cutoff_chan=cutoff_chan, chan_low=chan_low,
+                    energy_bin=energy_bin, memory_budget=memory_budget)
+
+        def describe(**changes):
+            plan.update(changes)
+            decoder, dtype = unbcf_numpy.make_decoder(
+                spectrum_file, downsample=plan['downsample'],
+                cutoff=plan['cutoff_chan'], index=index, region=region,
+                chan_low=plan['chan_low'], energy_bin=plan['energy_bin'])
+            plan['shape'], plan['dtype'] = decoder.shape, dtype
+            plan['nbytes'] = int(np.prod(decoder.shape)) * dtype.itemsize
+            # working arrays of decoding the band of lines:
+            plan['overhead'] = decoder.band_working_bytes()
+            return decoder
+
+        def needed(**changes):
+            """memory needed to decode the array in memory"""
+            describe(**changes)
+            if not parallel:
+                return plan['nbytes'] + plan['overhead']
+            total = plan['nbytes'] + plan['overhead'] * workers
+            if _shared_array_dir(plan['nbytes']) is None:
+                # shared memory of processes is copied to the result:
+                total += plan['nbytes']
+            return total
+
+        total = needed()
+        if total <= memory_budget:
+            steps.append('the array fits into the budget as it is (needs '
+                         '{0} with decoder working memory)'.format(
+                             format_bytes(total)))
+            return HyperMapPlan(mode='memory', steps=steps, **plan)
+        steps.append('the array {0} of {1} would take {2} of memory, {3} '
+                     'with decoder working memory'.format(
+                         plan['shape'], plan['dtype'].name,
+                         format_bytes(plan['nbytes']), format_bytes(total)))
+        for strategy in strategies:
+            if strategy == 'trim':
+                eds = self.header.spectra_data[index]
+                n_chan = plan['cutoff_chan'] or \
+                    self.header.estimate_map_channels(index=index)
+                nonzero = np.flatnonzero(eds.data[:n_chan])
+                if len(nonzero) == 0:
+                    continue
+                low = max(plan['chan_low'], int(nonzero[0]))
+                high = min(n_chan, int(nonzero[-1]) + 1)
+                if (low, high) == (plan['chan_low'], n_chan):
+                    continue
+                total = needed(chan_low=low, cutoff_chan=high)
+                steps.append('trimmed energy axis to channels {0}:{1}, '
+                             'where the sum spectrum is non zero (needs '
+                             '{2})'.format(low, high, format_bytes(total)))
+                if total <= memory_budget:
+                    return HyperMapPlan(mode='memory', steps=steps, **plan)
+            elif strategy == 'lazy':
+                decoder = describe()
+                threads = workers or dask.system.CPU_COUNT
+                line_bytes = plan['nbytes'] // plan['shape'][0]
+                per_thread = memory_budget // threads
+                # every thread keeps the chunk and the working memory
+                # of its decoding:
+                chunk_bytes = min(
+                    parse_bytes(dask.config.get('array.chunk-size')),
+                    per_thread - plan['overhead'])
+                line_work = decoder.band_working_bytes(
+                    lines=plan['downsample'])
+                if chunk_bytes < line_bytes and \
+                        line_bytes + line_work <= per_thread:
+                    # chunks of single line have smaller bands:
+                    chunk_bytes = line_bytes
+                    plan['overhead'] = line_work
+                if chunk_bytes < line_bytes:
+                    steps.append('lazy loading: the line ({0}) with decoder '
+                                 'working memory ({1}) would not fit into {2} '
+                                 'of every of {3} threads'.format(
+                                     format_bytes(line_bytes),
+                                     format_bytes(line_work),
+                                     format_bytes(per_thread), threads))
+                    continue
+                steps.append('lazy loading in chunks of {0} lines '
+                             '({1} threads)'.format(chunk_bytes // line_bytes,
+                                                    threads))
+                return HyperMapPlan(mode='lazy', steps=steps,
+                                    chunk_bytes=chunk_bytes, **plan)
+            elif strategy == 'memmap':
+                describe()
+                if plan['overhead'] > memory_budget:
+                    steps.append('memmap: decoder working memory ({0}) '
+                                 'does not fit into the budget'.format(
+                                     format_bytes(plan['overhead'])))
+                    continue
+                free = shutil.disk_usage(memmap_dir).free
+                if plan['nbytes'] > free:
+                    steps.append('memmap: not enough space in {0} ({1} '
+                                 'free, {2} needed)'.format(
+                                     memmap_dir, format_bytes(free),
+                                     format_bytes(plan['nbytes'])))
+                    continue
+                steps.append('decoding into memory mapped file in '
+                             '{0}'.format(memmap_dir))
+                return HyperMapPlan(mode='memmap', steps=steps,
+                                    memmap_dir=memmap_dir, **plan)
+            elif strategy == 'energy_bin':
+                if plan['energy_bin'] >= max_energy_bin:
+                    continue
+                for e_bin in range(plan['energy_bin'] + 1,
+                                   max_energy_bin + 1):
+                    total = needed(energy_bin=e_bin)
+                    if total <= memory_budget:
+                        steps.append('summed {0} adjacent channels (needs '
+                                     '{1})'.format(e_bin,
+                                                   format_bytes(total)))
+                        return HyperMapPlan(mode='memory', steps=steps,
+                                            **plan)
+                steps.append('summed {0} adjacent channels: still needs '
+                             '{1}'.format(max_energy_bin,
+                                          format_bytes(total)))
+            elif strategy == 'downsample':
+                if plan['downsample'] >= max_downsample:
+                    continue
+                for dwn in range(plan['downsample'] + 1, max_downsample + 1):
+                    total = needed(downsample=dwn)
+                    if total <= memory_budget:
+                        steps.append('downsampled by {0} (needs {1})'.format(
+                            dwn, format_bytes(total)))
+                        return HyperMapPlan(mode='memory', steps=steps,
+                                            **plan)
+                steps.append('downsampled by {0}: still needs {1}'.format(
+                    max_downsample, format_bytes(total)))
             else:
-                res = value.compute()
-            return res
+                raise ValueError('unknown strategy: {0}'.format(strategy))
+        raise MemoryError('hypermap can not be loaded within the budget of '
+                          '{0}:\n  {1}'.format(format_bytes(memory_budget),
+                                               '\n  '.join(steps)))
+
+    def load_hypermap(self, index=None, plan=None, memory_budget=None,
+                      workers=None, progress=None, **kwargs):
+        """Plan (see plan_hypermap) and load the hypermap within the
+        memory budget, and assign it to the HyperMap instance.
+
+        Arguments:
+        index -- the index of hypermap in bcf (default 0)
+        plan -- HyperMapPlan to be used (default None -- planned with
+            memory_budget, workers and other keyword arguments passed
+            to plan_hypermap)
+        memory_budget -- see plan_hypermap (default None)
+        workers -- number of processes to decode the hypermap in memory
+            (default None)
+        progress -- unbcf_numpy.Progress instance, used if the plan
+            is not lazy (default None)
+
+        Returns:
+        the used HyperMapPlan; the HyperMap instance (with the plan
+        as plan attribute) is added to self.hypermap dictionary.
+        """
+        if plan is None:
+            plan = self.plan_hypermap(index=index,
+                                      memory_budget=memory_budget,
+                                      workers=workers, **kwargs)
+        _logger.info(plan.report())
+        channels = dict(downsample=plan.downsample,
+                        cutoff_chan=plan.cutoff_chan,
+                        region=plan.region,
+                        chan_low=plan.chan_low,
+                        energy_bin=plan.energy_bin)
+        if plan.mode == 'lazy':
+            hypermap = self.lazy_parse_hypermap(index=plan.index,
+                                                chunk_bytes=plan.chunk_bytes,
+                                                **channels)
+        elif plan.mode == 'memmap':
+            hypermap = self.memmap_parse_hypermap(index=plan.index,
+                                                  directory=plan.memmap_dir,
+                                                  progress=progress,
+                                                  **channels)
+            plan.filename = hypermap.filename
+        else:
+            hypermap = self._parse_hypermap_channels(plan.index,
+                                                     workers=workers,
+                                                     progress=progress,
+                                                     **channels)
+        self.hypermap[plan.index] = HyperMap(hypermap, self,
+                                             index=plan.index,
+                                             downsample=plan.downsample,
+                                             region=plan.region,
+                                             energy_bin=plan.energy_bin,
+                                             chan_low=plan.chan_low)
+        self.hypermap[plan.index].plan = plan
+        return plan
+
+    def parse_hypermaps(self, indexes=None, downsample=1, cutoff_at_kV=None,
+                        region=None, energy_bin=1, low_cutoff_at_kV=None,
+                        workers=None, memory_budget=None, processes=False):
+        """Decode several hypermaps of bcf v2 stack concurrently.
+
+        Hypermaps are decoded by the pool of threads sharing this reader
+        (its memory mapping, block and spectrum indexes), or if processes
+        is True, by the pool of processes (python/numpy backend) into
+        shared memory. Hypermaps are started only while the memory of all
+        returned arrays and of those being decoded fits into the budget.
+
+        Arguments:
+        indexes -- list of hypermap indexes (default None -- all
+            available indexes)
+        downsample, cutoff_at_kV, region, energy_bin, low_cutoff_at_kV
+            -- same as for parse_hypermap, applied to every hypermap
+        workers -- number of hypermaps decoded at once (default None --
+            number of cpu, but not more than hypermaps)
+        memory_budget -- bytes (int) or string as '2GB' (default None --
+            90% of available memory if psutil is present, else no limit)
+        processes -- decode in processes instead of threads
+            (default False)
+
+        Returns:
+        list of numpy arrays in order of indexes.
+
+        Raises MemoryError if the arrays do not fit into the budget
+        (see load_hypermap for the lazy or memory mapped loading).
+        """
+        if indexes is None:
+            indexes = self.available_indexes
+        jobs = []
+        for index in indexes:
+            cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                         low_cutoff_at_kV)
+            jobs.append((index, dict(downsample=downsample,
+                                     cutoff_chan=cutoff_chan, region=region,
+                                     chan_low=chan_low,
+                                     energy_bin=energy_bin)))
+        return self._parse_hypermaps_channels(jobs, workers=workers,
+                                              memory_budget=memory_budget,
+                                              processes=processes)
+
+    def persistent_parse_hypermaps(self, indexes=None, downsample=None,
+                                   cutoff_at_kV=None, region=None,
+                                   energy_bin=1, low_cutoff_at_kV=None,
+                                   workers=None, memory_budget=None,
+                                   processes=False):
+        """Decode several hypermaps concurrently (see parse_hypermaps)
+        and assign them to the HyperMap instances in self.hypermap
+        dictionary. Hypermaps present in the hypermap cache (if enabled)
+        are not decoded, and decoded ones are stored there.
+
+        See also:
+        persistent_parse_hypermap, parse_hypermaps
+        """
+        if indexes is None:
+            indexes = self.available_indexes
+        dwn = 1 if downsample is None else downsample
+        hypermaps = {}
+        jobs = []
+        cache_files = {}
+        for index in indexes:
+            cutoff_chan, chan_low = self._energy_cutoffs(index, cutoff_at_kV,
+                                                         low_cutoff_at_kV)
+            params = dict(downsample=dwn, cutoff_chan=cutoff_chan,
+                          region=region, chan_low=chan_low,
+                          energy_bin=energy_bin)
+            if self.hypermap_cache is not None:
+                cache_files[index] = self.hypermap_cache.filename(
+                    self, index=index, **params)
+                hypermap = self.hypermap_cache.load(cache_files[index])
+                if hypermap is not None:
+                    hypermaps[index] = (hypermap, chan_low)
+                    continue
+            jobs.append((index, params))
+        decoded = self._parse_hypermaps_channels(jobs, workers=workers,
+                                                 memory_budget=memory_budget,
+                                                 processes=processes)
+        for (index, params), hypermap in zip(jobs, decoded):
+            if self.hypermap_cache is not None:
+                self.hypermap_cache.store(cache_files[index], hypermap)
+            hypermaps[index] = (hypermap, params['chan_low'])
+        for index in indexes:
+            hypermap, chan_low = hypermaps[index]
+            self.hypermap[index] = HyperMap(hypermap, self, index=index,
+                                            downsample=dwn, region=region,
+                                            energy_bin=energy_bin,
+                                            chan_low=chan_low)
+
+    def _parse_hypermaps_channels(self, jobs, workers=None,
+                                  memory_budget=None, processes=False):
+        """decode list of (index, parameters of _parse_hypermap_channels)
+        jobs concurrently within memory budget, return list of arrays"""
+        if len(jobs) == 0:
+            return []
+        if memory_budget is None and psutil is not None:
+            memory_budget = int(psutil.virtual_memory().available * 0.9)
+        elif isinstance(memory_budget, str):
+            memory_budget = parse_bytes(memory_budget)
+        if workers is None:
+            workers = dask.system.CPU_COUNT
+        workers = max(1, min(workers, len(jobs)))
+        decoders = []
+        for index, params in jobs:
+            path = 'EDSDatabase/SpectrumData' + str(index)
+            decoder, dtype = unbcf_numpy.make_decoder(
+                self.get_file(path), downsample=params['downsample'],
+                cutoff=params['cutoff_chan'], index=index,
+                region=params['region'], chan_low=params['chan_low'],
+                energy_bin=params['energy_bin'])
+            decoders.append((path, decoder, dtype))
+        sizes = [int(np.prod(d.shape)) * dtype.itemsize
+                 for path, d, dtype in decoders]
+        # processes decode into shared memory, copied to the result
+        # if it is not mapped file (see _shared_array_dir):
+        copied = [processes and _shared_array_dir(size) is None
+                  for size in sizes]
+        # working arrays of decoder (bands of pulses and keys):
+        extra = [d.band_working_bytes() + (size if copy else 0)
+                 for (path, d, dtype), size, copy in
+                 zip(decoders, sizes, copied)]
+        total = sum(sizes)
+        if memory_budget is not None and total + max(extra) > memory_budget:
+            raise MemoryError(
+                'hypermaps {0} ({1}) can not be loaded within the budget '
+                'of {2}'.format([index for index, params in jobs],
+                                format_bytes(total),
+                                format_bytes(memory_budget)))
+        results = [None] * len(jobs)
+        shared = {}
+        running = {}
+        in_flight = 0
+        next_job = 0
+        if processes:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while next_job < len(jobs) or running:
+                while next_job < len(jobs) and len(running) < workers and (
+                        not running or memory_budget is None or
+                        total + in_flight + extra[next_job] <= memory_budget):
+                    i = next_job
+                    index, params = jobs[i]
+                    if processes:
+                        path, decoder, dtype = decoders[i]
+                        line_offset = unbcf_numpy.region_line_offset(
+                            self.get_spectrum_index(index, build=False),
+                            decoder.region[0])
+                        shared[i] = _SharedArray(decoder.shape, dtype)
+                        future = pool.submit(
+                            _decode_band_to_shared, self.filename, path,
+                            self.index_cache is not None, decoder,
+                            line_offset, shared[i].handle, 0,
+                            _compr_block_index(self.get_file(path)))
+                    else:
+                        future = pool.submit(self._parse_hypermap_channels,
+                                             index, **params)
+                    running[future] = i
+                    in_flight += extra[i]
+                    next_job += 1
+                done = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    i = running.pop(future)
+                    in_flight -= extra[i]
+                    result = future.result()
+                    if processes:
+                        results[i] = shared.pop(i).result()
+                    else:
+                        results[i] = result
+        finally:
+            for future in running:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for shared_array in shared.values():
+                shared_array.release()
+        return results
 
     def py_parse_hypermap(self, index=None, downsample=1, cutoff_at_channel=None,  # noqa
-                          description=False):
+                          description=False, progress=None):
         """Unpack the Delphi/Bruker binary spectral map and return
         numpy array in memory efficient way using pure python implementation.
         (Slow!)
@@ -981,8 +2983,9 @@ class BCF_reader(SFS_reader):
         logic check out fast cython implementation at
         hyperspy/io_plugins/unbcf_fast.pyx
 
-        The method is only meant to be used if for some
-        reason c (generated with cython) version of the parser is not compiled.
+        The method is kept as the reference implementation, parse_hypermap
+        falls back to vectorized decoder from unbcf_numpy if c (generated
+        with cython) version of the parser is not compiled.
 
         Arguments:
         ---------
@@ -994,11 +2997,23 @@ class BCF_reader(SFS_reader):
             memory requiriments. (default 1)
         cutoff_at_kV -- value in keV to truncate the array at. Helps reducing
           size of array. (default None)
+        progress -- unbcf_numpy.Progress instance, updated after every
+          line (default None)
 
         Returns:
         ---------
         numpy array of bruker hypermap, with (y,x,E) shape.
         """
+        try:
+            return self._py_parse_hypermap(index, downsample,
+                                           cutoff_at_channel, description,
+                                           progress)
+        finally:
+            if progress is not None:
+                progress.finish()
+
+    def _py_parse_hypermap(self, index, downsample, cutoff_at_channel,  # noqa
+                           description, progress):
         if index is None:
             index = self.def_index
         # dict of nibbles to struct notation for reading:
@@ -1022,7 +3037,18 @@ class BCF_reader(SFS_reader):
         vfa = np.zeros(shape[0] * shape[1] * shape[2], dtype=depth)
         offset = 0x1A0
         size = size_chnk
+        if progress is not None:
+            progress.start(height)
+            progress.bytes_read = len(buffer1)
+            iter_data = _count_bytes(iter_data, progress)
         for line_cnt in range(height):
+            if progress is not None and line_cnt > 0:
+                try:
+                    progress.update(1)
+                except unbcf_numpy.DecodingCancelled as cancelled:
+                    if progress.keep_partial:
+                        cancelled.partial = _as_unsigned(vfa.reshape(shape))
+                    raise
             if (offset + 4) >= size:
                 size = size_chnk + size - offset
                 buffer1 = buffer1[offset:] + next(iter_data)
@@ -1147,37 +3173,424 @@ class BCF_reader(SFS_reader):
                 else:
                     vfa[max_chan * pix_idx:chan1 + max_chan * pix_idx] +=\
                         pixel[:chan1]
+        if progress is not None:
+            progress.update(1)
         vfa.resize((-(-height // dwn_factor),
                     -(-width // dwn_factor),
                     max_chan))
-        # check if array is signed, and convert to unsigned
-        if str(vfa.dtype)[0] == 'i':
-            new_dtype = ''.join(['u', str(vfa.dtype)])
-            vfa.dtype = new_dtype
-        return vfa
+        return _as_unsigned(vfa)
 
     def add_filename_to_general(self, item):
         item['metadata']['General']['original_filename'] = \
             self.filename.split('/')[-1]
 
 
-class HyperMap(object):
+def _remove_temporary(filename, leftovers):
+    """delete the temporary file, or keep it in leftovers list if it
+    can't be deleted (yet)"""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        if filename not in leftovers:
+            leftovers.append(filename)
+        _logger.warning('temporary file %s could not be deleted: %s',
+                        filename, error)
+        return
+    if filename in leftovers:
+        leftovers.remove(filename)
+
+
+def _as_unsigned(array):
+    """view the signed array as unsigned"""
+    # check if array is signed, and convert to unsigned
+    if str(array.dtype)[0] == 'i':
+        new_dtype = ''.join(['u', str(array.dtype)])
+        array.dtype = new_dtype
+    return array
+
+
+def _count_bytes(blocks, progress):
+    """pass the data chunks through, counting their size into progress"""
+    for block in blocks:
+        progress.bytes_read += len(block)
+        yield block
+
+
+def _decode_band(filename, path, index_cache, decoder, dtype, line_offset):
+    """decode the band of hypermap into new array
+    (the chunk of BCF_reader.lazy_parse_hypermap)"""
+    sfs = SFS_reader(filename, index_cache=index_cache)
+    try:
+        return decoder.decode_file(sfs.get_file(path),
+                                   np.zeros(decoder.shape, dtype=dtype),
+                                   line_offset=line_offset)
+    finally:
+        sfs.close()
+
+
+def _band_end_offset(filename, path, index_cache, decoder, line_offset):
+    """return the uncompressed offset of the line following the band,
+    walking only the line headers from the band start at line_offset
+    (None -- from the first line of hypermap) (the offsets of chunks
+    of BCF_reader.lazy_parse_hypermap without spectrum index)"""
+    sfs = SFS_reader(filename, index_cache=index_cache)
+    try:
+        region = decoder.open_region(sfs.get_file(path), line_offset)
+        stream = region['stream']
+        pos = decoder.skip_lines(stream, region['pos'],
+                                 decoder.region[1] - region['line'])
+        return stream.base + pos
+    finally:
+        stream = region = None
+        sfs.close()
+
+
+def _free_bytes(directory):
+    """return the bytes available to unprivileged user in the file
+    system of directory (0 if it can not be found out)"""
+    try:
+        stat = os.statvfs(directory)
+    except (AttributeError, OSError):
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def _shared_array_dir(nbytes=0):
+    """return the directory where array of nbytes decoded by processes
+    can be created as file mapped in memory, or None if there is no such.
+
+    Memory backed files (/dev/shm) are preferred; the tmpfs is usually
+    limited to a half of RAM (in containers much less) and writing
+    beyond its free space kills the processes with SIGBUS, thus if it
+    is too small, the file is created in the temporary directory on the
+    disk (paged in and out by the system like memmap_parse_hypermap).
+    The shared memory of python is also kept in /dev/shm on linux, thus
+    it can not be the fallback there.
+    """
+    if os.name != 'posix':
+        return None
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) and \
+            _free_bytes('/dev/shm') >= nbytes:
+        return '/dev/shm'
+    directory = tempfile.gettempdir()
+    if nbytes and _free_bytes(directory) >= nbytes:
+        return directory
+    return None
+
+
+class _SharedArray(object):
+    """Array in memory shared with the decoding processes.
+
+    If the array fits into memory backed files (/dev/shm, else into the
+    temporary directory, see _shared_array_dir), the array is the file
+    mapped in memory, which is removed (while mapped) when the result
+    is taken, thus the returned array owns the memory, which is freed
+    when the array is released, and no copy is made. Else the array is
+    in SharedMemory block, copied to the returned array (twice the
+    memory at peak).
+
+    Arguments:
+    shape, dtype -- of the array
 
-    """Container class to hold the parsed bruker hypermap
-    and its scale calibrations"""
+    Attributes:
+    handle -- picklable description of the array for the processes
+        (see _decode_band_to_shared)
+    copied -- True if the result is copied out of shared memory
+
+    Methods:
+    result, release
+    """
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        directory = _shared_array_dir(size)
+        self._shm = None
+        self._filename = None
+        if directory is not None:
+            if directory != '/dev/shm':
+                _logger.warning('/dev/shm has no space for the array of '
+                                '%s, it is decoded into the file in %s',
+                                format_bytes(size), directory)
+            fd, self._filename = tempfile.mkstemp(prefix='hypermap',
+                                                  dir=directory)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+            self.handle = ('file', self._filename, self.shape,
+                           self.dtype.str)
+        else:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self.handle = ('shm', self._shm.name, self.shape, self.dtype.str)
+
+    @property
+    def copied(self):
+        return self._shm is not None
+
+    def result(self):
+        """return the decoded array and release the shared resources"""
+        if int(np.prod(self.shape)) == 0:
+            self.release()
+            return np.zeros(self.shape, dtype=self.dtype)
+        if self._filename is not None:
+            array = np.asarray(np.memmap(self._filename, dtype=self.dtype,
+                                         mode='r+', shape=self.shape))
+        else:
+            array = np.ndarray(self.shape, dtype=self.dtype,
+                               buffer=self._shm.buf).copy()
+        self.release()
+        return array
+
+    def release(self):
+        """remove the file or the shared memory block (the mapped array
+        returned by result stays valid)"""
+        if self._filename is not None:
+            try:
+                os.remove(self._filename)
+            except OSError:
+                pass
+            self._filename = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def _compr_block_index(item):
+    """return the index of compressed blocks of the sfs internal file
+    (see SFSItem.setup_compr_block_index) to be passed to processes,
+    or None if the file is not compressed"""
+    if item.sfs.compression == 'None':
+        return None
+    item.setup_compr_block_index()
+    return (item.compr_blk_offsets, item.compr_blk_sizes,
+            item.compr_blk_uc_offsets)
+
+
+def _decode_band_to_shared(filename, path, index_cache, decoder, line_offset,
+                           shared, out_first, block_index=None):
+    """decode the band of hypermap into the SharedArray (given by its
+    handle) (the worker of BCF_reader.parallel_parse_hypermap);
+    block_index of the parent (see _compr_block_index) saves every
+    process from walking the compressed blocks"""
+    kind, name, shape, dtype = shared
+    sfs = SFS_reader(filename, index_cache=index_cache)
+    shm = None
+    hypermap = None
+    try:
+        item = sfs.get_file(path)
+        if block_index is not None:
+            item.compr_blk_offsets, item.compr_blk_sizes, \
+                item.compr_blk_uc_offsets = block_index
+        if kind == 'file':
+            hypermap = np.memmap(name, dtype=dtype, mode='r+', shape=shape)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            hypermap = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        decoder.decode_file(item,
+                            hypermap[out_first:out_first + decoder.shape[0]],
+                            line_offset=line_offset)
+    finally:
+        hypermap = None
+        sfs.close()
+        if shm is not None:
+            shm.close()
+
+
+class _HyperMapCalibration(object):
 
-    def __init__(self, nparray, parent, index=0, downsample=1):
+    """Mixin setting the scale calibrations of (results of) the parsed
+    hypermap (and offsets if it is cropped to the region, energy
+    calibration if it is binned or cut at low energy).
+
+    Attributes:
+    calib_abs, calib_lin -- energy calibration (keV) of the channels
+    xcalib, ycalib -- size of the pixel
+    xoffset, yoffset -- position of the region
+    region -- (y0, y1, x0, x1) rectangle of hypermap or None
+    """
+
+    def _set_calibration(self, parent, index, downsample, region, energy_bin,
+                         chan_low):
         sp_meta = parent.header.get_spectra_metadata(index=index)
-        self.calib_abs = sp_meta.calibAbs  # in keV
-        self.calib_lin = sp_meta.calibLin
+        # binned channel is placed at the middle of summed channels:
+        self.calib_abs = sp_meta.calibAbs + sp_meta.calibLin *\
+            (chan_low + (energy_bin - 1) / 2.)  # in keV
+        self.calib_lin = sp_meta.calibLin * energy_bin
         self.xcalib = parent.header.x_res * downsample
         self.ycalib = parent.header.y_res * downsample
+        self.region = region
+        if region is None:
+            self.xoffset = self.yoffset = 0
+        else:
+            self.yoffset = region[0] * parent.header.y_res
+            self.xoffset = region[2] * parent.header.x_res
+
+
+class HyperMap(_HyperMapCalibration):
+
+    """Container class to hold the parsed bruker hypermap
+    and its scale calibrations (and offsets if it is cropped
+    to the region, energy calibration if it is binned or cut
+    at low energy)"""
+
+    def __init__(self, nparray, parent, index=0, downsample=1, region=None,
+                 energy_bin=1, chan_low=0):
+        self._set_calibration(parent, index, downsample, region, energy_bin,
+                              chan_low)
         self.hypermap = nparray
 
 
+class HyperMapStatistics(_HyperMapCalibration):
+
+    """Container class to hold the statistics of bruker hypermap
+    computed in single pass (see BCF_reader.get_hypermap_statistics),
+    and its scale and energy calibrations (same as of HyperMap).
+
+    Attributes:
+    sum_spectrum -- sum of spectra of all pixels
+    max_spectrum -- max value of every channel over all pixels
+        (the max peak spectrum)
+    pixel_totals -- total counts of every pixel (y, x)
+    max_channel -- the channel with the highest counts of every pixel
+        (counting from chan_low)
+    line_totals -- total counts of every line
+    chan_low -- the first channel of the spectra (low energy cutoff)
+    matches_header -- if sum_spectrum is equal to the sum spectrum
+        saved in the header (None if header spectrum is not given,
+        i.e. statistics are of the region)
+    """
+
+    def __init__(self, stats, parent, index=0, downsample=1, region=None,
+                 chan_low=0, header_spectrum=None):
+        self._set_calibration(parent, index, downsample, region, 1,
+                              chan_low)
+        self.chan_low = chan_low
+        self.sum_spectrum = stats['sum_spectrum']
+        self.max_spectrum = stats['max_spectrum']
+        self.pixel_totals = stats['pixel_totals']
+        self.max_channel = stats['max_channel']
+        self.line_totals = stats['line_totals']
+        if header_spectrum is None:
+            self.matches_header = None
+        else:
+            self.matches_header = self.check_with_header(header_spectrum)
+
+    def check_with_header(self, header_spectrum):
+        """compare the sum spectrum with the sum spectrum from the
+        header over the common channels, return True if equal."""
+        header_spectrum = header_spectrum[self.chan_low:]
+        n_chan = min(len(self.sum_spectrum), len(header_spectrum))
+        equal = np.array_equal(self.sum_spectrum[:n_chan],
+                               header_spectrum[:n_chan])
+        if not equal:
+            _logger.warning('sum spectrum of the hypermap differs from '
+                            'the sum spectrum in the header')
+        return equal
+
+
+class HyperMapPCA(_HyperMapCalibration):
+
+    """Container class to hold the principal component analysis of
+    bruker hypermap (see BCF_reader.get_hypermap_pca), and its scale
+    and energy calibrations (same as of HyperMap).
+
+    Attributes:
+    components -- array of (n_components, channels) shape
+    explained_variance -- variance of (scaled) spectra explained by
+        every component
+    explained_variance_ratio -- explained_variance as fraction of total
+        variance
+    mean -- the mean (scaled) spectrum, which is subtracted
+    scores -- array of (y, x, n_components) shape with the scores of
+        pixels (None if not computed)
+    sum_spectrum -- sum of spectra of all pixels
+    channel_scale -- Poisson scale of the channels (ones if not scaled)
+    n_pixels -- number of analysed pixels
+    """
+
+    def __init__(self, accumulator, variance, components, scores, parent,
+                 index=0, downsample=1, region=None, energy_bin=1,
+                 chan_low=0):
+        self._set_calibration(parent, index, downsample, region, energy_bin,
+                              chan_low)
+        self.components = components
+        self.explained_variance = variance
+        total = np.trace(accumulator.covariance())
+        self.explained_variance_ratio = variance / total if total > 0 \
+            else np.zeros_like(variance)
+        self.mean = accumulator.mean()
+        self.scores = scores
+        self.sum_spectrum = accumulator.sum_spectrum
+        self.channel_scale = accumulator.channel_scale()
+        self.poisson = accumulator.poisson
+        self.n_pixels = accumulator.count
+
+
+class HyperMapPlan(object):
+
+    """Container class to hold the plan of loading the hypermap within
+    the memory budget (see BCF_reader.plan_hypermap).
+
+    Attributes:
+    mode -- 'memory', 'lazy' or 'memmap'
+    index, region, downsample, cutoff_chan, chan_low, energy_bin --
+        parameters of hypermap parsing
+    shape, dtype, nbytes -- of the planned array
+    overhead -- working memory of the decoder (bytes, per thread or
+        process)
+    memory_budget -- in bytes
+    chunk_bytes -- size of chunks if lazy (else None)
+    memmap_dir -- directory of memory mapped file if memmap (else None)
+    filename -- memory mapped temporary file, when loaded (else None);
+        it is deleted when the loaded array is released
+    steps -- list of the decisions, which lead to the plan
+    """
+
+    def __init__(self, mode, index, region, downsample, cutoff_chan,
+                 chan_low, energy_bin, shape, dtype, nbytes, memory_budget,
+                 steps, overhead=0, chunk_bytes=None, memmap_dir=None):
+        self.mode = mode
+        self.index = index
+        self.region = region
+        self.downsample = downsample
+        self.cutoff_chan = cutoff_chan
+        self.chan_low = chan_low
+        self.energy_bin = energy_bin
+        self.shape = shape
+        self.dtype = dtype
+        self.nbytes = nbytes
+        self.overhead = overhead
+        self.memory_budget = memory_budget
+        self.chunk_bytes = chunk_bytes
+        self.memmap_dir = memmap_dir
+        self.filename = None
+        self.steps = steps
+
+    def report(self):
+        """return human readable description of the plan"""
+        lines = ['hypermap {0}: {1} array {2} of {3} ({4} + {5} decoder '
+                 'working memory), memory budget {6}:'.format(
+                     self.index, self.mode, self.shape, self.dtype.name,
+                     format_bytes(self.nbytes), format_bytes(self.overhead),
+                     format_bytes(self.memory_budget))]
+        lines.extend('  ' + step for step in self.steps)
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
+
+
 # wrapper functions for hyperspy:
 def file_reader(filename, select_type=None, index=None, downsample=1,     # noqa
-                cutoff_at_kV=None, instrument=None, lazy=False):
+                cutoff_at_kV=None, instrument=None, lazy=False, region=None,
+                energy_bin=1, low_cutoff_at_kV=None, hypermap_cache=False,
+                image_workers=None, thumbnail_size=None, workers=None,
+                memory_budget=None):
     """Reads a bruker bcf file and loads the data into the appropriate class,
     then wraps it into appropriate hyperspy required list of dictionaries
     used by hyperspy.api.load() method.
@@ -1196,50 +3609,94 @@ def file_reader(filename, select_type=None, index=None, downsample=1,     # noqa
     cutoff_at_kV -- if set (can be int of float >= 0) can be used either, to
        crop or enlarge energy range at max values. (default None)
     instrument -- str, either 'TEM' or 'SEM'. Default is None.
+    region -- (y0, y1, x0, x1) rectangle of hyperspectral array to be
+      loaded (default None -- whole array).
+    energy_bin -- number of adjacent channels summed together, the energy
+      axis is shrinked by that factor (default 1).
+    low_cutoff_at_kV -- if set, the channels bellow are dropped
+      (default None).
+    hypermap_cache -- True, or HypermapCache instance, to reuse hypermaps
+      decoded in previous sessions (default False).
+    image_workers -- number of processes decoding sem imagery
+      (default None -- sequential decoding).
+    thumbnail_size -- if set, sem imagery is loaded as thumbnails with
+      largest side not bigger than that (default None -- full images).
+    workers -- number of hypermaps (if index is 'all') decoded at once,
+      or number of processes decoding single hypermap (default None).
+    memory_budget -- bytes or string as '2GB', the limit of memory
+      of hypermaps decoded at once (default None -- 90% of available
+      memory, if it can be queried).
       """
 
     # objectified bcf file:
-    obj_bcf = BCF_reader(filename, instrument=instrument)
+    obj_bcf = BCF_reader(filename, instrument=instrument,
+                         hypermap_cache=hypermap_cache)
     if select_type == 'image':
-        return bcf_imagery(obj_bcf)
+        return bcf_imagery(obj_bcf, workers=image_workers,
+                           thumbnail_size=thumbnail_size)
     elif select_type == 'spectrum':
         return bcf_hyperspectra(obj_bcf, index=index,
                                 downsample=downsample,
                                 cutoff_at_kV=cutoff_at_kV,
-                                lazy=lazy)
+                                lazy=lazy, region=region,
+                                energy_bin=energy_bin,
+                                low_cutoff_at_kV=low_cutoff_at_kV,
+                                workers=workers,
+                                memory_budget=memory_budget)
     else:
-        return bcf_imagery(obj_bcf) + bcf_hyperspectra(
+        return bcf_imagery(obj_bcf, workers=image_workers,
+                           thumbnail_size=thumbnail_size) + bcf_hyperspectra(
             obj_bcf,
             index=index,
             downsample=downsample,
             cutoff_at_kV=cutoff_at_kV,
-            lazy=lazy)
+            lazy=lazy,
+            region=region,
+            energy_bin=energy_bin,
+            low_cutoff_at_kV=low_cutoff_at_kV,
+            workers=workers,
+            memory_budget=memory_budget)
 
 
-def bcf_imagery(obj_bcf):
+def bcf_imagery(obj_bcf, workers=None, thumbnail_size=None):
     """ return hyperspy required list of dict with sem
     imagery and metadata.
+
+    Image planes are decoded here (in parallel processes if
+    workers > 1), as thumbnails if thumbnail_size is set
+    (see HyperImage.get_images).
     """
     imagery_list = []
-    for img in obj_bcf.header.image.images:
-        obj_bcf.add_filename_to_general(img)
-        imagery_list.append(img)
+    images = [obj_bcf.header.image]
     if hasattr(obj_bcf.header, 'overview'):
-        for img2 in obj_bcf.header.overview.images:
-            obj_bcf.add_filename_to_general(img2)
-            imagery_list.append(img2)
+        images.append(obj_bcf.header.overview)
+    for image in images:
+        if thumbnail_size is None and workers is None:
+            items = image.images
+        else:
+            items = image.get_images(workers=workers,
+                                     thumbnail_size=thumbnail_size)
+        for img in items:
+            obj_bcf.add_filename_to_general(img)
+            imagery_list.append(img)
     return imagery_list
 
 
 def bcf_hyperspectra(obj_bcf, index=None, downsample=None, cutoff_at_kV=None,  # noqa
-                     lazy=False):
+                     lazy=False, region=None, energy_bin=1,
+                     low_cutoff_at_kV=None, workers=None, memory_budget=None):
     """ Return hyperspy required list of dict with eds
     hyperspectra and metadata.
+
+    Several hypermaps (index='all') are decoded concurrently by
+    workers threads within the memory_budget (see
+    BCF_reader.parse_hypermaps), single hypermap is decoded by workers
+    processes (see BCF_reader.parallel_parse_hypermap).
     """
     global warn_once
     if (fast_unbcf == False) and warn_once:
         _logger.warning("""unbcf_fast library is not present...
-Parsing BCF with Python-only backend, which is slow... please wait.
+Parsing BCF with python/numpy backend, which is slower... please wait.
 If parsing is uncomfortably slow, first install cython, then reinstall hyperspy.
 For more information, check the 'Installing HyperSpy' section in the documentation.""")
         warn_once = False
@@ -1252,19 +3709,32 @@ For more information, check the 'Installing HyperSpy' section in the documentati
     hyperspectra = []
     mode = obj_bcf.header.mode
     mapping = get_mapping(mode)
+    if len(indexes) > 1 and not lazy:
+        # the stack of hypermaps is decoded concurrently:
+        obj_bcf.persistent_parse_hypermaps(indexes, downsample=downsample,
+                                           cutoff_at_kV=cutoff_at_kV,
+                                           region=region,
+                                           energy_bin=energy_bin,
+                                           low_cutoff_at_kV=low_cutoff_at_kV,
+                                           workers=workers,
+                                           memory_budget=memory_budget)
     for index in indexes:
-        obj_bcf.persistent_parse_hypermap(index=index, downsample=downsample,
-                                      cutoff_at_kV=cutoff_at_kV, lazy=lazy)
+        if len(indexes) == 1 or lazy:
+            obj_bcf.persistent_parse_hypermap(
+                index=index, downsample=downsample,
+                cutoff_at_kV=cutoff_at_kV, lazy=lazy, region=region,
+                workers=workers, energy_bin=energy_bin,
+                low_cutoff_at_kV=low_cutoff_at_kV)
         eds_metadata = obj_bcf.header.get_spectra_metadata(index=index)
         hyperspectra.append({'data': obj_bcf.hypermap[index].hypermap,
                      'axes': [{'name': 'height',
                                'size': obj_bcf.hypermap[index].hypermap.shape[0],
-                               'offset': 0,
+                               'offset': obj_bcf.hypermap[index].yoffset,
                                'scale': obj_bcf.hypermap[index].ycalib,
                                'units': obj_bcf.header.units},
                               {'name': 'width',
                                'size': obj_bcf.hypermap[index].hypermap.shape[1],
-                               'offset': 0,
+                               'offset': obj_bcf.hypermap[index].xoffset,
                                'scale': obj_bcf.hypermap[index].xcalib,
                                'units': obj_bcf.header.units},
                               {'name': 'Energy',
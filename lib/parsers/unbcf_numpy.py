@@ -0,0 +1,1462 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Pure python/numpy decoder of Bruker hypermaps (bcf SpectrumData).
+#  It is the fallback for the cython unbcf_fast library and gives
+#  the same results as BCF_reader.py_parse_hypermap.
+#
+# The decoding goes in two phases. The first phase walks the pixel
+#  headers of a band of lines (which is the only sequential part of
+#  the format) and collects them into arrays. The second phase decodes
+#  all pixels of the band at once, separately for every packing flag:
+#  16bit and 12bit pulse lists and instructively packed spectra are
+#  expanded into (pixel * channels + channel) keys which are summed up
+#  with single bincount.
+
+import time
+import numpy as np
+from struct import Struct
+
+# x index of pixel, number of channels for whole mapping,
+# number of channels for pixel, dummy placeholder, packing flag,
+# size of packed data (sometimes), number of pulses, packed data size:
+_pixel_head = Struct('<IHHIHHHI')
+_uint32 = Struct('<I')
+_map_head = Struct('<ii')
+
+# max number of elements of the band accumulator, which keeps memory
+# use of temporary decoding arrays in tens of MB:
+BAND_ELEMENTS = 1 << 20
+# max number of pixels (including skipped ones) walked at once:
+BAND_PIXELS = 1 << 16
+
+
+class DecodingCancelled(Exception):
+    """Raised when the decoding is cancelled through Progress.
+
+    Attributes:
+    progress -- the Progress instance of the decoding
+    partial -- the partially decoded array (if the partial result was
+        requested and is available, else None)
+    """
+
+    def __init__(self, progress, partial=None):
+        Exception.__init__(self, 'hypermap decoding cancelled after '
+                           '{0} of {1} lines'.format(progress.lines_done,
+                                                     progress.total_lines))
+        self.progress = progress
+        self.partial = partial
+
+
+class Progress(object):
+    """Progress reporting and cancellation token of hypermap decoding.
+
+    The token is updated by the decoder after every decoded band of
+    lines (the bytes are counted as the data is read from the internal
+    file), the callback is called and if the decoding is cancelled
+    (by cancel method, i.e. from the callback or other thread, or by
+    callback returning False), DecodingCancelled is raised.
+
+    The token can be reused: every decoding starts it (resetting the
+    counters and cancellation) and finishes it. The decoding which
+    runs other decodings (i.e. bands in processes or several passes)
+    starts the token itself, and then the inner decodings only count
+    into it.
+
+    Arguments:
+    callback -- function called with this instance after every
+        band of lines (default None)
+    keep_partial -- attach the partially decoded array to
+        DecodingCancelled (default False)
+
+    Attributes:
+    lines_done, total_lines -- decoded and all lines of (region of)
+        the hypermap
+    bytes_read -- uncompressed bytes read from the internal file
+    elapsed -- seconds since the start of decoding
+    rate -- lines per second
+    throughput -- bytes per second
+    eta -- estimated seconds left (None before the first band)
+    cancelled -- True if decoding was cancelled
+    started -- True from the start until the finish of the decoding
+    """
+
+    def __init__(self, callback=None, keep_partial=False):
+        self.callback = callback
+        self.keep_partial = keep_partial
+        self.cancelled = False
+        self.started = False
+        self.total_lines = 0
+        self.lines_done = 0
+        self.bytes_read = 0
+        self._started = None
+        self._finished = None
+
+    def start(self, total_lines):
+        """reset the counters and the cancellation, set the number
+        of lines to be decoded and start the clock"""
+        self.total_lines = total_lines
+        self.lines_done = 0
+        self.bytes_read = 0
+        self.cancelled = False
+        self.started = True
+        self._started = time.perf_counter()
+        self._finished = None
+
+    def finish(self):
+        """stop the clock; the counters are kept until the next start"""
+        if self.started:
+            self.started = False
+            self._finished = time.perf_counter()
+
+    def cancel(self):
+        """request the decoding to stop at the next band of lines"""
+        self.cancelled = True
+
+    @property
+    def elapsed(self):
+        if self._started is None:
+            return 0.
+        if self._finished is not None:
+            return self._finished - self._started
+        return time.perf_counter() - self._started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.lines_done / elapsed if elapsed > 0 else 0.
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        return self.bytes_read / elapsed if elapsed > 0 else 0.
+
+    @property
+    def eta(self):
+        if self.lines_done == 0:
+            return None
+        return self.elapsed / self.lines_done *\
+            (self.total_lines - self.lines_done)
+
+    def check(self):
+        """raise DecodingCancelled if the decoding was cancelled"""
+        if self.cancelled:
+            raise DecodingCancelled(self)
+
+    def update(self, lines=0):
+        """count decoded lines, call the callback and check
+        the cancellation"""
+        self.lines_done += lines
+        if self.callback is not None and self.callback(self) is False:
+            self.cancelled = True
+        self.check()
+
+    def __str__(self):
+        eta = self.eta
+        return '{0}/{1} lines, {2:.1f} MB/s, ETA {3}'.format(
+            self.lines_done, self.total_lines, self.throughput / 1e6,
+            '?' if eta is None else '{0:.0f}s'.format(eta))
+
+
+class DataStream(object):
+    """Growing byte buffer over the iterator of data chunks.
+
+    Python counterpart of DataStream from unbcf_fast: the chunks
+    are appended to the buffer when more data is required and consumed
+    part of buffer can be discarded.
+
+    Arguments:
+    blocks -- iterator of data chunks (bytes or buffers)
+    offset -- offset of the first chunk in the uncompressed internal
+        file (default 0)
+    progress -- Progress instance counting the read bytes and
+        reporting the decoded lines (default None)
+
+    Attributes:
+    buffer -- bytearray with not discarded data
+    base -- offset of the buffer start in uncompressed internal file
+    progress -- Progress instance or None
+    """
+
+    def __init__(self, blocks, offset=0, progress=None):
+        self.blocks = blocks
+        self.buffer = bytearray()
+        self.base = offset
+        self.progress = progress
+
+    def fill(self, end):
+        """make sure buffer is at least end bytes long, return its length"""
+        try:
+            while len(self.buffer) < end:
+                block = next(self.blocks)
+                self.buffer += block
+                if self.progress is not None:
+                    self.progress.bytes_read += len(block)
+        except StopIteration:
+            raise ValueError('hypermap data is truncated at offset {0}'.format(
+                self.base + len(self.buffer)))
+        return len(self.buffer)
+
+    def discard(self, pos):
+        """drop the part of buffer before position pos"""
+        del self.buffer[:pos]
+        self.base += pos
+
+
+class PixelRecords(object):
+    """Pixel headers of the band of lines collected into arrays.
+
+    Attributes (numpy arrays, one value per pixel record):
+    line -- line of the pixel counting from the first line of the band
+    rec -- offset of the pixel record in the stream buffer
+    x, chan1, chan2, flag, n_pulses, size -- pixel header values
+    data -- offset of the packed data in the stream buffer
+    line_starts -- offsets of every line in the stream buffer
+    end -- offset after the last record in the stream buffer
+    """
+
+    fields = ('line', 'rec', 'x', 'chan1', 'chan2', 'flag', 'n_pulses',
+              'data', 'size')
+
+    def __init__(self, rows, line_starts, end):
+        table = np.array(rows, dtype=np.int64).reshape(-1, len(self.fields))
+        for i, name in enumerate(self.fields):
+            setattr(self, name, table[:, i])
+        self.line_starts = np.array(line_starts, dtype=np.int64)
+        self.end = end
+
+    def __len__(self):
+        return len(self.x)
+
+
+def scan_lines(stream, pos, n_lines, collect='records'):
+    """Walk pixel headers of n_lines lines (phase one).
+
+    Arguments:
+    stream -- DataStream instance
+    pos -- position of the first line in the stream buffer
+    n_lines -- number of lines to walk
+    collect -- 'records' to collect the pixel headers, 'offsets' to
+        collect only the positions of lines and pixel records, or
+        None to skip the lines (default 'records')
+
+    Returns:
+    PixelRecords (if collect is 'records'),
+    (line positions, pixel record positions, position after the last
+    line) (if collect is 'offsets'),
+    or position after the last line.
+    """
+    buf = stream.buffer
+    size = len(buf)
+    unpack_head = _pixel_head.unpack_from
+    unpack_uint32 = _uint32.unpack_from
+    records = collect == 'records'
+    offsets = collect == 'offsets'
+    rows = []
+    line_starts = []
+    append = rows.append
+    for line in range(n_lines):
+        if pos + 4 > size:
+            size = stream.fill(pos + 4)
+        line_starts.append(pos)
+        n_pixels = unpack_uint32(buf, pos)[0]
+        pos += 4
+        for dummy in range(n_pixels):
+            if pos + 22 > size:
+                size = stream.fill(pos + 22)
+            x, chan1, chan2, dummy1, flag, dummy_size1, n_pulses, size2 =\
+                unpack_head(buf, pos)
+            end = pos + 22 + size2
+            if end > size:
+                size = stream.fill(end)
+            if flag > 1 and n_pulses > 0:
+                # the additional pulses follows the instructed data:
+                end += unpack_uint32(buf, end - 4)[0]
+                if end > size:
+                    size = stream.fill(end)
+            if records:
+                append((line, pos, x, chan1, chan2, flag, n_pulses, pos + 22,
+                        size2))
+            elif offsets:
+                append(pos)
+            pos = end
+    if records:
+        return PixelRecords(rows, line_starts, pos)
+    if offsets:
+        return line_starts, rows, pos
+    return pos
+
+
+class SpectrumIndex(object):
+    """Offsets of the lines and the pixel records of the hypermap
+    in the uncompressed SpectrumData internal file.
+
+    Arguments/Attributes (uint64 arrays):
+    lines -- offset of every line, followed by the offset of the end
+        of hypermap data (height + 1 values)
+    pixels -- offset of every pixel record
+    line_pixels -- index of the first pixel record of every line in
+        pixels, followed by number of pixel records (height + 1 values)
+
+    Methods:
+    build, line_span, line_pixel_offsets
+    """
+
+    fields = ('lines', 'pixels', 'line_pixels')
+
+    def __init__(self, lines, pixels, line_pixels):
+        self.lines = np.asarray(lines, dtype=np.uint64)
+        self.pixels = np.asarray(pixels, dtype=np.uint64)
+        self.line_pixels = np.asarray(line_pixels, dtype=np.uint64)
+
+    @property
+    def height(self):
+        return len(self.lines) - 1
+
+    @classmethod
+    def build(cls, stream, height, pos=0x1A0, band_lines=64):
+        """Build the index with header-only pass over the hypermap.
+
+        Arguments:
+        stream -- DataStream instance with the hypermap
+        height -- number of lines of the hypermap
+        pos -- position of the first line in the stream buffer
+            (default 0x1A0)
+        band_lines -- number of lines walked before discarding
+            the consumed stream buffer (default 64)
+        """
+        lines = []
+        pixels = []
+        for first_line in range(0, height, band_lines):
+            n_lines = min(band_lines, height - first_line)
+            line_starts, records, pos = scan_lines(stream, pos, n_lines,
+                                                   collect='offsets')
+            lines.append(np.array(line_starts, dtype=np.uint64) + stream.base)
+            pixels.append(np.array(records, dtype=np.uint64) + stream.base)
+            stream.discard(pos)
+            pos = 0
+        lines.append(np.array([stream.base], dtype=np.uint64))
+        lines = np.concatenate(lines)
+        pixels = np.concatenate(pixels) if pixels else\
+            np.zeros(0, dtype=np.uint64)
+        return cls(lines, pixels, np.searchsorted(pixels, lines))
+
+    def line_span(self, first_line, last_line):
+        """return (start, end) offsets of the lines from first_line
+        up to (not including) last_line"""
+        return int(self.lines[first_line]), int(self.lines[last_line])
+
+    def line_pixel_offsets(self, line):
+        """return offsets of the pixel records of the line"""
+        return self.pixels[int(self.line_pixels[line]):
+                           int(self.line_pixels[line + 1])]
+
+
+def _ranges(starts, counts, step=1):
+    """concatenated ranges of count values from start with step
+    for every pair of starts and counts"""
+    counts_sum = np.cumsum(counts)
+    total = counts_sum[-1] if len(counts) else 0
+    return np.arange(0, total * step, step, dtype=np.int64) +\
+        np.repeat(starts - step * (counts_sum - counts), counts)
+
+
+def _read_uint(u8, pos, n_bytes):
+    """read little endian unsigned integers of n_bytes at positions"""
+    value = u8[pos].astype(np.int64)
+    for i in range(1, n_bytes):
+        value |= u8[pos + i].astype(np.int64) << (8 * i)
+    return value
+
+
+def _pulses_16bit(u8, data, size):
+    """channels of 16bit packed pulses and the owning record"""
+    n = size // 2
+    return _read_uint(u8, _ranges(data, n, 2), 2),\
+        np.repeat(np.arange(len(n)), n)
+
+
+def _pulses_12bit(u8, data, n_pulses):
+    """channels of 12bit packed pulses and the owning record
+    (every 4 pulses are packed into 6 bytes)"""
+    n_groups = -(-n_pulses // 4)
+    base = _ranges(data, n_groups, 6)
+    b = [u8[base + i].astype(np.int64) for i in range(6)]
+    channel = np.empty((len(base), 4), dtype=np.int64)
+    channel[:, 0] = (b[0] >> 4) + (b[1] << 4)
+    channel[:, 1] = ((b[0] << 8) + b[3]) & 4095
+    channel[:, 2] = (b[2] << 4) + (b[5] >> 4)
+    channel[:, 3] = ((b[5] << 8) + b[4]) & 4095
+    owner = np.repeat(np.arange(len(n_pulses)), n_groups)
+    # the last group of pixel can be incomplete:
+    valid = (_ranges(np.zeros_like(n_groups), n_groups, 4)[:, None] +
+             np.arange(4)) < n_pulses[owner][:, None]
+    return channel[valid], np.repeat(owner, 4)[valid.ravel()]
+
+
+def _instructed(u8, data, size, limit):
+    """decode instructively packed spectra.
+
+    Instructions of all pixels are walked simultaneously: every
+    iteration reads next instruction (size of values, number of
+    channels, gain) of every not yet finished pixel.
+
+    Returns:
+    (channels, values, owning records) of channels below limit
+    """
+    n = len(data)
+    pos = data.copy()
+    end = data + size - 4
+    channel = np.zeros(n, dtype=np.int64)
+    segments = []
+    active = np.nonzero(pos < end)[0]
+    while active.size:
+        p = pos[active]
+        val_size = u8[p].astype(np.int64)
+        n_chan = u8[p + 1].astype(np.int64)
+        p = p + 2
+        gain = np.zeros(len(active), dtype=np.int64)
+        for n_bytes in (1, 2, 4, 8):
+            mask = val_size == n_bytes
+            if mask.any():
+                gain[mask] = _read_uint(u8, p[mask], n_bytes)
+        values_pos = p + val_size
+        length = np.where(val_size == 1, (n_chan + 1) // 2,
+                          n_chan * val_size // 2)
+        packed = (val_size > 0) & (channel[active] < limit[active])
+        if packed.any():
+            segments.append((active[packed], channel[active][packed],
+                             n_chan[packed], values_pos[packed],
+                             val_size[packed], gain[packed]))
+        channel[active] += n_chan
+        pos[active] = values_pos + length
+        active = active[pos[active] < end[active]]
+    if not segments:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    owner, first_chan, n_chan, values_pos, val_size, gain = [
+        np.concatenate(i) for i in zip(*segments)]
+    # values over the limit are not needed:
+    n_chan = np.minimum(n_chan, limit[owner] - first_chan)
+    parts = []
+    for n_bytes in (1, 2, 4, 8):
+        seg = np.nonzero(val_size == n_bytes)[0]
+        if seg.size == 0:
+            continue
+        count = n_chan[seg]
+        if n_bytes == 1:
+            # values are nibbles, low nibble goes first:
+            nibble = _ranges(2 * values_pos[seg], count)
+            byte = u8[nibble >> 1]
+            values = np.where(nibble & 1, byte >> 4,
+                              byte & 15).astype(np.int64)
+        else:
+            # values are 1, 2 and 4 bytes long respectively:
+            values = _read_uint(u8, _ranges(values_pos[seg], count,
+                                            n_bytes // 2), n_bytes // 2)
+        values += np.repeat(gain[seg], count)
+        parts.append((_ranges(first_chan[seg], count), values,
+                      np.repeat(owner[seg], count)))
+    return [np.concatenate(i) for i in zip(*parts)]
+
+
+def decode_records(buffer, records, target, limit, n_channels,
+                   chan_low=0, energy_bin=1):
+    """Decode pixels of the band (phase two).
+
+    Arguments:
+    buffer -- stream buffer which records refers to
+    records -- PixelRecords
+    target -- index of the destination pixel of every record
+        (negative to skip the record)
+    limit -- channel limit of every record (channels >= limit
+        are dropped)
+    n_channels -- number of channels of destination pixel
+    chan_low -- channels bellow are dropped (default 0)
+    energy_bin -- number of adjacent channels summed together (default 1)
+
+    Returns:
+    list of (keys, values) pairs, where keys are
+    destination pixel * n_channels + destination channel,
+    and values are None for single pulses.
+    """
+    u8 = np.frombuffer(buffer, dtype=np.uint8)
+    parts = []
+    selected = target >= 0
+    flag = records.flag
+    for pulse_flag in (0, 1):
+        sel = np.nonzero(selected & (flag == pulse_flag))[0]
+        if sel.size == 0:
+            continue
+        if pulse_flag == 0:
+            channels, owner = _pulses_16bit(u8, records.data[sel],
+                                            records.size[sel])
+        else:
+            channels, owner = _pulses_12bit(u8, records.data[sel],
+                                            records.n_pulses[sel])
+        parts.append((channels, None, sel[owner]))
+    sel = np.nonzero(selected & (flag > 1))[0]
+    if sel.size:
+        channels, values, owner = _instructed(u8, records.data[sel],
+                                              records.size[sel], limit[sel])
+        parts.append((channels, values, sel[owner]))
+        # additional pulses, stored after instructed data:
+        add = sel[records.n_pulses[sel] > 0]
+        if add.size:
+            channels, owner = _pulses_16bit(
+                u8, records.data[add] + records.size[add],
+                2 * records.n_pulses[add])
+            parts.append((channels, None, add[owner]))
+    del u8
+    keyed = []
+    for channels, values, owner in parts:
+        if values is None:
+            valid = channels < limit[owner]
+        else:
+            # instructed channels are already limited:
+            valid = None
+        if chan_low:
+            low = channels >= chan_low
+            valid = low if valid is None else valid & low
+        if valid is not None:
+            channels, owner = channels[valid], owner[valid]
+            if values is not None:
+                values = values[valid]
+        if chan_low:
+            channels = channels - chan_low
+        if energy_bin > 1:
+            channels = channels // energy_bin
+        keys = target[owner] * n_channels
+        keys += channels
+        keyed.append((keys, values))
+    return keyed
+
+
+def accumulate(keyed, n_elements, unique=False):
+    """Sum the (keys, values) pairs into dense int64 array.
+
+    Arguments:
+    keyed -- list of (keys, values) pairs from decode_records
+    n_elements -- size of returned array
+    unique -- if True, keys of every pair with values are known
+        to be unique (no downsampling) and values are simply added
+        at the keys (default False)
+    """
+    pulses = [keys for keys, values in keyed if values is None]
+    if pulses:
+        acc = np.bincount(np.concatenate(pulses),
+                          minlength=n_elements).astype(np.int64, copy=False)
+    else:
+        acc = np.zeros(n_elements, dtype=np.int64)
+    for keys, values in keyed:
+        if values is None:
+            continue
+        if unique:
+            acc[keys] += values
+        else:
+            acc += np.bincount(keys, weights=values,
+                               minlength=n_elements).astype(np.int64)
+    return acc
+
+
+def window_sums(keyed, n_channels, windows, n_pixels):
+    """Sum the (keys, values) pairs into channel windows of every pixel.
+
+    Arguments:
+    keyed -- list of (keys, values) pairs from decode_records
+    n_channels -- number of channels used in the keys
+    windows -- list of (first, last + 1) channel ranges (can overlap)
+    n_pixels -- number of pixels
+
+    Returns:
+    int64 array of (n_windows, n_pixels) shape
+    """
+    sums = np.zeros((len(windows), n_pixels), dtype=np.int64)
+    for keys, values in keyed:
+        pixel, channel = np.divmod(keys, n_channels)
+        for i, (first, last) in enumerate(windows):
+            inside = (channel >= first) & (channel < last)
+            if values is None:
+                sums[i] += np.bincount(pixel[inside], minlength=n_pixels)
+            else:
+                sums[i] += np.bincount(pixel[inside],
+                                       weights=values[inside],
+                                       minlength=n_pixels).astype(np.int64)
+    return sums
+
+
+class HypermapDecoder(object):
+    """Decoder of the Bruker hypermap stream into the bands of lines.
+
+    Arguments:
+    height, width -- dimensions of the hypermap in pixels
+    max_chan -- channels above are truncated
+    downsample -- spatial downsampling factor (integer, default 1)
+    region -- (y0, y1, x0, x1) rectangle of the hypermap to be
+        decoded, pixel records outside are skipped without unpacking,
+        and downsampling starts at the corner of the region.
+        (default None -- whole hypermap)
+    chan_low -- channels below are dropped (default 0)
+    energy_bin -- number of adjacent channels (starting from chan_low)
+        summed into one channel of decoded array (default 1)
+
+    Attributes:
+    shape -- (height, width, channels) of decoded array
+    region -- (y0, y1, x0, x1) of the decoded rectangle
+    """
+
+    def __init__(self, height, width, max_chan, downsample=1, region=None,
+                 chan_low=0, energy_bin=1):
+        self.height = height
+        self.width = width
+        self.max_chan = max_chan
+        self.downsample = downsample
+        self.region = check_region(region, height, width)
+        if not 0 <= chan_low < max_chan:
+            raise ValueError('low cutoff channel {0} is out of the range of '
+                             '{1} channels'.format(chan_low, max_chan))
+        if energy_bin < 1:
+            raise ValueError('energy_bin should be positive integer')
+        self.chan_low = chan_low
+        self.energy_bin = energy_bin
+        y0, y1, x0, x1 = self.region
+        self.shape = (-(-(y1 - y0) // downsample),
+                      -(-(x1 - x0) // downsample),
+                      -(-(max_chan - chan_low) // energy_bin))
+
+    def band_lines(self):
+        """number of lines (multiple of downsample) decoded at once"""
+        out_line = self.shape[1] * self.shape[2]
+        out_lines = min(BAND_ELEMENTS // out_line,
+                        BAND_PIXELS // (self.width * self.downsample))
+        return max(1, out_lines) * self.downsample
+
+    def band_working_bytes(self, lines=None):
+        """Estimate the memory (bytes) of temporary arrays of decoding
+        the band of lines: the pulses or channels (up to max_chan) of
+        every pixel record in the band expanded into keys and values,
+        and the band accumulator of decoded elements.
+
+        Arguments:
+        lines -- number of lines to be decoded (default None -- all
+            lines of the region), the band is not larger
+        """
+        y0, y1, x0, x1 = self.region
+        if lines is None:
+            lines = y1 - y0
+        lines = min(self.band_lines(), lines)
+        out_elements = -(-lines // self.downsample) * self.shape[1] *\
+            self.shape[2]
+        return lines * (x1 - x0) * self.max_chan * 16 + out_elements * 12
+
+    def _targets(self, records, first_line):
+        dwn = self.downsample
+        y0, y1, x0, x1 = self.region
+        first_line -= y0
+        target = ((first_line + records.line) // dwn - first_line // dwn) *\
+            self.shape[1] + (records.x - x0) // dwn
+        target[(records.x < x0) | (records.x >= x1)] = -1
+        return target
+
+    def skip_lines(self, stream, pos, n_lines):
+        """walk over n_lines lines without decoding, and return
+        the position of the next line"""
+        band = max(1, BAND_PIXELS // self.width)
+        for first_line in range(0, n_lines, band):
+            pos = scan_lines(stream, pos, min(band, n_lines - first_line),
+                             collect=None)
+            stream.discard(pos)
+            pos = 0
+        return pos
+
+    def iter_keyed(self, stream, pos=0x1A0, line=0):
+        """Generate the decoded, but not summed up bands of lines.
+
+        Arguments are same as for iter_bands.
+
+        Yields:
+        (first output line, number of output lines, list of (keys, values)
+        pairs from decode_records)
+        """
+        y0, y1 = self.region[:2]
+        if line > y0:
+            raise ValueError('stream starts after the first line of region')
+        band = self.band_lines()
+        progress = stream.progress
+        # the token started by the caller is only counted into:
+        own_progress = progress is not None and not progress.started
+        if own_progress:
+            progress.start(y1 - y0)
+        try:
+            pos = self.skip_lines(stream, pos, y0 - line)
+            for first_line in range(y0, y1, band):
+                if progress is not None:
+                    progress.check()
+                n_lines = min(band, y1 - first_line)
+                records = scan_lines(stream, pos, n_lines)
+                out_first = (first_line - y0) // self.downsample
+                out_lines = -(-(first_line - y0 + n_lines) //
+                              self.downsample) - out_first
+                limit = np.minimum(records.chan1, self.max_chan)
+                keyed = decode_records(stream.buffer, records,
+                                       self._targets(records, first_line),
+                                       limit, self.shape[2],
+                                       chan_low=self.chan_low,
+                                       energy_bin=self.energy_bin)
+                stream.discard(records.end)
+                pos = 0
+                yield out_first, out_lines, keyed
+                if progress is not None:
+                    progress.update(n_lines)
+        finally:
+            if own_progress:
+                progress.finish()
+
+    def iter_bands(self, stream, pos=0x1A0, line=0):
+        """Generate the decoded bands of lines.
+
+        Arguments:
+        stream -- DataStream instance with the hypermap
+        pos -- position of the line in the stream buffer (default 0x1A0)
+        line -- the line at pos, lines before the region are
+            skipped (default 0)
+
+        Yields:
+        (first output line, int64 array of (lines, width, channels) shape)
+        """
+        out_width, n_chan = self.shape[1:]
+        for out_first, out_lines, keyed in self.iter_keyed(stream, pos=pos,
+                                                           line=line):
+            acc = accumulate(keyed, out_lines * out_width * n_chan,
+                             unique=(self.downsample == 1 and
+                                     self.energy_bin == 1))
+            yield out_first, acc.reshape(out_lines, out_width, n_chan)
+
+    def iter_lines(self, stream, dtype, pos=0x1A0, line=0):
+        """Generate the decoded lines one by one.
+
+        Lines are cast to dtype same as by decode_into, in the single
+        buffer which is reused for every line, thus the yielded array
+        is valid until the next line is requested (copy it to keep).
+
+        Arguments:
+        stream, pos, line -- same as for iter_bands
+        dtype -- dtype of the line
+
+        Yields:
+        (output line number, array of (width, channels) shape)
+        """
+        buffer = np.empty(self.shape[1:], dtype=dtype)
+        for out_first, band in self.iter_bands(stream, pos=pos, line=line):
+            for i, band_line in enumerate(band):
+                buffer[...] = band_line
+                yield out_first + i, buffer
+
+    def window_maps_into(self, stream, windows, out, pos=0x1A0, line=0):
+        """Sum the counts in channel windows of every pixel into
+        the given array, without building the spectra.
+
+        Arguments:
+        stream -- DataStream instance with the hypermap
+        windows -- list of (first, last + 1) channel ranges
+        out -- array of (n_windows, height, width) shape
+        pos, line -- same as for iter_bands
+
+        Returns:
+        out
+        """
+        out_width = self.shape[1]
+        try:
+            for out_first, out_lines, keyed in self.iter_keyed(stream,
+                                                               pos=pos,
+                                                               line=line):
+                sums = window_sums(keyed, self.shape[2], windows,
+                                   out_lines * out_width)
+                out[:, out_first:out_first + out_lines] =\
+                    sums.reshape(len(windows), out_lines, out_width)
+        except DecodingCancelled as cancelled:
+            if stream.progress.keep_partial:
+                cancelled.partial = out
+            raise
+        return out
+
+    def statistics(self, stream, pos=0x1A0, line=0):
+        """Compute the statistics of the hypermap in single pass.
+
+        Arguments are same as for iter_bands.
+
+        Returns:
+        dict with int64 arrays (except max_channel):
+        sum_spectrum -- sum of spectra of all pixels,
+        max_spectrum -- max value of every channel over all pixels,
+        pixel_totals -- total counts of every pixel (height, width),
+        max_channel -- the channel with the highest counts of every
+            pixel (uint16 array of (height, width) shape),
+        line_totals -- total counts of every line.
+        """
+        height, width, n_chan = self.shape
+        stats = {'sum_spectrum': np.zeros(n_chan, dtype=np.int64),
+                 'max_spectrum': np.zeros(n_chan, dtype=np.int64),
+                 'pixel_totals': np.zeros((height, width), dtype=np.int64),
+                 'max_channel': np.zeros((height, width), dtype=np.uint16),
+                 'line_totals': np.zeros(height, dtype=np.int64)}
+        for out_first, band in self.iter_bands(stream, pos=pos, line=line):
+            out_last = out_first + band.shape[0]
+            spectra = band.reshape(-1, n_chan)
+            stats['sum_spectrum'] += spectra.sum(axis=0)
+            np.maximum(stats['max_spectrum'], spectra.max(axis=0),
+                       out=stats['max_spectrum'])
+            totals = band.sum(axis=2)
+            stats['pixel_totals'][out_first:out_last] = totals
+            stats['max_channel'][out_first:out_last] = band.argmax(axis=2)
+            stats['line_totals'][out_first:out_last] = totals.sum(axis=1)
+        return stats
+
+    def decode(self, stream, dtype, pos=0x1A0, line=0):
+        """decode the hypermap (or its region) into new numpy array
+        of given dtype (arguments are same as for iter_bands)"""
+        return self.decode_into(stream, np.zeros(self.shape, dtype=dtype),
+                                pos=pos, line=line)
+
+    def decode_into(self, stream, out, pos=0x1A0, line=0):
+        """decode the hypermap (or its region) into given array of
+        self.shape shape (i.e. array in shared memory), every element
+        of array is overwritten.
+
+        If the decoding is cancelled (see Progress), not decoded lines
+        of out are left untouched."""
+        try:
+            for out_first, band in self.iter_bands(stream, pos=pos,
+                                                   line=line):
+                out[out_first:out_first + band.shape[0]] = band
+        except DecodingCancelled as cancelled:
+            if stream.progress.keep_partial:
+                cancelled.partial = out
+            raise
+        return out
+
+    def open_region(self, virtual_file, line_offset=None, progress=None):
+        """Open the stream over the internal file for decoding the region.
+
+        Arguments:
+        virtual_file -- SFSTreeItem of EDSDatabase/SpectrumData
+        line_offset -- uncompressed offset of the first line of
+            the region (see SpectrumIndex), if None the file is read
+            from the beginning (default None)
+        progress -- Progress instance (default None)
+
+        Returns:
+        dict with stream, pos and line arguments for iter_bands
+        """
+        if line_offset is None:
+            return {'stream': open_stream(virtual_file, progress=progress),
+                    'pos': 0x1A0, 'line': 0}
+        return {'stream': open_stream(virtual_file, line_offset,
+                                      progress=progress),
+                'pos': 0, 'line': self.region[0]}
+
+    def decode_file(self, virtual_file, out, line_offset=None,
+                    progress=None):
+        """Decode the region of the hypermap in internal file into
+        the given array of self.shape shape (line_offset and progress
+        are same as for open_region)."""
+        return self.decode_into(out=out, **self.open_region(virtual_file,
+                                                            line_offset,
+                                                            progress))
+
+    def split(self, n_bands):
+        """Split the region into up to n_bands bands of lines.
+
+        Bands are aligned to the downsampling factor, thus every line
+        of the decoded array is summed up from the lines of single band.
+
+        Returns:
+        list of (HypermapDecoder of the band, first output line)
+        """
+        y0, y1, x0, x1 = self.region
+        dwn = self.downsample
+        step = -(-self.shape[0] // n_bands)
+        return [(HypermapDecoder(self.height, self.width, self.max_chan,
+                                 downsample=dwn,
+                                 region=(y0 + i * dwn,
+                                         min(y1, y0 + (i + step) * dwn),
+                                         x0, x1),
+                                 chan_low=self.chan_low,
+                                 energy_bin=self.energy_bin), i)
+                for i in range(0, self.shape[0], step)]
+
+
+def check_region(region, height, width):
+    """Check and return the (y0, y1, x0, x1) region as tuple of ints.
+
+    None means the whole hypermap of given height and width.
+    ValueError is raised if region is empty or not inside the hypermap.
+    """
+    if region is None:
+        return 0, height, 0, width
+    y0, y1, x0, x1 = [int(i) for i in region]
+    if not (0 <= y0 < y1 <= height and 0 <= x0 < x1 <= width):
+        raise ValueError('region {0} is empty or not inside the hypermap '
+                         'of {1}x{2} pixels'.format(tuple(region), height,
+                                                    width))
+    return y0, y1, x0, x1
+
+
+def min_unsigned_dtype(max_value):
+    """return the smallest unsigned integer dtype holding max_value"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+class SparseHypermap(object):
+    """Sparse (CSR like) container of the hypermap.
+
+    Non-zero channels of every pixel are kept as channel indexes and
+    counts, pixels (in C order of (y, x)) are pointing to their
+    channels with the indptr array.
+
+    Arguments/Attributes:
+    shape -- (height, width, channels) of the dense hypermap
+    indptr -- int64 array of n_pixels + 1 values, channels and counts
+        of pixel i are at indptr[i]:indptr[i + 1]
+    channels -- channel indexes (uint16, or uint32 for more than
+        65536 channels)
+    counts -- counts of the channels (smallest fitting unsigned dtype)
+
+    Methods:
+    from_bands, pixel_spectrum, region_spectrum, window_maps,
+    downsample, to_dense, save, load
+    """
+
+    def __init__(self, shape, indptr, channels, counts):
+        self.shape = tuple(int(i) for i in shape)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.channels = channels
+        self.counts = counts
+
+    @property
+    def nnz(self):
+        """number of stored (non zero) channels"""
+        return len(self.channels)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.channels.nbytes + self.counts.nbytes
+
+    @classmethod
+    def from_keys(cls, shape, keys, values):
+        """Build the container from keys (pixel * channels + channel)
+        and values, keys can repeat (values are summed)."""
+        n_chan = shape[2]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        values = np.bincount(inverse, weights=values,
+                             minlength=len(keys)).astype(np.int64)
+        pixels, channels = np.divmod(keys, n_chan)
+        indptr = np.zeros(shape[0] * shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pixels, minlength=shape[0] * shape[1]),
+                  out=indptr[1:])
+        return cls._compact(shape, indptr, channels, values)
+
+    @classmethod
+    def _compact(cls, shape, indptr, channels, counts):
+        chan_dtype = np.uint16 if shape[2] <= 0x10000 else np.uint32
+        max_count = int(counts.max()) if len(counts) else 0
+        return cls(shape, indptr, channels.astype(chan_dtype),
+                   counts.astype(min_unsigned_dtype(max_count)))
+
+    @classmethod
+    def from_bands(cls, shape, bands):
+        """Build the container from the bands of dense hypermap
+        (i.e. HypermapDecoder.iter_bands generator), which are
+        expected to come in order of lines."""
+        n_chan = shape[2]
+        pixel_counts = np.zeros(shape[0] * shape[1], dtype=np.int64)
+        channels = []
+        counts = []
+        for out_first, band in bands:
+            flat = band.reshape(-1)
+            nonzero = np.flatnonzero(flat)
+            pixels, chans = np.divmod(nonzero, n_chan)
+            first_pixel = out_first * shape[1]
+            pixel_counts[first_pixel:first_pixel + band.shape[0] *
+                         shape[1]] = np.bincount(
+                pixels, minlength=band.shape[0] * shape[1])
+            channels.append(chans)
+            counts.append(flat[nonzero])
+        indptr = np.zeros(len(pixel_counts) + 1, dtype=np.int64)
+        np.cumsum(pixel_counts, out=indptr[1:])
+        empty = np.zeros(0, dtype=np.int64)
+        return cls._compact(shape, indptr,
+                            np.concatenate(channels) if channels else empty,
+                            np.concatenate(counts) if counts else empty)
+
+    def _region_entries(self, y0, y1, x0, x1):
+        """return indexes of stored channels of the pixels in region"""
+        pixels = (np.arange(y0, y1)[:, None] * self.shape[1] +
+                  np.arange(x0, x1)).ravel()
+        starts = self.indptr[pixels]
+        return _ranges(starts, self.indptr[pixels + 1] - starts)
+
+    def pixel_spectrum(self, y, x):
+        """return spectrum (int64 array) of the pixel"""
+        i = y * self.shape[1] + x
+        spectrum = np.zeros(self.shape[2], dtype=np.int64)
+        first, last = self.indptr[i], self.indptr[i + 1]
+        spectrum[self.channels[first:last]] = self.counts[first:last]
+        return spectrum
+
+    def region_spectrum(self, y0, y1, x0, x1):
+        """return sum spectrum (int64 array) of the rectangle region"""
+        entries = self._region_entries(y0, y1, x0, x1)
+        return np.bincount(self.channels[entries],
+                           weights=self.counts[entries],
+                           minlength=self.shape[2]).astype(np.int64)
+
+    def window_maps(self, windows):
+        """return the maps (int64 array of (n_windows, y, x) shape) of
+        counts in the channel windows, given as list of (first, last + 1)
+        channel ranges."""
+        n_pixels = self.shape[0] * self.shape[1]
+        pixels = np.repeat(np.arange(n_pixels), np.diff(self.indptr))
+        maps = np.zeros((len(windows), n_pixels), dtype=np.int64)
+        for i, (first, last) in enumerate(windows):
+            inside = (self.channels >= first) & (self.channels < last)
+            maps[i] = np.bincount(pixels[inside],
+                                  weights=self.counts[inside],
+                                  minlength=n_pixels)
+        return maps.reshape((len(windows),) + self.shape[:2])
+
+    def downsample(self, factor):
+        """return new SparseHypermap with factor x factor pixels summed"""
+        height, width, n_chan = self.shape
+        shape = (-(-height // factor), -(-width // factor), n_chan)
+        pixels = np.repeat(np.arange(height * width), np.diff(self.indptr))
+        y, x = np.divmod(pixels, width)
+        keys = ((y // factor) * shape[1] + x // factor) * n_chan +\
+            self.channels
+        return SparseHypermap.from_keys(shape, keys, self.counts)
+
+    def to_dense(self, dtype=None):
+        """return dense numpy array of (y, x, E) shape (default dtype is
+        dtype of counts)"""
+        if dtype is None:
+            dtype = self.counts.dtype
+        dense = np.zeros(self.shape[0] * self.shape[1] * self.shape[2],
+                         dtype=dtype)
+        pixels = np.repeat(np.arange(self.shape[0] * self.shape[1]),
+                           np.diff(self.indptr))
+        dense[pixels * self.shape[2] + self.channels] = self.counts
+        return dense.reshape(self.shape)
+
+    def save(self, filename):
+        """save the container into numpy .npz file"""
+        np.savez(filename, shape=np.array(self.shape), indptr=self.indptr,
+                 channels=self.channels, counts=self.counts)
+
+    @classmethod
+    def load(cls, filename):
+        """load the container saved with save method"""
+        with np.load(filename) as npz:
+            return cls(npz['shape'], npz['indptr'], npz['channels'],
+                       npz['counts'])
+
+
+def _expand_key(key, ndim):
+    """return basic index (ints and slices only) as tuple of ndim
+    items, or None if index is not basic"""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if key.count(Ellipsis) > 1:
+        return None
+    if Ellipsis in key:
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    if len(key) > ndim:
+        return None
+    for k in key:
+        if not isinstance(k, (slice, int, np.integer)):
+            return None
+    return key + (slice(None),) * (ndim - len(key))
+
+
+class CompactHypermap(object):
+    """Compact storage of the hypermap with exact counts.
+
+    Counts are stored in the array of small unsigned dtype (base), the
+    rare larger values are saturated in the base and kept exactly in
+    sparse overflow table (flat indexes and values). The dtype of base
+    is chosen by the data: it starts from the given dtype (default
+    uint8) and is promoted only when overflow table would take more
+    memory than the base of larger dtype.
+
+    Indexing (with ints and slices) returns numpy array with exact
+    counts, and numpy.asarray (or to_dense) gives the whole array.
+
+    Arguments/Attributes:
+    base -- array of (y, x, E) shape with saturated counts
+    overflow_index -- sorted flat indexes of the saturated elements
+    overflow_values -- exact values of the saturated elements
+
+    Methods:
+    from_bands, to_dense
+    """
+
+    # bytes taken by one entry of overflow table:
+    _entry_bytes = 16
+
+    def __init__(self, base, overflow_index=None, overflow_values=None):
+        self.base = base
+        if overflow_index is None:
+            overflow_index = np.zeros(0, dtype=np.int64)
+            overflow_values = np.zeros(0, dtype=np.int64)
+        self.overflow_index = overflow_index
+        self.overflow_values = overflow_values
+
+    @property
+    def shape(self):
+        return self.base.shape
+
+    @property
+    def ndim(self):
+        return self.base.ndim
+
+    @property
+    def dtype(self):
+        """the smallest unsigned dtype holding the exact counts"""
+        if len(self.overflow_values) == 0:
+            return self.base.dtype
+        return min_unsigned_dtype(int(self.overflow_values.max()))
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.overflow_index.nbytes +\
+            self.overflow_values.nbytes
+
+    @classmethod
+    def from_bands(cls, shape, bands, dtype=np.uint8):
+        """Build the storage from the bands of dense hypermap
+        (i.e. HypermapDecoder.iter_bands generator)."""
+        base = np.zeros(shape, dtype=dtype)
+        line = shape[1] * shape[2]
+        index = []
+        values = []
+        n_overflow = 0
+        for out_first, band in bands:
+            out_last = out_first + band.shape[0]
+            limit = np.iinfo(base.dtype).max
+            over = np.flatnonzero(band > limit)
+            if over.size == 0:
+                base[out_first:out_last] = band
+                continue
+            base[out_first:out_last] = np.minimum(band, limit)
+            index.append(over + out_first * line)
+            values.append(band.reshape(-1)[over])
+            n_overflow += over.size
+            while (base.dtype != np.uint64 and
+                   n_overflow * cls._entry_bytes > base.size *
+                   base.dtype.itemsize):
+                # the larger base is cheaper than the overflow table:
+                index = [np.concatenate(index)]
+                values = [np.concatenate(values)]
+                base = base.astype(min_unsigned_dtype(limit + 1))
+                limit = np.iinfo(base.dtype).max
+                base.reshape(-1)[index[0]] = np.minimum(values[0], limit)
+                over = values[0] > limit
+                index = [index[0][over]]
+                values = [values[0][over]]
+                n_overflow = len(index[0])
+        if n_overflow:
+            values = np.concatenate(values)
+            return cls(base, np.concatenate(index),
+                       values.astype(min_unsigned_dtype(int(values.max()))))
+        return cls(base)
+
+    def to_dense(self, dtype=None):
+        """return dense numpy array with exact counts (default dtype is
+        the smallest holding the counts)"""
+        dense = self.base.astype(self.dtype if dtype is None else dtype)
+        dense.reshape(-1)[self.overflow_index] = self.overflow_values
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype)
+
+    def __getitem__(self, key):
+        basic_key = _expand_key(key, self.ndim)
+        if basic_key is None:
+            return self.to_dense()[key]
+        result = self.base[key].astype(self.dtype)
+        if len(self.overflow_index) == 0:
+            return result
+        coords = np.unravel_index(self.overflow_index, self.shape)
+        inside = np.ones(len(self.overflow_index), dtype=bool)
+        positions = []
+        for size, c, k in zip(self.shape, coords, basic_key):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                shift = c - start
+                if step > 0:
+                    inside &= (shift >= 0) & (c < stop)
+                else:
+                    inside &= (shift <= 0) & (c > stop)
+                inside &= shift % step == 0
+                positions.append(shift // step)
+            else:
+                inside &= c == (k + size if k < 0 else k)
+        if np.ndim(result) == 0:
+            return self.overflow_values[inside][0] if inside.any() \
+                else result
+        result[tuple(p[inside] for p in positions)] =\
+            self.overflow_values[inside]
+        return result
+
+
+class CovarianceAccumulator(object):
+    """Streaming accumulator of the mean spectrum and the channel by
+    channel covariance of spectra, fed with batches of spectra (i.e.
+    the bands of HypermapDecoder.iter_bands) in single pass.
+
+    The sum of spectra and the sum of their cross products (float64)
+    are accumulated, thus only arrays of (channels, channels) size are
+    kept. Spectra of the hypermap are sparse (the pixel has few counts),
+    so the cross products are summed only over the pairs of non zero
+    channels of every spectrum, unless the batch is dense enough for
+    the matrix product to be faster.
+
+    With Poisson scaling (same as normalize_poissonian_noise of hyperspy)
+    spectra are divided by the square root of their total counts and of
+    the sum spectrum. The pixel part is applied to every spectrum as it
+    is added, and the channel part (sum spectrum is known only at the
+    end) is applied to the mean and the covariance when they are read.
+
+    Arguments:
+    n_channels -- number of channels of spectra
+    poisson -- scale the spectra for Poisson noise (default False)
+
+    Attributes:
+    count -- number of added spectra
+    sum_spectrum -- sum of added (not scaled) spectra
+
+    Methods:
+    add, channel_scale, mean, covariance, decompose, transform
+    """
+
+    # cost of the pair of channels summed with np.add.at relative to
+    # multiply-add of the matrix product:
+    sparse_cost = 32
+
+    def __init__(self, n_channels, poisson=False):
+        self.n_channels = n_channels
+        self.poisson = poisson
+        self.count = 0
+        self.sum_spectrum = np.zeros(n_channels, dtype=np.float64)
+        self._sum = np.zeros(n_channels, dtype=np.float64)
+        self._cross = np.zeros((n_channels, n_channels), dtype=np.float64)
+
+    @staticmethod
+    def _inverse_sqrt(values):
+        """return 1 / sqrt(values), where zeros are kept at 1"""
+        scale = np.ones(values.shape, dtype=np.float64)
+        nonzero = values > 0
+        scale[nonzero] = 1. / np.sqrt(values[nonzero])
+        return scale
+
+    def _pixel_scaled(self, spectra):
+        spectra = np.asarray(spectra).reshape(-1, self.n_channels)
+        scaled = spectra.astype(np.float64)
+        if self.poisson:
+            scaled *= self._inverse_sqrt(scaled.sum(axis=1))[:, None]
+        return spectra, scaled
+
+    def _add_pairs(self, pixel, channel, values):
+        """sum the cross products of non zero channels (pixel sorted
+        coordinates and values) of every spectrum"""
+        group = np.bincount(pixel)[pixel]  # non zero channels of pixel
+        first = np.cumsum(group) - group
+        left = np.repeat(np.arange(len(pixel)), group)
+        right = np.arange(len(left)) - np.repeat(first, group) +\
+            np.repeat(np.searchsorted(pixel, pixel), group)
+        np.add.at(self._cross.reshape(-1),
+                  channel[left] * self.n_channels + channel[right],
+                  values[left] * values[right])
+
+    def add(self, spectra):
+        """add the batch of spectra (array with channels at last axis)"""
+        spectra, scaled = self._pixel_scaled(spectra)
+        n_batch = len(scaled)
+        if n_batch == 0:
+            return
+        self.sum_spectrum += spectra.sum(axis=0)
+        self._sum += scaled.sum(axis=0)
+        self.count += n_batch
+        pixel, channel = np.nonzero(scaled)
+        pairs = np.cumsum(np.bincount(pixel, minlength=n_batch) ** 2)
+        if pairs[-1] * self.sparse_cost >= n_batch * self.n_channels ** 2:
+            self._cross += np.dot(scaled.T, scaled)
+            return
+        values = scaled[pixel, channel]
+        # pixels are split to limit the memory of pairs:
+        bounds = np.searchsorted(pixel, np.searchsorted(
+            pairs, np.arange(BAND_ELEMENTS, pairs[-1], BAND_ELEMENTS)))
+        for nz in np.split(np.arange(len(pixel)), bounds):
+            if len(nz):
+                self._add_pairs(pixel[nz], channel[nz], values[nz])
+
+    def channel_scale(self):
+        """return the scale of channels (ones if not Poisson scaled)"""
+        if self.poisson:
+            return self._inverse_sqrt(self.sum_spectrum)
+        return np.ones(self.n_channels, dtype=np.float64)
+
+    def mean(self):
+        """return the mean of (scaled) spectra"""
+        return self._sum / max(self.count, 1) * self.channel_scale()
+
+    def covariance(self, ddof=1):
+        """return the covariance matrix of (scaled) channels"""
+        if self.count <= ddof:
+            raise ValueError('{0} spectra are not enough for the '
+                             'covariance'.format(self.count))
+        mean = self._sum / self.count
+        scale = self.channel_scale()
+        covariance = self._cross - np.outer(mean, self._sum)
+        covariance /= self.count - ddof
+        covariance *= np.outer(scale, scale)
+        return covariance
+
+    def decompose(self, n_components=None):
+        """Return the principal components of accumulated spectra.
+
+        Arguments:
+        n_components -- number of components (default None -- all)
+
+        Returns:
+        (explained variance of components in descending order,
+        array of (n_components, channels) shape with the components)
+        """
+        variance, vectors = np.linalg.eigh(self.covariance())
+        order = np.argsort(variance)[::-1][:n_components]
+        components = vectors[:, order].T
+        # sign of components is arbitrary, make the largest loading
+        # positive to get reproducible scores:
+        flip = components[np.arange(len(order)),
+                          np.abs(components).argmax(axis=1)] < 0
+        components[flip] *= -1
+        return np.maximum(variance[order], 0), components
+
+    def transform(self, spectra, components):
+        """Return the scores of spectra (scaled and centered same as
+        accumulated ones) on the components, with channels at last
+        axis replaced by components."""
+        shape = np.shape(spectra)[:-1]
+        scaled = self._pixel_scaled(spectra)[1]
+        scaled *= self.channel_scale()
+        scaled -= self.mean()
+        return np.dot(scaled, components.T).reshape(shape + (-1,))
+
+
+def unsigned_dtype(dtype):
+    """return unsigned counterpart of integer dtype"""
+    return np.dtype(np.dtype(dtype).str.replace('i', 'u'))
+
+
+def open_stream(virtual_file, offset=0, chunk_size=524288, progress=None):
+    """Return DataStream over the internal file (SFSTreeItem)
+    starting at the given uncompressed offset (progress is passed
+    to DataStream)."""
+    if offset == 0:
+        blocks = virtual_file.get_iter_and_properties(
+            as_memoryview=True, larger_chunks=chunk_size)[0]
+    else:
+        raw = virtual_file.open(buffering=0)
+        raw.seek(offset)
+        blocks = iter(lambda: raw.read(chunk_size), b'')
+    return DataStream(blocks, offset, progress=progress)
+
+
+def map_dimensions(virtual_file):
+    """return (height, width) of the hypermap in SpectrumData file"""
+    with virtual_file.open() as fh:
+        return _map_head.unpack(fh.read(8))
+
+
+def region_line_offset(spectrum_index, line):
+    """return offset of the line from SpectrumIndex (or None if index
+    is None or line is the first line)"""
+    if spectrum_index is None or line == 0:
+        return None
+    return int(spectrum_index.lines[line])
+
+
+def make_decoder(virtual_file, downsample=1, cutoff=None, index=0,
+                 region=None, chan_low=0, energy_bin=1):
+    """Return (HypermapDecoder, dtype) for the hypermap in internal file
+    (arguments are same as for parse_to_numpy)."""
+    header = virtual_file.sfs.header
+    if type(cutoff) == int:
+        max_chan = cutoff
+    else:
+        max_chan = header.estimate_map_channels(index=index)
+    # same dtype as used by pure python decoder:
+    dtype = unsigned_dtype(header.estimate_map_depth(index=index,
+                                                     downsample=downsample,
+                                                     for_numpy=True,
+                                                     energy_bin=energy_bin))
+    height, width = map_dimensions(virtual_file)
+    decoder = HypermapDecoder(height, width, max_chan, downsample=downsample,
+                              region=region, chan_low=chan_low,
+                              energy_bin=energy_bin)
+    return decoder, dtype
+
+
+def parse_to_numpy(virtual_file, downsample=1, cutoff=None,
+                   description=False, index=0, region=None,
+                   spectrum_index=None, chan_low=0, energy_bin=1,
+                   progress=None):
+    """Decode the bcf hypermap into numpy array.
+
+    Mirrors parse_to_numpy from unbcf_fast (cython) library.
+
+    Arguments:
+    virtual_file -- SFSTreeItem of EDSDatabase/SpectrumData
+    downsample -- downsampling factor (integer, default 1)
+    cutoff -- channel to truncate the energy axis at (default None)
+    description -- if True, return only (shape, dtype) (default False)
+    index -- index of the hypermap (default 0)
+    region -- (y0, y1, x0, x1) rectangle to decode (default None)
+    spectrum_index -- SpectrumIndex of the hypermap, if given the lines
+        before region are not read at all (default None)
+    chan_low -- channels below are dropped (default 0)
+    energy_bin -- number of adjacent channels summed together (default 1)
+    progress -- Progress instance to report the progress to and to
+        cancel the decoding (default None)
+
+    Returns:
+    numpy array of (y, x, E) shape, or (shape, dtype) if description.
+    """
+    decoder, dtype = make_decoder(virtual_file, downsample=downsample,
+                                  cutoff=cutoff, index=index, region=region,
+                                  chan_low=chan_low, energy_bin=energy_bin)
+    if description:
+        return decoder.shape, dtype
+    return decoder.decode_file(
+        virtual_file, np.zeros(decoder.shape, dtype=dtype),
+        line_offset=region_line_offset(spectrum_index, decoder.region[0]),
+        progress=progress)
@@ -21,11 +21,15 @@
 #  this library.
 
 import io
+import mmap
 from datetime import datetime, timedelta
 import numpy as np
 from struct import unpack as strct_unp
 import json  # can be replaced with pprint
 
+import logging
+_logger = logging.getLogger(__name__)
+
 
 class SFSTreeItem(object):
     """Class to manage one internal sfs file.
@@ -84,25 +88,26 @@ class SFSTreeItem(object):
         # table size in number of chunks:
         n_of_chunks = -(-self.size_in_chunks //
                         (self.sfs.usable_chunk // 4))
-        with open(self.sfs.filename, 'rb') as fn:
-            if n_of_chunks > 1:
-                next_chunk = self._pointer_to_pointer_table
-                temp_string = io.BytesIO()
-                for dummy1 in range(n_of_chunks):
-                    fn.seek(self.sfs.chunksize * next_chunk + 0x118)
-                    next_chunk = strct_unp('<I', fn.read(4))[0]
-                    fn.seek(28, 1)
-                    temp_string.write(fn.read(self.sfs.usable_chunk))
-                temp_string.seek(0)
-                temp_table = temp_string.read()
-                temp_string.close()
-            else:
-                fn.seek(self.sfs.chunksize *
-                        self._pointer_to_pointer_table + 0x138)
-                temp_table = fn.read(self.sfs.usable_chunk)
-            self.pointers = np.fromstring(
-                temp_table[:self.size_in_chunks * 4],
-                dtype='uint32').astype(np.int64) * self.sfs.chunksize + 0x138
+        view = self.sfs._view
+        if n_of_chunks > 1:
+            next_chunk = self._pointer_to_pointer_table
+            temp_table = []
+            for dummy1 in range(n_of_chunks):
+                chunk_addr = self.sfs.chunksize * next_chunk + 0x118
+                next_chunk = strct_unp('<I',
+                                       view[chunk_addr:chunk_addr + 4])[0]
+                temp_table.append(
+                    view[chunk_addr + 32:
+                         chunk_addr + 32 + self.sfs.usable_chunk])
+            temp_table = b''.join(temp_table)
+            table_offset = 0
+        else:
+            temp_table = view
+            table_offset = self.sfs.chunksize *\
+                self._pointer_to_pointer_table + 0x138
+        self.pointers = np.frombuffer(
+            temp_table, dtype='<u4', count=self.size_in_chunks,
+            offset=table_offset).astype(np.int64) * self.sfs.chunksize + 0x138
 
     def read_piece(self, offset, length):
         """Read and returns raw byte string of the file without applying
@@ -115,9 +120,11 @@ class SFSTreeItem(object):
 
         Returns:
         ----------
-        io.ByteIO object
+        memoryview of the memory mapped container if the piece resides
+        inside single sfs chunk (no copy is made), else memoryview
+        of the bytes assembled from the pieces of spanned chunks.
         """
-        data = io.BytesIO()
+        view = self.sfs._view
         # first block index:
         fb_idx = offset // self.sfs.usable_chunk
         # first block offset:
@@ -126,23 +133,19 @@ class SFSTreeItem(object):
         lb_idx = (offset + length) // self.sfs.usable_chunk
         # last block cut off:
         lbco = (offset + length) % self.sfs.usable_chunk
-        with open(self.sfs.filename, 'rb') as fn:
-            if fb_idx != lb_idx:
-                fn.seek(self.pointers[fb_idx] + fbo)
-                data.write(fn.read(self.sfs.usable_chunk - fbo))
-                for i in self.pointers[fb_idx + 1:lb_idx]:
-                    fn.seek(i)
-                    data.write(fn.read(self.sfs.usable_chunk))
-                if lbco > 0:
-                    fn.seek(self.pointers[lb_idx])
-                    data.write(fn.read(lbco))
-            else:
-                fn.seek(self.pointers[fb_idx] + fbo)
-                data.write(fn.read(length))
-        data.seek(0)
-        return data.read()
-
-    def _iter_read_chunks(self, first=0, chunks=False):
+        if fb_idx == lb_idx or (lb_idx == fb_idx + 1 and lbco == 0):
+            start = self.pointers[fb_idx] + fbo
+            return view[start:start + length]
+        data = [view[self.pointers[fb_idx] + fbo:
+                     self.pointers[fb_idx] + self.sfs.usable_chunk]]
+        for i in self.pointers[fb_idx + 1:lb_idx]:
+            data.append(view[i:i + self.sfs.usable_chunk])
+        if lbco > 0:
+            data.append(view[self.pointers[lb_idx]:
+                             self.pointers[lb_idx] + lbco])
+        return memoryview(b''.join(data))
+
+    def _iter_read_chunks(self, first=0, chunks=False, as_memoryview=False):
         """Generate and return iterator for reading and returning
         sfs internal file in chunks.
 
@@ -153,24 +156,30 @@ class SFSTreeItem(object):
         Keyword arguments:
         first -- the index of first chunk from which to read. (default 0)
         chunks -- the number of chunks to read. (default False)
+        as_memoryview -- yield zero-copy memoryview slices of memory
+            mapped container instead of bytes. (default False)
         """
         if not chunks:
             last = self.size_in_chunks
         else:
             last = chunks + first
-        with open(self.sfs.filename, 'rb') as fn:
-            for idx in range(first, last - 1):
-                fn.seek(self.pointers[idx])
-                yield fn.read(self.sfs.usable_chunk)
-            fn.seek(self.pointers[last - 1])
-            if last == self.size_in_chunks:
-                last_stuff = self.size % self.sfs.usable_chunk
-                if last_stuff != 0:
-                    yield fn.read(last_stuff)
-                else:
-                    yield fn.read(self.sfs.usable_chunk)
+        if as_memoryview:
+            container = self.sfs._view
+        else:
+            container = self.sfs._mmap
+        usable_chunk = self.sfs.usable_chunk
+        for idx in range(first, last - 1):
+            pointer = self.pointers[idx]
+            yield container[pointer:pointer + usable_chunk]
+        pointer = self.pointers[last - 1]
+        if last == self.size_in_chunks:
+            last_stuff = self.size % usable_chunk
+            if last_stuff != 0:
+                yield container[pointer:pointer + last_stuff]
             else:
-                yield fn.read(self.sfs.usable_chunk)
+                yield container[pointer:pointer + usable_chunk]
+        else:
+            yield container[pointer:pointer + usable_chunk]
 
     def setup_compression_metadata(self):
         """ parse and setup the number of compression chunks
@@ -179,10 +188,9 @@ class SFSTreeItem(object):
         Sets up attributes:
         self.uncompressed_blk_size, self.no_of_compr_blk
         """
-        with open(self.sfs.filename, 'rb') as fn:
-            fn.seek(self.pointers[0])
-            # AACS signature, uncompressed size, undef var, number of blocks
-            aacs, uc_size, _, n_of_blocks = strct_unp('<IIII', fn.read(16))
+        # AACS signature, uncompressed size, undef var, number of blocks
+        aacs, uc_size, _, n_of_blocks = strct_unp('<IIII',
+                                                  self.read_piece(0, 16))
         if aacs == 0x53434141:  # AACS as string
             self.uncompressed_blk_size = uc_size
             self.no_of_compr_blk = n_of_blocks
@@ -202,12 +210,12 @@ but compression signature is missing in the header. Aborting....""")
         for dummy1 in range(chunks - 1):
             raw_string = self.read_piece(offset, chunk_size)
             offset += chunk_size
-            yield raw_string
+            yield bytes(raw_string)
         if last_chunk != 0:
             raw_string = self.read_piece(offset, last_chunk)
         else:
             raw_string = self.read_piece(offset, chunk_size)
-        yield raw_string
+        yield bytes(raw_string)
 
     def _iter_read_compr_chunks(self):
         """Generate and return iterator for compressed file with
@@ -232,18 +240,26 @@ but compression signature is missing in the header. Aborting....""")
             offset += cpr_size
             yield unzip_block(raw_string)
 
-    def get_iter_and_properties(self, larger_chunks=False):
+    def get_iter_and_properties(self, larger_chunks=False,
+                                as_memoryview=False):
         """Get the the iterator and properties of its chunked size and
         number of chunks for compressed or not compressed data
         accordingly.
+
+        Keyword arguments:
+        larger_chunks -- size of not compressed chunks to be returned
+            instead of sfs chunks (default False)
+        as_memoryview -- if True, not compressed sfs chunks are returned
+            as zero-copy memoryview slices of memory mapped container,
+            else as bytes (default False)
         ----------
         Returns:
             (iterator, chunk_size, number_of_chunks)
         """
         if self.sfs.compression == 'None':
             if not larger_chunks:
-                return self._iter_read_chunks(), self.sfs.usable_chunk,\
-                   self.size_in_chunks
+                return self._iter_read_chunks(as_memoryview=as_memoryview),\
+                    self.sfs.usable_chunk, self.size_in_chunks
             else:
                 return self._iter_read_larger_chunks(chunk_size=larger_chunks),\
                     larger_chunks, -(-self.size // larger_chunks)
@@ -284,49 +300,92 @@ class SFS_reader(object):
 
     def __init__(self, filename):
         self.filename = filename
-        with open(filename, 'rb') as fn:
-            a = fn.read(8)
-            if a != b'AAMVHFSS':
-                raise TypeError(
-                    "file '{0}' is not SFS container".format(filename))
-            fn.seek(0x124)  # this looks to be version, as float value is always
-            # nicely rounded and at older bcf versions (<1.9) it was 2.40,
-            # at new (v2) - 2.60
-            version, self.chunksize = strct_unp('<fI', fn.read(8))
-            self.sfs_version = '{0:4.2f}'.format(version)
-            self.usable_chunk = self.chunksize - 32
-            fn.seek(0x140)
-            #the sfs tree and number of the items / files + directories in it,
-            #and the number in chunks of whole sfs:
-            self.tree_address, self.n_tree_items, self.sfs_n_of_chunks =\
-                                                 strct_unp('<III', fn.read(12))
+        # the whole container is memory mapped once and all internal
+        # files are read as slices of that mapping:
+        self._open_mapping()
+        view = self._view
+        if view[:8] != b'AAMVHFSS':
+            raise TypeError(
+                "file '{0}' is not SFS container".format(filename))
+        # this looks to be version, as float value is always
+        # nicely rounded and at older bcf versions (<1.9) it was 2.40,
+        # at new (v2) - 2.60
+        version, self.chunksize = strct_unp('<fI', view[0x124:0x12C])
+        self.sfs_version = '{0:4.2f}'.format(version)
+        self.usable_chunk = self.chunksize - 32
+        #the sfs tree and number of the items / files + directories in it,
+        #and the number in chunks of whole sfs:
+        self.tree_address, self.n_tree_items, self.sfs_n_of_chunks =\
+            strct_unp('<III', view[0x140:0x14C])
         self._setup_vfs()
 
-    def _setup_vfs(self):
+    def _open_mapping(self):
+        """memory map the sfs container (read only)"""
         with open(self.filename, 'rb') as fn:
-            #check if file tree do not exceed one chunk:
-            n_file_tree_chunks = -((-self.n_tree_items * 0x200) //
-                                             (self.chunksize - 512))
-            if n_file_tree_chunks is 1:
-                fn.seek(self.chunksize * self.tree_address + 0x138)
-                raw_tree = fn.read(0x200 * self.n_tree_items)
-            else:
-                temp_str = io.BytesIO()
-                for i in range(n_file_tree_chunks):
-                    # jump to tree/list address:
-                    fn.seek(self.chunksize * self.tree_address + 0x118)
-                    # next tree/list address:
-                    self.tree_address = strct_unp('<I', fn.read(4))[0]
-                    fn.seek(28, 1)
-                    temp_str.write(fn.read(self.chunksize - 512))
-                temp_str.seek(0)
-                raw_tree = temp_str.read(self.n_tree_items * 0x200)
-                temp_str.close()
-            # temp flat list of items:
-            temp_item_list = [SFSTreeItem(raw_tree[i * 0x200:(i + 1) * 0x200],
-                                       self) for i in range(self.n_tree_items)]
-            # temp list with parents of items
-            paths = [[h.parent] for h in temp_item_list]
+            self._mmap = mmap.mmap(fn.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def close(self):
+        """release the memory mapping of the sfs container.
+
+        If memoryview slices handed out by internal files are still
+        alive, the mapping can't be closed: the reader is left open
+        and usable (close can be called again after the slices are
+        released), and the mapping with its file handle is released
+        with the last reference.
+
+        Returns:
+        True if the mapping was closed, else False
+        """
+        if self._mmap.closed:
+            return True
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # keep the reader consistent -- both view and mapping open:
+            self._view = memoryview(self._mmap)
+            _logger.warning('sfs container mapping of %s is still in use '
+                            'and was not closed, the file stays open until '
+                            'the last slice of it is released',
+                            self.filename)
+            return False
+        return True
+
+    def __getstate__(self):
+        # mmap can't be pickled, it is reopened after unpickling
+        state = self.__dict__.copy()
+        del state['_mmap'], state['_view']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_mapping()
+
+    def _setup_vfs(self):
+        view = self._view
+        #check if file tree do not exceed one chunk:
+        n_file_tree_chunks = -((-self.n_tree_items * 0x200) //
+                                         (self.chunksize - 512))
+        if n_file_tree_chunks == 1:
+            tree_start = self.chunksize * self.tree_address + 0x138
+            raw_tree = view[tree_start:tree_start + 0x200 * self.n_tree_items]
+        else:
+            temp_str = []
+            for i in range(n_file_tree_chunks):
+                # jump to tree/list address:
+                chunk_addr = self.chunksize * self.tree_address + 0x118
+                # next tree/list address:
+                self.tree_address = strct_unp(
+                    '<I', view[chunk_addr:chunk_addr + 4])[0]
+                temp_str.append(view[chunk_addr + 32:
+                                     chunk_addr + 32 + self.chunksize - 512])
+            raw_tree = b''.join(temp_str)[:self.n_tree_items * 0x200]
+        # temp flat list of items:
+        temp_item_list = [SFSTreeItem(raw_tree[i * 0x200:(i + 1) * 0x200],
+                                   self) for i in range(self.n_tree_items)]
+        # temp list with parents of items
+        paths = [[h.parent] for h in temp_item_list]
         #checking the compression header which can be different per file:
         self._check_the_compresion(temp_item_list)
         if self.compression in ('zlib', 'bzip2'):
@@ -371,25 +430,22 @@ class SFS_reader(object):
     def _check_the_compresion(self, temp_item_list):
         """parse, check and setup the self.compression"""
 
-        with open(self.filename, 'rb') as fn:
-            #Find if there is compression:
-            for c in temp_item_list:
-                if not c.is_dir:
-                    fn.seek(c.pointers[0])
-                    if fn.read(4) == b'\x41\x41\x43\x53':  # string AACS
-                        fn.seek(0x8C, 1)
-                        compression_head = fn.read(2)
-                        byte_one = strct_unp('BB', compression_head)[0]
-                        if byte_one == 0x78:
-                            self.compression = 'zlib'
-                        elif compression_head == b'\x42\x5A':
-                            self.compression = 'bzip2'
-                        else:
-                            self.compression = 'unknown'
+        #Find if there is compression:
+        for c in temp_item_list:
+            if not c.is_dir:
+                if c.read_piece(0, 4) == b'\x41\x41\x43\x53':  # string AACS
+                    compression_head = c.read_piece(0x90, 2)
+                    byte_one = strct_unp('BB', compression_head)[0]
+                    if byte_one == 0x78:
+                        self.compression = 'zlib'
+                    elif compression_head == b'\x42\x5A':
+                        self.compression = 'bzip2'
                     else:
-                        self.compression = 'None'
-                    # compression is global, can't be diferent per file in sfs
-                    break
+                        self.compression = 'unknown'
+                else:
+                    self.compression = 'None'
+                # compression is global, can't be diferent per file in sfs
+                break
 
     def print_file_tree(self):
         """print the internal file/dir tree of sfs container
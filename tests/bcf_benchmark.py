@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Benchmark of bcf hypermap decoders on synthetic files (sfs_writer).
+#  Every decoder is timed on every case (packing of pixels and
+#  compression) and its result is checked against the hypermap which
+#  was written into the file. Run from the root of the project:
+#
+#  python -m tests.bcf_benchmark --height 64 --width 80
+#
+#  With --header the parsing of large (v2) xml header with many
+#  SpectrumData indexes (HyperHeader) is measured instead.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from lib.parsers import bcf_hype
+from lib.parsers import unbcf_numpy
+
+from . import sfs_writer
+
+# name: (write_bcf flags_mix, compression)
+default_cases = {
+    '16bit': ((1, 0, 0), None),
+    '12bit': ((0, 1, 0), None),
+    'instructed': ((0, 0, 1), None),
+    'mixed': ((1, 1, 1), None),
+    'mixed+zlib': ((1, 1, 1), 'zlib'),
+}
+
+
+def default_decoders(workers=2):
+    """return dict of name: function(BCF_reader, index) -> array
+    of available decoders"""
+    def numpy_backend(reader, index):
+        return unbcf_numpy.parse_to_numpy(
+            reader.get_file('EDSDatabase/SpectrumData' + str(index)),
+            index=index)
+
+    decoders = {'py_parse_hypermap':
+                lambda reader, index: reader.py_parse_hypermap(index=index)}
+    if bcf_hype.fast_unbcf:
+        def fast_backend(reader, index):
+            return bcf_hype.unbcf_fast.parse_to_numpy(
+                reader.get_file('EDSDatabase/SpectrumData' + str(index)),
+                index=index)
+        decoders['unbcf_fast'] = fast_backend
+    decoders['unbcf_numpy'] = numpy_backend
+    decoders['parallel_parse_hypermap'] = \
+        lambda reader, index: reader.parallel_parse_hypermap(index=index,
+                                                             workers=workers)
+    decoders['lazy_parse_hypermap'] = \
+        lambda reader, index: reader.lazy_parse_hypermap(index=index).compute()
+    return decoders
+
+
+def run_benchmark(height=64, width=80, chans=4096, dwell=50, cases=None,
+                  decoders=None, repeat=3, chunksize=4096, directory=None):
+    """Write the synthetic bcf of every case and time every decoder.
+
+    Arguments:
+    height, width, chans, dwell -- parameters of the synthetic
+        hypermap (see sfs_writer.write_bcf)
+    cases -- dict of name: (flags_mix, compression)
+        (default default_cases)
+    decoders -- dict of name: function(BCF_reader, index) -> array
+        (default default_decoders())
+    repeat -- number of runs, the fastest one is reported (default 3)
+    chunksize -- sfs chunk size (default 4096)
+    directory -- where synthetic files are written (default None --
+        temporary directory, removed at the end)
+
+    Returns:
+    list of dicts with keys: case, decoder, seconds, mb_per_s
+        (uncompressed hypermap data per second), pixels_per_s,
+        correct (result is equal to the written hypermap)
+    """
+    if cases is None:
+        cases = default_cases
+    if decoders is None:
+        decoders = default_decoders()
+    tmp_dir = None
+    if directory is None:
+        directory = tmp_dir = tempfile.mkdtemp(prefix='bcf_benchmark')
+    results = []
+    try:
+        for case, (flags_mix, compression) in cases.items():
+            filename = os.path.join(directory, case + '.bcf')
+            reference = sfs_writer.write_bcf(filename, height=height,
+                                             width=width, chans=chans,
+                                             compression=compression,
+                                             chunksize=chunksize,
+                                             flags_mix=flags_mix,
+                                             dwell=dwell)[0]
+            reader = bcf_hype.BCF_reader(filename, index_cache=False)
+            index = reader.def_index
+            # decoders truncate the energy axis at HV:
+            reference = reference[:, :, :reader.header.estimate_map_channels(
+                index=index)]
+            data_size = int(reader.get_spectrum_index(index).lines[-1])
+            for name, decoder in decoders.items():
+                best = None
+                for i in range(repeat):
+                    # spectrum index is not reused between the runs:
+                    reader.spectrum_index.clear()
+                    start = time.perf_counter()
+                    hypermap = decoder(reader, index)
+                    seconds = time.perf_counter() - start
+                    best = seconds if best is None else min(best, seconds)
+                # values overflowing the dtype wrap same as in decoders:
+                correct = hypermap.shape == reference.shape and \
+                    np.array_equal(hypermap, reference.astype(hypermap.dtype))
+                results.append({'case': case, 'decoder': name,
+                                'seconds': best,
+                                'mb_per_s': data_size / best / 1e6,
+                                'pixels_per_s': height * width / best,
+                                'correct': correct})
+            reader.close()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def run_header_benchmark(n_indexes=32, height=512, width=512, chans=4096,
+                         planes=4, repeat=3):
+    """Time HyperHeader on the synthetic xml header.
+
+    Arguments:
+    n_indexes -- number of SpectrumData indexes (sum spectra)
+        (default 32)
+    height, width, planes -- size and number of image planes
+        (default 512, 512, 4)
+    chans -- number of channels of sum spectra (default 4096)
+    repeat -- number of runs, the fastest one is reported (default 3)
+
+    Returns:
+    dict with keys: size (of xml in bytes), seconds (parsing of header),
+        metadata_seconds (making all metadata dictionaries after parsing)
+    """
+    rng = np.random.RandomState(0)
+    sums = [rng.randint(0, 10 ** 7, chans) for i in range(n_indexes)]
+    xml = sfs_writer.make_header_xml(height, width, chans, sums,
+                                     planes=planes)
+    indexes = list(range(n_indexes))
+    best = best_metadata = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        header = bcf_hype.HyperHeader(xml, indexes)
+        middle = time.perf_counter()
+        header.sem_metadata, header.stage_metadata, header.dsp_metadata
+        for spectrum in header.spectra_data.values():
+            spectrum.hardware_metadata, spectrum.detector_metadata
+            spectrum.esma_metadata, spectrum.spectrum_metadata
+        end = time.perf_counter()
+        if best is None or middle - start < best:
+            best = middle - start
+        if best_metadata is None or end - middle < best_metadata:
+            best_metadata = end - middle
+    return {'size': len(xml), 'seconds': best,
+            'metadata_seconds': best_metadata}
+
+
+def format_results(results):
+    """return the results as text table"""
+    lines = ['{0:<12} {1:<24} {2:>9} {3:>9} {4:>12} {5}'.format(
+        'case', 'decoder', 'seconds', 'MB/s', 'pixels/s', 'correct')]
+    for r in results:
+        lines.append('{case:<12} {decoder:<24} {seconds:>9.3f} '
+                     '{mb_per_s:>9.2f} {pixels_per_s:>12.0f} '
+                     '{correct}'.format(**r))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='benchmark of bcf hypermap decoders on synthetic files')
+    parser.add_argument('--height', type=int, default=64)
+    parser.add_argument('--width', type=int, default=80)
+    parser.add_argument('--chans', type=int, default=4096)
+    parser.add_argument('--dwell', type=int, default=50,
+                        help='mean counts of pixel')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='processes of parallel_parse_hypermap')
+    parser.add_argument('--cases', nargs='+', choices=list(default_cases),
+                        default=list(default_cases))
+    parser.add_argument('--decoders', nargs='+', default=None,
+                        help='names of decoders (default all available)')
+    parser.add_argument('--header', action='store_true',
+                        help='benchmark HyperHeader parsing instead')
+    parser.add_argument('--indexes', type=int, default=32,
+                        help='SpectrumData indexes of --header benchmark')
+    parser.add_argument('--planes', type=int, default=4,
+                        help='image planes of --header benchmark')
+    args = parser.parse_args(argv)
+    if args.header:
+        result = run_header_benchmark(n_indexes=args.indexes,
+                                      height=args.height, width=args.width,
+                                      chans=args.chans, planes=args.planes,
+                                      repeat=args.repeat)
+        print('header of {0:.2f} MB: parsed in {1:.4f} s, metadata made in '
+              '{2:.4f} s'.format(result['size'] / 1e6, result['seconds'],
+                                 result['metadata_seconds']))
+        return 0
+    decoders = default_decoders(workers=args.workers)
+    if args.decoders is not None:
+        decoders = {name: decoders[name] for name in args.decoders}
+    results = run_benchmark(height=args.height, width=args.width,
+                            chans=args.chans, dwell=args.dwell,
+                            cases={c: default_cases[c] for c in args.cases},
+                            decoders=decoders, repeat=args.repeat)
+    print(format_results(results))
+    return 0 if all(r['correct'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
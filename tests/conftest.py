@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Shared fixtures of the tests: the synthetic bcf files are written
+#  with sfs_writer and the persistent caches are kept in the temporary
+#  directory of the test session.
+
+import numpy as np
+import pytest
+
+from lib.parsers import unbcf_numpy
+
+from .sfs_writer import write_bcf
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """keep the persistent indexes out of the user cache directory"""
+    directory = tmp_path / 'cache'
+    monkeypatch.setenv('HUSSARIX_CACHE_DIR', str(directory))
+    return directory
+
+
+@pytest.fixture(scope='module', params=[(None, False), ('zlib', False),
+                                        (None, True), ('zlib', True)],
+                ids=['plain', 'zlib', 'fragmented', 'zlib-fragmented'])
+def synthetic_bcf(request, tmp_path_factory):
+    """(filename, written hypermap) of the small synthetic bcf with
+    mixed packing of pixels, (not) compressed and (not) fragmented"""
+    compression, fragmented = request.param
+    filename = str(tmp_path_factory.mktemp('bcf') / 'synthetic.bcf')
+    cubes = write_bcf(filename, height=13, width=17, chans=2048, dwell=30,
+                      compression=compression, fragmented=fragmented,
+                      chunksize=2048, seed=5)
+    return filename, cubes[0]
+
+
+@pytest.fixture
+def small_bands(monkeypatch):
+    """decode the synthetic maps (17 pixels wide) in bands of 2 lines,
+    so the streaming decoders and progress go through many bands"""
+    monkeypatch.setattr(unbcf_numpy, 'BAND_PIXELS', 2 * 17)
+
+
+def expected_hypermap(cube, max_chan, downsample=1, region=None,
+                      energy_bin=1, chan_low=0):
+    """return the written hypermap transformed as the decoders should
+    do: region, downsampling by summing pixels, channel cutoffs and
+    summing of adjacent channels."""
+    if region is not None:
+        y0, y1, x0, x1 = region
+        cube = cube[y0:y1, x0:x1]
+    height, width, chans = cube.shape
+    # channels up to max_chan estimated from the header are kept even
+    # if none were written:
+    out = np.zeros((-(-height // downsample), -(-width // downsample),
+                    max(chans, max_chan)), dtype=np.int64)
+    for y in range(height):
+        for x in range(width):
+            out[y // downsample, x // downsample, :chans] += cube[y, x]
+    out = out[:, :, chan_low:max_chan]
+    n_bins = -(-out.shape[2] // energy_bin)
+    binned = np.zeros(out.shape[:2] + (n_bins,), dtype=np.int64)
+    for b in range(n_bins):
+        binned[:, :, b] = out[:, :, b * energy_bin:
+                              (b + 1) * energy_bin].sum(axis=2)
+    return binned
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Writer of synthetic SFS containers and bcf files.
+#  Real bcf files can't be shared, thus the decoders are measured and
+#  checked against the synthetic files with known content: the hypermap
+#  of poisson distributed counts is packed pixel by pixel with all
+#  three packings (16bit and 12bit pulse lists, instructively packed
+#  spectra with additional pulses) into EDSDatabase/SpectrumDataN
+#  files, next to EDSDatabase/HeaderData xml with the sum spectra,
+#  images and the rest of metadata required by bcf_hype.HyperHeader.
+
+import codecs
+import zlib
+from datetime import datetime
+from struct import pack as strct_pck
+
+import numpy as np
+
+
+def min_chunksize(n_items):
+    """return the smallest chunk size (bytes) of the SFS container
+    with n_items in the file tree: SFS_reader (as bcf files) requires
+    the whole tree in one chunk, which holds 0x200 bytes per item
+    after 32 bytes of chunk header."""
+    return 32 + 0x200 * n_items
+
+
+class SFS_writer(object):
+    """Writer of the SFS container (the counterpart of SFS_reader).
+
+    The file tree is written into single chunk, thus the container can
+    hold at most (chunksize - 32) // 0x200 files and directories
+    (see min_chunksize); adding more raises ValueError.
+
+    Arguments:
+    chunksize -- size of sfs chunk in bytes (default 4096)
+    compression -- None or 'zlib' (AACS compressed files; default None)
+    compr_blk_size -- uncompressed size of zlib block (default 0x8000)
+    fragmented -- if True, data chunks of files are shuffled, so files
+        are not written in continuous runs of chunks (default False)
+    seed -- seed of the shuffling (default 0)
+
+    Methods:
+    add_dir, add_file, write
+    """
+
+    def __init__(self, chunksize=4096, compression=None,
+                 compr_blk_size=0x8000, fragmented=False, seed=0):
+        if compression not in (None, 'zlib'):
+            raise ValueError('compression can be None or zlib')
+        self.chunksize = chunksize
+        self.usable_chunk = chunksize - 32
+        self.max_items = self.usable_chunk // 0x200
+        if self.max_items < 1:
+            raise ValueError('chunksize {0} is too small for the file tree, '
+                             'minimum is {1}'.format(chunksize,
+                                                     min_chunksize(1)))
+        self.compression = compression
+        self.compr_blk_size = compr_blk_size
+        self.fragmented = fragmented
+        self.rng = np.random.RandomState(seed)
+        self.items = []  # (name, parent, is_dir, data)
+
+    def _check_tree(self):
+        if len(self.items) >= self.max_items:
+            raise ValueError(
+                'file tree of {0} items does not fit in one chunk of {1} '
+                'bytes, chunksize has to be at least {2}'.format(
+                    len(self.items) + 1, self.chunksize,
+                    min_chunksize(len(self.items) + 1)))
+
+    def add_dir(self, name, parent=-1):
+        """add directory, return its index (used as parent)"""
+        self._check_tree()
+        self.items.append((name, parent, True, b''))
+        return len(self.items) - 1
+
+    def add_file(self, name, data, parent=-1):
+        """add file with given content, return its index"""
+        self._check_tree()
+        if self.compression == 'zlib':
+            data = self._aacs_compress(data)
+        self.items.append((name, parent, False, bytes(data)))
+        return len(self.items) - 1
+
+    def _aacs_compress(self, data):
+        blk = self.compr_blk_size
+        n_blocks = -(-len(data) // blk)
+        out = [strct_pck('<IIII', 0x53434141, blk, 0,
+                         n_blocks).ljust(0x80, b'\x00')]
+        for i in range(n_blocks):
+            raw = data[i * blk:(i + 1) * blk]
+            cpr = zlib.compress(raw)
+            out.append(strct_pck('<IIII', len(cpr), len(raw), 0,
+                                 len(cpr) + 16))
+            out.append(cpr)
+        return b''.join(out)
+
+    def write(self, filename):
+        """write the container to the file"""
+        cs, uc = self.chunksize, self.usable_chunk
+        n_items = len(self.items)
+        # chunk 0 -- sfs header, chunk 1 -- file tree,
+        # then pointer table chunks of every file:
+        next_free = 2
+        pointer_chunks = []
+        n_data_chunks = []
+        for name, parent, is_dir, data in self.items:
+            if is_dir:
+                pointer_chunks.append([])
+                n_data_chunks.append(0)
+                continue
+            n_data = max(-(-len(data) // uc), 1)
+            n_ptr = -(-n_data // (uc // 4))
+            pointer_chunks.append(list(range(next_free, next_free + n_ptr)))
+            n_data_chunks.append(n_data)
+            next_free += n_ptr
+        total_data = sum(n_data_chunks)
+        order = np.arange(next_free, next_free + total_data)
+        if self.fragmented:
+            # swapping random pairs breaks the runs of chunks:
+            for k in range(total_data // 5):
+                a, b = self.rng.randint(0, total_data, 2)
+                order[a], order[b] = order[b], order[a]
+        data_chunks = []
+        pos = 0
+        for n in n_data_chunks:
+            data_chunks.append(order[pos:pos + n])
+            pos += n
+        n_chunks = next_free + total_data
+        buf = bytearray(0x118 + n_chunks * cs)
+        buf[:8] = b'AAMVHFSS'
+        buf[0x124:0x12C] = strct_pck('<fI', 2.6, cs)
+        buf[0x140:0x14C] = strct_pck('<III', 1, n_items, n_chunks)
+        tree = bytearray()
+        # any time is fine (FILETIME of 2019):
+        filetime = 132000000000000000
+        for i, (name, parent, is_dir, data) in enumerate(self.items):
+            if is_dir:
+                ptr_addr = -1
+            else:
+                ptr_addr = pointer_chunks[i][0]
+                table = np.asarray(data_chunks[i], dtype='<u4').tobytes()
+                per_chunk = (uc // 4) * 4
+                for j, c in enumerate(pointer_chunks[i]):
+                    nxt = pointer_chunks[i][j + 1] \
+                        if j + 1 < len(pointer_chunks[i]) else 0
+                    buf[c * cs + 0x118:c * cs + 0x11C] = strct_pck('<I', nxt)
+                    part = table[j * per_chunk:(j + 1) * per_chunk]
+                    buf[c * cs + 0x138:c * cs + 0x138 + len(part)] = part
+                for j, c in enumerate(data_chunks[i]):
+                    part = data[j * uc:(j + 1) * uc]
+                    buf[c * cs + 0x138:c * cs + 0x138 + len(part)] = part
+            tree += strct_pck('<iQQQQIi176s?3s256s32s', ptr_addr, len(data),
+                              filetime, filetime, filetime, 0, parent, b'',
+                              is_dir, b'', name.encode('utf-8'), b'')
+        buf[cs + 0x138:cs + 0x138 + len(tree)] = tree
+        with open(filename, 'wb') as fn:
+            fn.write(buf)
+
+
+def pack_12bit(pulses):
+    """pack the list of pulses (channels) as 12bit values
+    (4 pulses into 6 bytes, flag 1 pixels)"""
+    n = len(pulses)
+    p = np.zeros(-(-n // 4) * 4, dtype=np.int64)
+    p[:n] = pulses
+    v0, v1, v2, v3 = p[0::4], p[1::4], p[2::4], p[3::4]
+    out = np.zeros((len(v0), 6), dtype=np.uint8)
+    out[:, 0] = ((v0 & 0xF) << 4) | (v1 >> 8)
+    out[:, 1] = v0 >> 4
+    out[:, 2] = v2 >> 4
+    out[:, 3] = v1 & 0xFF
+    out[:, 4] = v3 & 0xFF
+    out[:, 5] = ((v2 & 0xF) << 4) | (v3 >> 8)
+    return out.tobytes()
+
+
+def pack_instructed(counts, add_pulses=()):
+    """pack the spectrum instructively (flag > 1 pixels) in the groups
+    of up to 255 channels with the smallest possible delta size.
+
+    Returns:
+    (packed spectrum, packed additional pulses)
+    """
+    out = bytearray()
+    for start in range(0, len(counts), 255):
+        group = counts[start:start + 255]
+        n = len(group)
+        if not group.any():
+            out += strct_pck('<BB', 0, n)
+            continue
+        gain = int(group.min())
+        delta = group - gain
+        max_delta = int(delta.max())
+        if max_delta < 16:
+            size, gain_fmt = 1, 'B'
+            nibbles = delta.astype(np.uint8)
+            if n % 2:
+                nibbles = np.append(nibbles, 0)
+            packed = (nibbles[0::2] |
+                      (nibbles[1::2] << 4)).astype(np.uint8).tobytes()
+        elif max_delta < 0x100:
+            size, gain_fmt = 2, 'H'
+            packed = delta.astype('<u1').tobytes()
+        elif max_delta < 0x10000:
+            size, gain_fmt = 4, 'I'
+            packed = delta.astype('<u2').tobytes()
+        else:
+            size, gain_fmt = 8, 'Q'
+            packed = delta.astype('<u4').tobytes()
+        out += strct_pck('<BB', size, n) + strct_pck('<' + gain_fmt, gain) +\
+            packed
+    return bytes(out), np.asarray(add_pulses, dtype='<u2').tobytes()
+
+
+def make_spectrum_data(counts, flags, chan1=4096, skip_empty=False, seed=1):
+    """Pack the hypermap into the content of SpectrumData file.
+
+    Arguments:
+    counts -- (height, width, channels) integer array
+    flags -- (height, width) array of packing flags of pixels
+        (0 -- 16bit pulses, 1 -- 12bit pulses, >1 -- instructed)
+    chan1 -- number of channels of whole mapping (default 4096)
+    skip_empty -- pixels without counts are not written (default False)
+    seed -- seed of pulse order and of additional pulses (default 1)
+
+    Returns:
+    bytes
+    """
+    height, width, chans = counts.shape
+    out = [strct_pck('<ii', height, width).ljust(0x1A0, b'\x00')]
+    rng = np.random.RandomState(seed)
+    for y in range(height):
+        records = []
+        for x in range(width):
+            spectrum = counts[y, x]
+            if skip_empty and not spectrum.any():
+                continue
+            flag = int(flags[y, x])
+            if flag < 2:
+                pulses = np.repeat(np.arange(chans), spectrum)
+                rng.shuffle(pulses)
+                if flag == 0:
+                    data = pulses.astype('<u2').tobytes()
+                else:
+                    data = pack_12bit(pulses)
+                head = strct_pck('<IHHIHHHI', x, chan1, chans, 0x10000, flag,
+                                 0, len(pulses), len(data))
+                records.append(head + data)
+                continue
+            nonzero = np.nonzero(spectrum)[0]
+            chan2 = int(nonzero[-1]) + 1 if len(nonzero) else 1
+            body = spectrum[:chan2].astype(np.int64)
+            # some counts are moved to the additional pulses:
+            add = []
+            if len(nonzero) and rng.rand() < 0.5:
+                for c in rng.choice(nonzero, min(5, len(nonzero))):
+                    if body[c] > 0:
+                        body[c] -= 1
+                        add.append(c)
+            instructed, add_bytes = pack_instructed(body, add)
+            head = strct_pck('<IHHIHHHI', x, chan1, chan2, 0x10000, flag,
+                             len(instructed), len(add), len(instructed) + 4)
+            records.append(head + instructed +
+                           strct_pck('<I', len(add_bytes)) + add_bytes)
+        out.append(strct_pck('<I', len(records)))
+        out.extend(records)
+    return b''.join(out)
+
+
+def make_header_xml(height, width, chans, sum_spectra, hv=15.0,
+                    calib_abs=-0.47, calib_lin=0.01, amplification=20000,
+                    elements=None, planes=1, seed=3):
+    """Return the content of HeaderData file (cp1252 encoded xml).
+
+    Arguments:
+    height, width -- dimensions of the map and images
+    chans -- number of channels
+    sum_spectra -- list of sum spectra (one per hypermap)
+    hv -- accelerating voltage in kV (default 15.0)
+    calib_abs, calib_lin -- energy calibration in keV
+    amplification -- pulse processor range in eV (default 20000)
+    elements -- dict of element: (line, energy, width)
+        (default Fe K and Si K)
+    planes -- number of 16bit image planes (default 1)
+    seed -- seed of random image content (default 3)
+    """
+    if elements is None:
+        elements = {'Fe': ('K', 6.4, 0.3), 'Si': ('K', 1.74, 0.2)}
+    det_layers = zlib.compress(b'<DetLayers><Layer0 Atom="14" '
+                               b'Thickness="0.1"/></DetLayers>')
+    det_layers = codecs.encode(det_layers,
+                               'base64').decode('ascii').replace('\n', '')
+    date = datetime(2020, 1, 2, 3, 4, 5)
+    rng = np.random.RandomState(seed)
+    image_planes = []
+    for p in range(planes):
+        image = rng.randint(0, 65535, size=(height, width)).astype('<u2')
+        b64 = codecs.encode(image.tobytes(), 'base64').decode('ascii')
+        image_planes.append(
+            '<Plane{0}><Description>BSE{0}</Description><Data>{1}</Data>'
+            '</Plane{0}>'.format(p, b64))
+    elements_xml = ''.join(
+        '<ClassInstance Type="TRTSpectrumRegion" Name="{0}"><Line>{1}</Line>'
+        '<Energy>{2}</Energy><Width>{3}</Width></ClassInstance>'.format(
+            name, line, energy, e_width)
+        for name, (line, energy, e_width) in elements.items())
+    spectra_xml = []
+    for i, spectrum in enumerate(sum_spectra):
+        spectra_xml.append(
+            '<SpectrumData{0}><ClassInstance Type="TRTSpectrum">'
+            '<TRTHeaderedClass>'
+            '<ClassInstance Type="TRTSpectrumHardwareHeader">'
+            '<RealTime>{8}</RealTime><LifeTime>{9}</LifeTime>'
+            '<DeadTime>3</DeadTime><ZeroPeakPosition>95</ZeroPeakPosition>'
+            '<ZeroPeakFrequency>800</ZeroPeakFrequency>'
+            '<PulseDensity>25471</PulseDensity>'
+            '<Amplification>{1}</Amplification><ShapingTime>60000'
+            '</ShapingTime><DetectorTemperature>-20.5'
+            '</DetectorTemperature><DetectorHV>-130</DetectorHV>'
+            '<GatingTimes>0,0,0,0</GatingTimes></ClassInstance>'
+            '<ClassInstance Type="TRTDetectorHeader"><Type>XFlash 6|10'
+            '</Type><Technology>SDD</Technology><Serial>8842_80</Serial>'
+            '<DetectorThickness>0.45</DetectorThickness>'
+            '<SiDeadLayerThickness>0.029</SiDeadLayerThickness>'
+            '<WindowType>slew AP3.3</WindowType>'
+            '<ResponseFunctionCount>21</ResponseFunctionCount>'
+            '<SampleCount>5</SampleCount><SampleOffset>-3</SampleOffset>'
+            '<PileUpWithBG>false</PileUpWithBG>'
+            '<DetLayers>{2}</DetLayers></ClassInstance>'
+            '<ClassInstance Type="TRTESMAHeader"><PrimaryEnergy>{3}'
+            '</PrimaryEnergy><ElevationAngle>35</ElevationAngle>'
+            '<AzimutAngle>90</AzimutAngle></ClassInstance>'
+            '</TRTHeaderedClass>'
+            '<ClassInstance Type="TRTSpectrumHeader"><Date>02.01.2020'
+            '</Date><Time>03:04:05</Time><ChannelCount>{6}</ChannelCount>'
+            '<CalibAbs>{4}</CalibAbs><CalibLin>{5}</CalibLin>'
+            '<SigmaAbs>4.8e-4</SigmaAbs><SigmaLin>1.2e-3</SigmaLin>'
+            '</ClassInstance><Channels>{7}</Channels>'
+            '</ClassInstance></SpectrumData{0}>'.format(
+                i, amplification, det_layers, hv, calib_abs, calib_lin,
+                chans, ','.join(str(int(v)) for v in spectrum),
+                height * width * 100 // 1000, height * width * 97 // 1000))
+    xml = (
+        '<?xml version="1.0" encoding="WINDOWS-1252" standalone="yes"?>'
+        '<TRTHeaderedClass><ClassInstance Type="TRTSpectrumDatabase" '
+        'Name="synthetic"><Header><Date>{date}</Date><Time>{time}</Time>'
+        '<FileVersion>2</FileVersion></Header>'
+        '<ClassInstance Type="TRTSEMData"><HV>{hv}</HV><WD>10.5</WD>'
+        '<Mag>250</Mag><DX>0.5</DX><DY>0.5</DY></ClassInstance>'
+        '<ClassInstance Type="TRTSEMStageData"><X>100.5</X><Y>20.5</Y>'
+        '<Z>10</Z><Rotation>0</Rotation></ClassInstance>'
+        '<ClassInstance Type="TRTDSPConfiguration"><ImageWidth>{w}'
+        '</ImageWidth><ImageHeight>{h}</ImageHeight><XLeft>0</XLeft>'
+        '<XRight>{w}</XRight><YTop>0</YTop><YBottom>{h}</YBottom>'
+        '<Zoom>1</Zoom><LineAverage>1</LineAverage><PixelAverage>1'
+        '</PixelAverage><PixelTime>100</PixelTime><TiltAngle>0</TiltAngle>'
+        '<ChannelName0>BSE</ChannelName0><SyncMode>true</SyncMode>'
+        '<Rotation>0.0</Rotation></ClassInstance>'
+        '<ClassInstance Type="TRTImageData"><Width>{w}</Width>'
+        '<Height>{h}</Height><PlaneCount>{planes}</PlaneCount>{images}'
+        '</ClassInstance>'
+        '<ClassInstance Type="TRTContainerClass"><ChildClassInstances>'
+        '<ClassInstance Type="TRTElementInformationList">'
+        '<ClassInstance Type="TRTSpectrumRegionList"><ChildClassInstances>'
+        '{elements}</ChildClassInstances></ClassInstance></ClassInstance>'
+        '</ChildClassInstances></ClassInstance>'
+        '<LineCounter>{lines}</LineCounter><ChCount>{chans}</ChCount>'
+        '<DetectorCount>{n_det}</DetectorCount>{spectra}'
+        '</ClassInstance></TRTHeaderedClass>').format(
+            date=date.strftime('%d.%m.%Y'), time=date.strftime('%H:%M:%S'),
+            hv=hv, w=width, h=height, planes=planes,
+            images=''.join(image_planes), elements=elements_xml,
+            lines=','.join(['1'] * height), chans=chans,
+            n_det=len(sum_spectra), spectra=''.join(spectra_xml))
+    return xml.encode('cp1252')
+
+
+def synthetic_counts(height, width, chans=4096, dwell=50, hv=15.0,
+                     calib_abs=-0.47, calib_lin=0.01, seed=0):
+    """Return (height, width, chans) int64 array of poisson distributed
+    counts: bremsstrahlung-like background with Si, Fe and zero energy
+    peaks, and pixel intensity varying around dwell counts."""
+    rng = np.random.RandomState(seed)
+    energy = calib_abs + calib_lin * np.arange(chans)
+    spectrum = np.where((energy > 0.2) & (energy < hv), 1.0, 0.0) *\
+        np.exp(-energy / 5.)
+    for peak in (1.74, 6.4, 7.06, 0.0):
+        spectrum += 8 * np.exp(-0.5 * ((energy - peak) / 0.06) ** 2)
+    spectrum /= spectrum.sum()
+    intensity = rng.gamma(2., dwell / 2., size=(height, width))
+    return rng.poisson(intensity[..., None] *
+                       spectrum[None, None, :]).astype(np.int64)
+
+
+def write_bcf(filename, height=32, width=40, chans=4096, compression=None,
+              chunksize=4096, flags_mix=(1, 1, 1), fragmented=False,
+              n_indexes=1, seed=0, dwell=50, hot=False, planes=1):
+    """Write the synthetic bcf file.
+
+    Arguments:
+    filename -- path of bcf to be written
+    height, width -- dimensions of the map (default 32, 40)
+    chans -- number of channels (default 4096)
+    compression -- None or 'zlib' (default None)
+    chunksize -- sfs chunk size; the file tree (EDSDatabase directory,
+        HeaderData and n_indexes SpectrumData files) has to fit in one
+        chunk, thus it has to be at least min_chunksize(n_indexes + 2),
+        i.e. 1568 bytes for single hypermap, else ValueError is raised
+        before anything is generated (default 4096)
+    flags_mix -- relative frequencies of 16bit, 12bit and instructively
+        packed pixels (default (1, 1, 1))
+    fragmented -- shuffle the chunks of files (default False)
+    n_indexes -- number of hypermaps (SpectrumDataN files) (default 1)
+    seed -- random seed (default 0)
+    dwell -- mean counts of pixel (default 50)
+    hot -- add two pixels with very high counts in one channel,
+        which overflow the dtype estimated from sum spectrum
+        (default False)
+    planes -- number of image planes (default 1)
+
+    Returns:
+    list of the written hypermaps ((height, width, chans) int64 arrays)
+    """
+    if chunksize < min_chunksize(n_indexes + 2):
+        raise ValueError('chunksize {0} is too small for the file tree of '
+                         '{1} items, minimum is {2}'.format(
+                             chunksize, n_indexes + 2,
+                             min_chunksize(n_indexes + 2)))
+    rng = np.random.RandomState(seed + 7)
+    sfs = SFS_writer(chunksize=chunksize, compression=compression,
+                     fragmented=fragmented, seed=seed)
+    eds_dir = sfs.add_dir('EDSDatabase')
+    cubes, sums, spectrum_data = [], [], []
+    mix = np.asarray(flags_mix, dtype=float)
+    for i in range(n_indexes):
+        counts = synthetic_counts(height, width, chans, dwell=dwell,
+                                  seed=seed + i)
+        flags = rng.choice([0, 1, 2], size=(height, width),
+                           p=mix / mix.sum())
+        if hot:
+            counts[0, 0, 5] = 70000
+            counts[1, 1, 10] = 300
+            flags[0, 0] = flags[1, 1] = 2
+        spectrum_data.append(make_spectrum_data(counts, flags, chan1=chans))
+        sums.append(counts.sum(axis=(0, 1)))
+        cubes.append(counts)
+    sfs.add_file('HeaderData', make_header_xml(height, width, chans, sums,
+                                               planes=planes),
+                 parent=eds_dir)
+    for i, data in enumerate(spectrum_data):
+        sfs.add_file('SpectrumData{0}'.format(i), data, parent=eds_dir)
+    sfs.write(filename)
+    return cubes
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Checks of the analyses streamed from the bcf (element maps, statistics,
+#  lines and principal components) against the written hypermap.
+
+import numpy as np
+import pytest
+
+from lib.parsers import bcf_hype
+from lib.parsers import unbcf_numpy
+
+from .conftest import expected_hypermap
+from .sfs_writer import write_bcf
+
+
+@pytest.fixture(scope='module')
+def pca_bcf(tmp_path_factory):
+    """filename of compressed and fragmented synthetic bcf with few
+    channels written (the decomposition of dense covariance is slow)"""
+    filename = str(tmp_path_factory.mktemp('pca') / 'pca.bcf')
+    write_bcf(filename, height=13, width=17, chans=256, dwell=30,
+              compression='zlib', fragmented=True, chunksize=2048, seed=5)
+    return filename
+
+
+@pytest.mark.parametrize('downsample, region', [(1, None),
+                                                (2, (3, 12, 1, 16))])
+def test_element_maps(synthetic_bcf, downsample, region):
+    filename, cube = synthetic_bcf
+    expected = expected_hypermap(cube, cube.shape[2], downsample=downsample,
+                                 region=region)
+    windows = [(0.5, 2.0), (1.0, 7.0)]
+    with bcf_hype.BCF_reader(filename) as reader:
+        eds = reader.header.get_spectra_metadata(0)
+        elements = reader.header.elements
+        labels, maps = reader.get_element_maps(downsample=downsample,
+                                               region=region)
+        window_labels, window_maps = reader.get_element_maps(
+            windows=windows, downsample=downsample, region=region)
+    assert labels == sorted(elements)
+    assert window_labels == ['0.5-2 keV', '1-7 keV']
+    assert maps.shape == (len(labels),) + expected.shape[:2]
+    assert maps.dtype == np.uint32
+    element_windows = [(elements[name]['energy'] - elements[name]['width'] / 2,
+                        elements[name]['energy'] + elements[name]['width'] / 2)
+                       for name in labels]
+    for result, used in ((maps, element_windows), (window_maps, windows)):
+        for window_map, (low, high) in zip(result, used):
+            first = eds.energy_to_channel(low)
+            last = eds.energy_to_channel(high) + 1
+            np.testing.assert_array_equal(
+                window_map, expected[:, :, first:last].sum(axis=2))
+
+
+@pytest.mark.parametrize('low_cutoff', [None, 1.0])
+def test_hypermap_statistics(synthetic_bcf, small_bands, low_cutoff):
+    filename, cube = synthetic_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        chan_low = reader._energy_cutoffs(0, None, low_cutoff)[1]
+        cutoff = reader._energy_cutoffs(0, 8.0, None)[0]
+        stats = reader.get_hypermap_statistics(low_cutoff_at_kV=low_cutoff)
+        region_stats = reader.get_hypermap_statistics(
+            region=(2, 10, 3, 9), downsample=2, cutoff_at_kV=8.0,
+            low_cutoff_at_kV=low_cutoff)
+        calib_abs = reader.header.get_spectra_metadata(0).calibAbs
+    # spectra are cut at the length of the sum spectrum in the header:
+    data = cube[:, :, chan_low:]
+    assert stats.matches_header is True
+    assert stats.chan_low == chan_low
+    np.testing.assert_array_equal(stats.sum_spectrum, data.sum(axis=(0, 1)))
+    np.testing.assert_array_equal(stats.max_spectrum, data.max(axis=(0, 1)))
+    np.testing.assert_array_equal(stats.pixel_totals, data.sum(axis=2))
+    np.testing.assert_array_equal(stats.max_channel, data.argmax(axis=2))
+    np.testing.assert_array_equal(stats.line_totals, data.sum(axis=(1, 2)))
+    assert stats.calib_abs == pytest.approx(
+        calib_abs + chan_low * stats.calib_lin)
+    region = expected_hypermap(cube, cutoff, downsample=2,
+                               region=(2, 10, 3, 9), chan_low=chan_low)
+    # statistics of region are not comparable with the header:
+    assert region_stats.matches_header is None
+    assert len(region_stats.sum_spectrum) == cutoff - chan_low
+    np.testing.assert_array_equal(region_stats.sum_spectrum,
+                                  region.sum(axis=(0, 1)))
+    np.testing.assert_array_equal(region_stats.pixel_totals,
+                                  region.sum(axis=2))
+    changed = cube.sum(axis=(0, 1))
+    changed[chan_low + 5] += 1
+    assert stats.check_with_header(changed) is False
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'downsample': 3},
+    {'region': (2, 11, 3, 15), 'energy_bin': 3, 'low_cutoff_at_kV': 0.5},
+    {'cutoff_at_kV': 8.},
+])
+def test_iter_hypermap_lines(synthetic_bcf, small_bands, kwargs):
+    filename, cube = synthetic_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        hypermap = reader.parse_hypermap(**kwargs)
+        numbers, buffers = [], set()
+        for number, line in reader.iter_hypermap_lines(**kwargs):
+            numbers.append(number)
+            buffers.add(id(line))
+            assert line.dtype == hypermap.dtype
+            np.testing.assert_array_equal(line, hypermap[number])
+    assert numbers == list(range(hypermap.shape[0]))
+    # the line buffer is reused:
+    assert len(buffers) == 1
+
+
+def dense_pca(cube, n_components, poisson):
+    """return (variance, components, mean, scores) of the principal
+    component analysis of the whole (y, x, E) cube in memory"""
+    spectra = cube.reshape(-1, cube.shape[2]).astype(np.float64)
+    if poisson:
+        scale = np.sqrt(np.outer(spectra.sum(axis=1), spectra.sum(axis=0)))
+        scale[scale == 0] = 1
+        spectra /= scale
+    mean = spectra.mean(axis=0)
+    variance, vectors = np.linalg.eigh(np.cov(spectra, rowvar=False))
+    order = np.argsort(variance)[::-1][:n_components]
+    components = vectors[:, order].T
+    scores = np.dot(spectra - mean, components.T)
+    return (variance[order], components, mean,
+            scores.reshape(cube.shape[:2] + (n_components,)))
+
+
+# the channels are cut (the map channels are estimated up to HV):
+@pytest.mark.parametrize('kwargs', [
+    {'cutoff_at_kV': 2.},
+    {'cutoff_at_kV': 2., 'poisson': False},
+    {'cutoff_at_kV': 2., 'energy_bin': 4, 'downsample': 2},
+    {'cutoff_at_kV': 1.5, 'region': (1, 12, 2, 15), 'low_cutoff_at_kV': 0.5},
+])
+def test_hypermap_pca_matches_dense_decomposition(pca_bcf, small_bands,
+                                                  kwargs):
+    cube_kwargs = {k: v for k, v in kwargs.items() if k != 'poisson'}
+    with bcf_hype.BCF_reader(pca_bcf) as reader:
+        pca = reader.get_hypermap_pca(n_components=4, **kwargs)
+        hypermap = reader.parse_hypermap(**cube_kwargs)
+    variance, components, mean, scores = dense_pca(
+        hypermap, 4, kwargs.get('poisson', True))
+    # components are defined up to the sign:
+    sign = np.sign((pca.components * components).sum(axis=1))
+    np.testing.assert_allclose(pca.explained_variance, variance)
+    np.testing.assert_allclose(pca.components, components * sign[:, None],
+                               atol=1e-8)
+    np.testing.assert_allclose(pca.mean, mean, atol=1e-12)
+    np.testing.assert_allclose(pca.scores, scores * sign, atol=1e-8)
+    np.testing.assert_array_equal(pca.sum_spectrum,
+                                  hypermap.sum(axis=(0, 1)))
+    assert pca.n_pixels == hypermap.shape[0] * hypermap.shape[1]
+    assert np.all(np.diff(pca.explained_variance_ratio) <= 0)
+
+
+def test_hypermap_pca_without_scores(pca_bcf, small_bands):
+    progress = unbcf_numpy.Progress()
+    with bcf_hype.BCF_reader(pca_bcf) as reader:
+        height = reader.header.image.height
+        pca = reader.get_hypermap_pca(n_components=3, cutoff_at_kV=2.,
+                                      scores=False, progress=progress)
+        with_scores = reader.get_hypermap_pca(n_components=3,
+                                              cutoff_at_kV=2.,
+                                              progress=progress)
+    assert pca.scores is None
+    np.testing.assert_allclose(pca.components, with_scores.components)
+    # both passes are counted into the progress:
+    assert progress.lines_done == progress.total_lines == 2 * height
+    assert not progress.started
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Cross-checks of the hypermap decoders against the hypermap written
+#  into synthetic bcf files.
+
+import numpy as np
+import pytest
+
+from lib.parsers import bcf_hype
+from lib.parsers import unbcf_numpy
+
+from .conftest import expected_hypermap
+from .sfs_writer import write_bcf
+
+# downsample, region, energy_bin, low_cutoff_at_kV:
+decoding_cases = [
+    (1, None, 1, None),
+    (2, (1, 12, 2, 15), 3, 1.0),
+    (3, None, 4, 0.5),
+    (1, (4, 9, 0, 17), 1, None),
+]
+
+
+def decode(reader, decoder, downsample, region, energy_bin, low_cutoff):
+    kwargs = dict(downsample=downsample, region=region,
+                  energy_bin=energy_bin, low_cutoff_at_kV=low_cutoff)
+    if decoder == 'numpy':
+        return reader.parse_hypermap(**kwargs)
+    if decoder == 'lazy':
+        return reader.parse_hypermap(lazy=True, **kwargs).compute()
+    if decoder == 'parallel':
+        return reader.parse_hypermap(workers=2, **kwargs)
+    if decoder == 'memmap':
+        chan_low = reader._energy_cutoffs(0, None, low_cutoff)[1]
+        return reader.memmap_parse_hypermap(
+            downsample=downsample, region=region, energy_bin=energy_bin,
+            chan_low=chan_low)
+    raise ValueError(decoder)
+
+
+@pytest.mark.parametrize('case', decoding_cases)
+@pytest.mark.parametrize('decoder', ['numpy', 'lazy', 'parallel', 'memmap'])
+def test_decoders_match_written_hypermap(synthetic_bcf, decoder, case):
+    filename, cube = synthetic_bcf
+    downsample, region, energy_bin, low_cutoff = case
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        chan_low = reader._energy_cutoffs(0, None, low_cutoff)[1]
+        expected = expected_hypermap(cube, max_chan, downsample=downsample,
+                                     region=region, energy_bin=energy_bin,
+                                     chan_low=chan_low)
+        hypermap = decode(reader, decoder, downsample, region, energy_bin,
+                          low_cutoff)
+        assert hypermap.shape == expected.shape
+        np.testing.assert_array_equal(hypermap, expected)
+        del hypermap
+
+
+@pytest.mark.parametrize('downsample', [1, 2, 5])
+def test_python_and_numpy_backends_agree(synthetic_bcf, downsample):
+    filename, cube = synthetic_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        reference = reader.py_parse_hypermap(downsample=downsample)
+        numpy_backend = unbcf_numpy.parse_to_numpy(
+            reader.get_file('EDSDatabase/SpectrumData0'),
+            downsample=downsample)
+        np.testing.assert_array_equal(
+            reference, expected_hypermap(cube, max_chan, downsample))
+        np.testing.assert_array_equal(numpy_backend, reference)
+        assert numpy_backend.dtype == reference.dtype
+
+
+@pytest.mark.parametrize('case', decoding_cases)
+def test_sparse_round_trip(synthetic_bcf, case, tmp_path):
+    filename, cube = synthetic_bcf
+    downsample, region, energy_bin, low_cutoff = case
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        chan_low = reader._energy_cutoffs(0, None, low_cutoff)[1]
+        sparse = reader.parse_sparse_hypermap(
+            downsample=downsample, region=region, energy_bin=energy_bin,
+            low_cutoff_at_kV=low_cutoff)
+    expected = expected_hypermap(cube, max_chan, downsample=downsample,
+                                 region=region, energy_bin=energy_bin,
+                                 chan_low=chan_low)
+    np.testing.assert_array_equal(sparse.to_dense(), expected)
+    assert sparse.nnz == np.count_nonzero(expected)
+    np.testing.assert_array_equal(sparse.pixel_spectrum(2, 3),
+                                  expected[2, 3])
+    saved = str(tmp_path / 'sparse.npz')
+    sparse.save(saved)
+    loaded = unbcf_numpy.SparseHypermap.load(saved)
+    np.testing.assert_array_equal(loaded.to_dense(), expected)
+
+
+def test_compact_keeps_exact_counts(tmp_path):
+    filename = str(tmp_path / 'hot.bcf')
+    cube = write_bcf(filename, height=9, width=11, chans=512, dwell=20,
+                     compression='zlib', hot=True, seed=2)[0]
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        compact = reader.parse_compact_hypermap()
+        sparse = reader.parse_sparse_hypermap()
+    expected = expected_hypermap(cube, max_chan)
+    # the hot pixel does not fit into the base dtype:
+    assert compact.base.dtype == np.uint8
+    assert len(compact.overflow_values) > 0
+    assert compact.dtype == np.uint32
+    np.testing.assert_array_equal(compact.to_dense(), expected)
+    np.testing.assert_array_equal(compact[:2, :3], expected[:2, :3])
+    np.testing.assert_array_equal(sparse.to_dense(), expected)
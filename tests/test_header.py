@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Checks of the header parsing: conversion of xml values and lazily
+#  decoded image planes.
+
+import codecs
+from ast import literal_eval
+
+import numpy as np
+import pytest
+
+from lib.parsers import bcf_hype
+
+from .sfs_writer import make_header_xml
+
+
+@pytest.mark.parametrize('string', [
+    '0', '12', '-3', '+7', '-0', '007', '1_000', '0x1f', '1.5', '.5', '1.',
+    '-2.5e-3', '1e3', '1E+3', '1.e-2', 'e5', '1,2,3', '-1,+2', '1, 2',
+    '1,2.5', '01,2', 'True', 'False', 'None', 'true', 'abc', 'a b',
+    'XFlash 6|10', '8842_80', 'inf', 'nan', 'and', 'lambda: 1', "'quoted'",
+    '"double"', 'b"bytes"', 'r"raw"', 'f"x"', 'u"text"', '[1, 2]', '(1,)',
+    '{1: 2}', '', ' ', ' 1', '1 ', '02.01.2020', '03:04:05', 'Ångström',
+    '-', '+', '.', '1..2', '12abc', '2020-01-02',
+])
+def test_interpret_is_same_as_literal_eval(string):
+    try:
+        expected = literal_eval(string)
+    except (ValueError, SyntaxError):
+        expected = string
+    result = bcf_hype.interpret(string)
+    assert type(result) is type(expected)
+    assert result == expected
+
+
+def test_interpret_passes_interpreted_values():
+    for value in (1, 2.5, (1, 2), None, {'a': 1}):
+        assert bcf_hype.interpret(value) is value
+
+
+def encoded_plane(image):
+    """return the base64 text of 16bit image as in bruker xml"""
+    return codecs.encode(image.astype('<u2').tobytes(),
+                         'base64').decode('ascii')
+
+
+@pytest.mark.parametrize('separator', ['\n', '\r\n', ' ', '\t'])
+def test_empty_plane_is_found_without_decoding(separator):
+    text = separator.join(encoded_plane(np.zeros((9, 23))).split())
+    plane = bcf_hype.ImagePlane(separator + text + separator, 9, 23, 'BSE')
+    assert plane.is_empty
+    assert not plane.decoded
+    image = np.zeros((9, 23))
+    image[8, 22] = 1
+    text = separator.join(encoded_plane(image).split())
+    plane = bcf_hype.ImagePlane(text, 9, 23, 'BSE')
+    assert not plane.is_empty
+    assert not plane.decoded
+    np.testing.assert_array_equal(plane.data, image)
+
+
+def test_plane_with_other_characters_is_decoded():
+    text = encoded_plane(np.zeros((4, 5)))
+    plane = bcf_hype.ImagePlane(text[:8] + '*' + text[8:], 4, 5, 'BSE')
+    assert plane.is_empty
+    assert plane.decoded
+
+
+def header_xml():
+    """return header xml of 13 x 17 map with 2 random and 1 zero image
+    planes"""
+    xml = make_header_xml(13, 17, 256, [np.ones(256)], planes=3)
+    zero = encoded_plane(np.zeros((13, 17))).encode('ascii')
+    start = xml.index(b'<Data>', xml.index(b'<Plane2>')) + len(b'<Data>')
+    return xml[:start] + zero + xml[xml.index(b'</Data>', start):]
+
+
+@pytest.fixture
+def header():
+    return bcf_hype.HyperHeader(header_xml(), [0])
+
+
+def test_image_planes_are_decoded_lazily(header):
+    image = header.image
+    assert image.plane_count == 3
+    assert not any(plane.decoded for plane in image.planes)
+    assert [plane.is_empty for plane in image.planes] == [False, False, True]
+    assert not any(plane.decoded for plane in image.planes)
+    images = image.images
+    assert image.images is images
+    assert [item['metadata']['General']['title'] for item in images] == \
+        ['BSE0', 'BSE1']
+    assert [plane.decoded for plane in image.planes] == [True, True, False]
+    for item, plane in zip(images, image.planes):
+        assert item['data'] is plane.data
+        assert item['data'].shape == (13, 17)
+        assert item['axes'][0]['size'] == 13
+        assert item['axes'][1]['size'] == 17
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_thumbnails(header, workers):
+    reference = bcf_hype.HyperHeader(header_xml(), [0]).image.images
+    image = header.image
+    thumbnails = image.get_images(workers=workers, thumbnail_size=5)
+    # every 4th pixel is kept (17 / 4 <= 5):
+    assert [item['data'].shape for item in thumbnails] == [(4, 5), (4, 5)]
+    for item, full in zip(thumbnails, reference):
+        np.testing.assert_array_equal(item['data'], full['data'][::4, ::4])
+        assert item['axes'][0]['size'] == 4
+        assert item['axes'][1]['size'] == 5
+        for axis in (0, 1):
+            assert item['axes'][axis]['scale'] == pytest.approx(
+                full['axes'][axis]['scale'] * 4)
+    # full planes are not kept:
+    assert not any(plane.decoded for plane in image.planes)
+    plane = image.planes[0]
+    assert plane.thumbnail_step(5) == 4
+    full = reference[0]['data']
+    np.testing.assert_array_equal(plane.thumbnail(5), full[::4, ::4])
+    np.testing.assert_array_equal(plane.thumbnail(100), full)
+    assert not plane.decoded
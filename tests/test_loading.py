@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Checks of the hypermap loading within the memory budget, of several
+#  hypermaps at once and of the progress reporting and cancellation.
+
+import os
+
+import numpy as np
+import pytest
+
+from lib.parsers import bcf_hype
+from lib.parsers import unbcf_numpy
+
+from .conftest import expected_hypermap
+from .sfs_writer import write_bcf
+
+
+@pytest.fixture(scope='module')
+def stack_bcf(tmp_path_factory):
+    """(filename, written hypermaps) of compressed synthetic bcf
+    with 3 hypermaps"""
+    filename = str(tmp_path_factory.mktemp('stack') / 'stack.bcf')
+    cubes = write_bcf(filename, height=13, width=17, chans=2048, dwell=30,
+                      compression='zlib', n_indexes=3, seed=5)
+    return filename, cubes
+
+
+def planned_expected(cube, plan, max_chan):
+    """return the written hypermap transformed as planned"""
+    return expected_hypermap(cube, plan.cutoff_chan or max_chan,
+                             downsample=plan.downsample,
+                             energy_bin=plan.energy_bin,
+                             chan_low=plan.chan_low)
+
+
+def test_plan_fits_as_it_is(stack_bcf):
+    filename, cubes = stack_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        plan = reader.plan_hypermap(memory_budget='1GB', workers=1)
+    assert plan.mode == 'memory'
+    assert plan.shape == (13, 17, max_chan)
+    assert plan.nbytes == 13 * 17 * max_chan * plan.dtype.itemsize
+    assert len(plan.steps) == 1
+    assert 'memory' in plan.report()
+
+
+@pytest.mark.parametrize('strategy, mode', [
+    ('trim', 'memory'),
+    ('lazy', 'lazy'),
+    ('memmap', 'memmap'),
+    ('energy_bin', 'memory'),
+    ('downsample', 'memory'),
+])
+def test_strategy_fits_into_budget(stack_bcf, tmp_path, strategy, mode):
+    filename, cubes = stack_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        full = reader.plan_hypermap(memory_budget='1GB', workers=1)
+        budget = full.nbytes + full.overhead - 1
+        plan = reader.load_hypermap(memory_budget=budget, workers=1,
+                                    strategies=(strategy,),
+                                    memmap_dir=str(tmp_path))
+        hypermap = reader.hypermap[0].hypermap
+        filename = plan.filename
+        assert reader.hypermap[0].plan is plan
+    assert plan.mode == mode
+    assert plan.memory_budget == budget
+    assert len(plan.steps) == 2
+    if strategy == 'trim':
+        assert plan.chan_low > 0 or plan.cutoff_chan < max_chan
+    elif strategy == 'lazy':
+        assert plan.chunk_bytes < plan.nbytes
+        hypermap = hypermap.compute()
+    elif strategy == 'memmap':
+        assert os.path.dirname(filename) == str(tmp_path)
+        assert isinstance(hypermap, np.memmap)
+    elif strategy == 'energy_bin':
+        assert plan.energy_bin == 2
+    elif strategy == 'downsample':
+        assert plan.downsample == 2
+    if strategy != 'memmap':
+        assert filename is None
+    if strategy in ('energy_bin', 'downsample'):
+        assert plan.nbytes < full.nbytes
+    assert hypermap.shape == plan.shape
+    np.testing.assert_array_equal(hypermap,
+                                  planned_expected(cubes[0], plan, max_chan))
+
+
+def test_plan_raises_memory_error(stack_bcf):
+    filename, cubes = stack_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        with pytest.raises(MemoryError, match='downsampled by 8') as error:
+            reader.plan_hypermap(memory_budget=1000, workers=1)
+        # every tried strategy is reported:
+        for step in ('trimmed', 'lazy loading', 'memmap', 'summed'):
+            assert step in str(error.value)
+        with pytest.raises(MemoryError):
+            reader.load_hypermap(memory_budget='1kB', workers=1,
+                                 strategies=('energy_bin',))
+        assert reader.hypermap == {}
+        with pytest.raises(ValueError, match='unknown strategy'):
+            reader.plan_hypermap(memory_budget=1000, strategies=('zip',))
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_parse_hypermaps_keeps_order(stack_bcf, processes):
+    filename, cubes = stack_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        chan_low = reader._energy_cutoffs(0, None, 0.5)[1]
+        hypermaps = reader.parse_hypermaps(indexes=[2, 0, 1], downsample=2,
+                                           low_cutoff_at_kV=0.5, workers=2,
+                                           processes=processes)
+    assert len(hypermaps) == 3
+    for index, hypermap in zip([2, 0, 1], hypermaps):
+        np.testing.assert_array_equal(
+            hypermap, expected_hypermap(cubes[index], max_chan, 2,
+                                        chan_low=chan_low))
+
+
+def test_parse_hypermaps_within_budget(stack_bcf):
+    filename, cubes = stack_bcf
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        plan = reader.plan_hypermap(memory_budget='1GB', workers=1)
+        # all arrays and the decoding of single hypermap fit:
+        budget = 3 * plan.nbytes + plan.overhead
+        hypermaps = reader.parse_hypermaps(workers=3, memory_budget=budget)
+        for cube, hypermap in zip(cubes, hypermaps):
+            np.testing.assert_array_equal(hypermap,
+                                          expected_hypermap(cube, max_chan))
+        with pytest.raises(MemoryError, match=r'hypermaps \[0, 1, 2\]'):
+            reader.parse_hypermaps(workers=3, memory_budget=budget - 1)
+        with pytest.raises(MemoryError):
+            reader.persistent_parse_hypermaps(memory_budget=budget - 1)
+        assert reader.parse_hypermaps(indexes=[]) == []
+
+
+def test_persistent_parse_hypermaps_uses_cache(stack_bcf, tmp_path):
+    filename, cubes = stack_bcf
+    cache = bcf_hype.HypermapCache(str(tmp_path / 'hypermaps'))
+    with bcf_hype.BCF_reader(filename, hypermap_cache=cache) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        reader.persistent_parse_hypermaps(indexes=[1], downsample=2)
+    for cached in ([1], [0, 1, 2]):
+        with bcf_hype.BCF_reader(filename, hypermap_cache=cache) as reader:
+            reader.persistent_parse_hypermaps(indexes=[2, 1, 0],
+                                              downsample=2)
+            assert sorted(reader.hypermap) == [0, 1, 2]
+            for index, cube in enumerate(cubes):
+                hypermap = reader.hypermap[index].hypermap
+                assert isinstance(hypermap, np.memmap) == (index in cached)
+                np.testing.assert_array_equal(
+                    hypermap, expected_hypermap(cube, max_chan, 2))
+            del hypermap
+
+
+def stop_after(n_lines):
+    """return callback of Progress, which cancels the decoding after
+    n_lines are decoded"""
+    def callback(progress):
+        return progress.lines_done < n_lines
+    return callback
+
+
+@pytest.mark.parametrize('downsample', [1, 2])
+def test_progress_cancel_keeps_partial(stack_bcf, small_bands, downsample):
+    filename, cubes = stack_bcf
+    progress = unbcf_numpy.Progress(callback=stop_after(5),
+                                    keep_partial=True)
+    with bcf_hype.BCF_reader(filename) as reader:
+        full = reader.parse_hypermap(downsample=downsample)
+        with pytest.raises(unbcf_numpy.DecodingCancelled) as error:
+            reader.parse_hypermap(downsample=downsample, progress=progress)
+    assert error.value.progress is progress
+    assert progress.cancelled
+    assert not progress.started
+    assert 5 <= progress.lines_done < progress.total_lines == 13
+    assert 0 < progress.bytes_read
+    done = progress.lines_done // downsample
+    partial = error.value.partial
+    assert partial.shape == full.shape
+    np.testing.assert_array_equal(partial[:done], full[:done])
+    assert not partial[done:].any()
+
+
+def test_progress_cancel_and_reuse(stack_bcf, small_bands):
+    filename, cubes = stack_bcf
+    cancel_at = {'lines': 4}
+
+    def callback(progress):
+        if progress.lines_done >= cancel_at['lines']:
+            progress.cancel()
+
+    progress = unbcf_numpy.Progress(callback=callback)
+    with bcf_hype.BCF_reader(filename) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        with pytest.raises(unbcf_numpy.DecodingCancelled) as error:
+            reader.parse_hypermap(progress=progress)
+        assert error.value.partial is None
+        assert progress.cancelled
+        assert progress.lines_done < 13
+        # the token is restarted (counters and cancellation) by the next
+        # decoding:
+        cancel_at['lines'] = 100
+        region = (2, 11, 0, 17)
+        hypermap = reader.parse_hypermap(region=region, progress=progress)
+        read_bytes = progress.bytes_read
+        reader.parse_hypermap(region=region, progress=progress)
+    np.testing.assert_array_equal(
+        hypermap, expected_hypermap(cubes[0], max_chan, region=region))
+    assert not progress.cancelled
+    assert not progress.started
+    assert progress.lines_done == progress.total_lines == 9
+    assert progress.bytes_read == read_bytes > 0
+    assert progress.eta == 0
+    # the clock is stopped at the finish:
+    assert progress.elapsed == progress.elapsed
+
+
+def test_progress_cancel_of_processes(stack_bcf):
+    filename, cubes = stack_bcf
+    progress = unbcf_numpy.Progress(callback=stop_after(1))
+    with bcf_hype.BCF_reader(filename) as reader:
+        with pytest.raises(unbcf_numpy.DecodingCancelled):
+            reader.parse_hypermap(workers=2, progress=progress)
+        assert progress.cancelled
+        assert progress.lines_done < progress.total_lines
+        assert not progress.started
+        reader.parse_hypermap(workers=2, progress=unbcf_numpy.Progress())
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Petras Jokubauskas
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any project and source this library is coupled.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Tests of the SFS container reading (internal files, persistent
+#  indexes and hypermap cache) on synthetic containers.
+
+import io
+import os
+
+import numpy as np
+import pytest
+
+from lib.parsers import bcf_hype
+
+from .conftest import expected_hypermap
+from .sfs_writer import SFS_writer, min_chunksize, write_bcf
+
+
+@pytest.fixture(params=[(None, False), ('zlib', False), ('zlib', True)],
+                ids=['plain', 'zlib', 'zlib-fragmented'])
+def container(request, tmp_path):
+    """(filename, content) of the container with single file spanning
+    many chunks (and compressed blocks)"""
+    compression, fragmented = request.param
+    content = np.random.RandomState(4).randint(
+        0, 40, size=70000).astype(np.uint8).tobytes()
+    sfs = SFS_writer(chunksize=min_chunksize(2), compression=compression,
+                     compr_blk_size=0x1000, fragmented=fragmented)
+    sfs.add_file('data', content, parent=sfs.add_dir('dir'))
+    filename = str(tmp_path / 'container.sfs')
+    sfs.write(filename)
+    return filename, content
+
+
+def test_sfs_file_seek_and_read(container):
+    filename, content = container
+    with bcf_hype.SFS_reader(filename, index_cache=False) as sfs:
+        item = sfs.get_file('dir/data')
+        assert item.get_as_BytesIO_string().getvalue() == content
+        with sfs.open('dir/data', buffering=0) as raw:
+            # reads crossing chunk and compressed block boundaries:
+            for offset, length in ((0, 10), (1500, 3000), (4090, 10),
+                                   (33333, 12345), (69990, 100)):
+                assert raw.seek(offset) == offset
+                assert raw.read(length) == content[offset:offset + length]
+                assert raw.tell() == min(offset + length, len(content))
+            assert raw.seek(-20, io.SEEK_END) == len(content) - 20
+            assert raw.read() == content[-20:]
+            assert raw.read(5) == b''
+            raw.seek(100)
+            raw.seek(50, io.SEEK_CUR)
+            buffer = bytearray(3000)
+            assert raw.readinto(buffer) == 3000
+            assert bytes(buffer) == content[150:3150]
+            with pytest.raises(ValueError):
+                raw.seek(-1)
+        with sfs.open('dir/data') as buffered:
+            assert buffered.read() == content
+
+
+def test_small_chunksize_is_rejected_up_front(tmp_path):
+    filename = str(tmp_path / 'small.bcf')
+    with pytest.raises(ValueError, match='minimum is 1568'):
+        write_bcf(filename, chunksize=512)
+    assert not os.path.exists(filename)
+    sfs = SFS_writer(chunksize=min_chunksize(2))
+    sfs.add_dir('a')
+    sfs.add_file('b', b'content', parent=0)
+    with pytest.raises(ValueError, match='at least {0}'.format(
+            min_chunksize(3))):
+        sfs.add_file('c', b'content', parent=0)
+
+
+def test_index_cache_is_invalidated_by_changed_file(tmp_path):
+    filename = str(tmp_path / 'changing.bcf')
+    region = (3, 8, 2, 9)
+    cube = write_bcf(filename, height=11, width=12, seed=1)[0]
+    with bcf_hype.BCF_reader(filename) as reader:
+        reader.get_spectrum_index(0)
+        first_key = reader.index_cache.filename
+    assert os.path.exists(first_key)
+    with bcf_hype.BCF_reader(filename) as reader:
+        # unchanged file reuses the stored index:
+        assert reader.index_cache.filename == first_key
+        assert reader.get_spectrum_index(0, build=False) is not None
+    cube = write_bcf(filename, height=11, width=12, seed=2)[0]
+    with bcf_hype.BCF_reader(filename) as reader:
+        assert reader.index_cache.filename != first_key
+        assert reader.get_spectrum_index(0, build=False) is None
+        max_chan = reader.header.estimate_map_channels()
+        hypermap = reader.parse_hypermap(region=region)
+    np.testing.assert_array_equal(
+        hypermap, expected_hypermap(cube, max_chan, region=region))
+
+
+def test_hypermap_cache_is_invalidated_by_changed_file(tmp_path):
+    filename = str(tmp_path / 'changing.bcf')
+    cache = bcf_hype.HypermapCache(str(tmp_path / 'hypermaps'))
+    cube = write_bcf(filename, height=10, width=9, seed=1)[0]
+    for cached in (False, True):
+        with bcf_hype.BCF_reader(filename, hypermap_cache=cache) as reader:
+            reader.persistent_parse_hypermap(downsample=2)
+            hypermap = reader.hypermap[0].hypermap
+            max_chan = reader.header.estimate_map_channels()
+        assert isinstance(hypermap, np.memmap) == cached
+        np.testing.assert_array_equal(hypermap,
+                                      expected_hypermap(cube, max_chan, 2))
+    del hypermap
+    cube = write_bcf(filename, height=10, width=9, seed=2)[0]
+    with bcf_hype.BCF_reader(filename, hypermap_cache=cache) as reader:
+        reader.persistent_parse_hypermap(downsample=2)
+        hypermap = reader.hypermap[0].hypermap
+    assert not isinstance(hypermap, np.memmap)
+    np.testing.assert_array_equal(hypermap,
+                                  expected_hypermap(cube, max_chan, 2))
+
+
+@pytest.mark.parametrize('workers', [None, 1, 3])
+def test_decompression_workers_give_same_content(container, workers):
+    filename, content = container
+    with bcf_hype.SFS_reader(filename, decompression_workers=workers,
+                             index_cache=False) as sfs:
+        item = sfs.get_file('dir/data')
+        assert item.get_as_BytesIO_string().getvalue() == content
+        chunks = item.get_iter_and_properties()[0]
+        assert b''.join(chunks) == content
+
+
+def test_decompression_workers_decode_same_hypermap(tmp_path):
+    filename = str(tmp_path / 'compressed.bcf')
+    cube = write_bcf(filename, height=12, width=14, compression='zlib',
+                     chunksize=2048, fragmented=True, seed=3)[0]
+    with bcf_hype.BCF_reader(filename, decompression_workers=3,
+                             index_cache=False) as reader:
+        max_chan = reader.header.estimate_map_channels()
+        hypermap = reader.parse_hypermap(downsample=2)
+    np.testing.assert_array_equal(hypermap,
+                                  expected_hypermap(cube, max_chan, 2))
+
+
+def test_fragmentation_report(tmp_path):
+    report = {}
+    for fragmented in (False, True):
+        filename = str(tmp_path / 'fragmented{0}.bcf'.format(fragmented))
+        write_bcf(filename, height=13, width=17, chans=2048,
+                  compression='zlib', fragmented=fragmented, n_indexes=2,
+                  seed=5)
+        with bcf_hype.SFS_reader(filename, index_cache=False) as sfs:
+            report[fragmented] = sfs.get_fragmentation_report()
+            for path, stats in report[fragmented].items():
+                assert stats == sfs.get_file(path).get_fragmentation()
+    assert sorted(report[False]) == ['EDSDatabase/HeaderData',
+                                     'EDSDatabase/SpectrumData0',
+                                     'EDSDatabase/SpectrumData1']
+    for path, stats in report[False].items():
+        assert stats['runs'] == 1
+        assert stats['longest_run'] == stats['chunks']
+        assert stats['fragmentation'] == 0.0
+        assert report[True][path]['chunks'] == stats['chunks']
+    shuffled = report[True]['EDSDatabase/SpectrumData0']
+    assert shuffled['runs'] > 1
+    assert shuffled['longest_run'] < shuffled['chunks']
+    assert shuffled['fragmentation'] == pytest.approx(
+        (shuffled['runs'] - 1) / (shuffled['chunks'] - 1))